@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""Measure fraud scoring decisions per second.
+
+Runs the default rule set of the fraud-service (velocity windows, amount
+threshold, payment method risk) in-process, with transactions spread over a
+configurable number of users.
+
+    python benchmarks/fraud_scoring.py --decisions 1000000 --users 50000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'services', 'fraud'))
+
+import scoring
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--decisions', type=int, default=500000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    engine = scoring.build_engine()
+    methods = ['credit_card', 'debit_card', 'gift_card', 'crypto']
+    transactions = [
+        scoring.Transaction(
+            str(n),
+            str(random.randrange(args.users)),
+            random.choice(methods),
+            f"{random.uniform(1, 500):.2f}",
+            timestamp=n * 0.001,
+        )
+        for n in range(args.decisions)
+    ]
+
+    flagged = 0
+    started = time.perf_counter()
+    for transaction in transactions:
+        if engine.evaluate(transaction).is_fraud:
+            flagged += 1
+    elapsed = time.perf_counter() - started
+
+    print(f"{args.decisions} decisions over {args.users} users in {elapsed:.2f}s")
+    print(f"{args.decisions / elapsed:,.0f} decisions/s, {elapsed / args.decisions * 1e6:.2f}us per decision, "
+          f"{flagged / args.decisions:.1%} flagged")
+    print(f"tracked users: {len(engine.rules[0].tracker.users)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""Compare the sync (Flask) and async (ASGI) api-gateway under concurrent load.
+
+Both gateways are started as subprocesses in front of a stub order-service
+that answers after a fixed delay, so the numbers show how many in-flight
+orders a single gateway process can hold while it waits on the chain.
+
+    python benchmarks/gateway_sync_vs_async.py --concurrency 500 --requests 5000
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import statistics
+import subprocess
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = os.path.join(ROOT, 'services')
+GATEWAY = os.path.join(SERVICES, 'api-gateway')
+
+ORDER = {
+    "user_id": "123",
+    "items": [{"item_id": "sku001", "quantity": 1}],
+    "amount": "49.99",
+    "payment_method": "credit_card",
+}
+
+def stub_app(latency):
+    from starlette.applications import Starlette
+    from starlette.responses import JSONResponse
+    from starlette.routing import Route
+
+    async def create_order(request):
+        await request.body()
+        await asyncio.sleep(latency)
+        return JSONResponse({"status": "success", "message": "Order created"})
+
+    return Starlette(routes=[Route('/order', create_order, methods=['POST'])])
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on port {port}")
+
+def start(cmd, cwd, env):
+    return subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def gateway_command(mode, port):
+    if mode == 'async':
+        return [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(port), '--no-access-log']
+    # app.run() in the sync gateway uses the threaded Werkzeug server
+    return [sys.executable, '-c',
+            "import app; from werkzeug.serving import run_simple; "
+            f"run_simple('127.0.0.1', {port}, app.app, threaded=True)"]
+
+async def run_load(url, total, concurrency):
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for _ in range(total):
+        queue.put_nowait(None)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        async def worker():
+            nonlocal errors
+            while not queue.empty():
+                queue.get_nowait()
+                start = time.perf_counter()
+                try:
+                    response = await client.post(url, json=ORDER)
+                    if response.status_code != 200:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+def report(mode, latencies, errors, elapsed):
+    print(f"{mode:>6}  {len(latencies) / elapsed:9.1f} req/s  "
+          f"p50={percentile(latencies, 50) * 1000:7.1f}ms  "
+          f"p95={percentile(latencies, 95) * 1000:7.1f}ms  "
+          f"p99={percentile(latencies, 99) * 1000:7.1f}ms  "
+          f"mean={statistics.mean(latencies) * 1000:7.1f}ms  errors={errors}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--downstream-latency-ms', type=float, default=100.0)
+    parser.add_argument('--modes', default='sync,async')
+    parser.add_argument('--tracing', action='store_true', help='keep the OpenTelemetry SDK enabled')
+    parser.add_argument('--stub-port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stub_port:
+        import uvicorn
+        uvicorn.run(stub_app(args.downstream_latency_ms / 1000.0), port=args.stub_port,
+                    log_level='warning', access_log=False)
+        return
+
+    stub_port = free_port()
+    stub = start([sys.executable, os.path.abspath(__file__), '--stub-port', str(stub_port),
+                  '--downstream-latency-ms', str(args.downstream_latency_ms)], ROOT, os.environ.copy())
+    try:
+        wait_for_port(stub_port)
+        print(f"{args.requests} orders, concurrency {args.concurrency}, "
+              f"order-service latency {args.downstream_latency_ms}ms")
+        for mode in args.modes.split(','):
+            port = free_port()
+            env = dict(os.environ,
+                       SERVICE_NAME='api-gateway',
+                       PYTHONPATH=SERVICES,
+                       ORDER_SERVICE_URL=f'http://127.0.0.1:{stub_port}',
+                       ORDER_SERVICE_POOL_MAXSIZE=str(args.concurrency),
+                       # Compares the gateways, not their load shedding
+                       ADMISSION_ENABLED='false',
+                       TEMPO_HOSTNAME='127.0.0.1')
+            if not args.tracing:
+                env['OTEL_SDK_DISABLED'] = 'true'
+            gateway = start(gateway_command(mode, port), GATEWAY, env)
+            try:
+                wait_for_port(port)
+                latencies, errors, elapsed = asyncio.run(
+                    run_load(f'http://127.0.0.1:{port}/api/order', args.requests, args.concurrency))
+                report(mode, latencies, errors, elapsed)
+            finally:
+                gateway.terminate()
+                gateway.wait()
+    finally:
+        stub.terminate()
+        stub.wait()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""Hammer /inventory/check from several processes and threads at once and
+verify that stock is never oversold.
+
+The inventory-service runs in-process against a temporary SQLite database,
+the warehouse-service is replaced by a stub that always answers 200. The
+script exits non-zero when the number of successful reservations does not
+match the stock that was taken, or when availability drops below zero.
+
+    python benchmarks/inventory_oversell_stress.py --processes 4 --threads 16 --stock 500
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import threading
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = os.path.join(ROOT, 'services')
+
+class WarehouseStub(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = json.dumps({"status": "success", "message": "Reserved"}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def load_inventory_app():
+    sys.path.insert(0, SERVICES)
+    sys.path.insert(0, os.path.join(SERVICES, 'inventory'))
+    import app as inventory
+    return inventory
+
+def worker(attempts, threads, quantity, results):
+    inventory = load_inventory_app()
+    # Connections must not be shared with the parent after fork
+    with inventory.app.app_context():
+        inventory.db.engine.dispose(close=False)
+
+    counts = {"success": 0, "failure": 0, "error": 0}
+    lock = threading.Lock()
+
+    def run():
+        client = inventory.app.test_client()
+        for _ in range(attempts):
+            response = client.post('/inventory/check', json={"item_id": "sku001", "quantity": quantity})
+            outcome = {200: "success", 400: "failure"}.get(response.status_code, "error")
+            with lock:
+                counts[outcome] += 1
+
+    pool = [threading.Thread(target=run) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put(counts)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--attempts', type=int, default=50, help='requests per thread')
+    parser.add_argument('--quantity', type=int, default=1)
+    parser.add_argument('--stock', type=int, default=500)
+    args = parser.parse_args()
+
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), WarehouseStub)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+    workdir = tempfile.mkdtemp()
+    os.environ.update(
+        SERVICE_NAME='inventory-service',
+        OTEL_SDK_DISABLED='true',
+        DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'inventory.db')}",
+        WAREHOUSE_SERVICE_URL=f"http://127.0.0.1:{stub.server_port}",
+        CHAOS_MONKEY_ENABLED='',
+    )
+
+    inventory = load_inventory_app()
+    with inventory.app.app_context():
+        inventory.db.create_all()
+        inventory.db.session.add(inventory.Inventory(id='sku001', description='stress', availability=args.stock))
+        inventory.db.session.commit()
+        inventory.db.engine.dispose()
+
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    processes = [
+        context.Process(target=worker, args=(args.attempts, args.threads, args.quantity, results))
+        for _ in range(args.processes)
+    ]
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+    totals = {"success": 0, "failure": 0, "error": 0}
+    for _ in processes:
+        for key, value in results.get().items():
+            totals[key] += value
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+
+    with inventory.app.app_context():
+        remaining = inventory.db.session.get(inventory.Inventory, 'sku001').availability
+
+    requested = args.processes * args.threads * args.attempts
+    taken = args.stock - remaining
+    print(f"{requested} reservations in {elapsed:.2f}s ({requested / elapsed:.0f} req/s)")
+    print(f"success={totals['success']} rejected={totals['failure']} errors={totals['error']} "
+          f"stock={args.stock} remaining={remaining}")
+
+    if remaining < 0 or taken != totals['success'] * args.quantity:
+        print("FAIL: stock was oversold or reservations were lost")
+        sys.exit(1)
+    print("OK: stock was never oversold")
+
+if __name__ == '__main__':
+    main()
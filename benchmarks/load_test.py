@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+"""Replay a mix of orders against the api-gateway and report latency percentiles.
+
+By default all services are started in this process, each with its own
+SQLite database in a temporary directory, and every span is recorded in
+memory to break the latency down per hop. Downstreams can be replaced with
+stubs (--stub fraud,warehouse), or a running gateway can be targeted with
+--url, in which case there is no per-hop breakdown.
+
+Requests are sent either by a fixed number of concurrent clients
+(--concurrency) or at a fixed arrival rate (--rate). At a fixed rate the
+latency is measured from the time the request was due, so a slow service
+cannot hide its queueing delay.
+
+    python benchmarks/load_test.py --requests 2000 --concurrency 16
+    python benchmarks/load_test.py --requests 2000 --rate 100 --stub fraud --stub-latency-ms 20
+    python benchmarks/load_test.py --requests 2000 --json current.json --baseline baseline.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+import importlib.util
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES_DIR = os.path.join(ROOT, 'services')
+
+# Started leaves first, so the URL of every downstream is known when a
+# service is imported: (directory, service name, URL variable of its callers)
+SERVICES = [
+    ('fraud', 'fraud-service', 'FRAUD_SERVICE_URL'),
+    ('payment', 'payment-service', 'PAYMENT_SERVICE_URL'),
+    ('warehouse', 'warehouse-service', 'WAREHOUSE_SERVICE_URL'),
+    ('inventory', 'inventory-service', 'INVENTORY_SERVICE_URL'),
+    ('order', 'order-service', 'ORDER_SERVICE_URL'),
+    ('api-gateway', 'api-gateway', None),
+]
+LOCATIONS = ['Warehouse-A', 'Warehouse-B']
+
+def parse_weights(spec):
+    """'sku001:3,sku002:1' -> (['sku001', 'sku002'], [3.0, 1.0])"""
+    names, weights = [], []
+    for part in spec.split(','):
+        name, _, weight = part.partition(':')
+        names.append(name.strip())
+        weights.append(float(weight or 1))
+    return names, weights
+
+def parse_range(spec, kind):
+    low, _, high = spec.partition('-')
+    return kind(low), kind(high or low)
+
+def build_orders(args):
+    rng = random.Random(args.seed)
+    skus, sku_weights = parse_weights(args.skus)
+    methods, method_weights = parse_weights(args.payment_methods)
+    quantity_low, quantity_high = parse_range(args.quantity, int)
+    lines_low, lines_high = parse_range(args.lines, int)
+    amount_low, amount_high = parse_range(args.amount, float)
+    return [
+        {
+            "user_id": str(rng.randrange(args.users)),
+            "items": [{
+                "item_id": rng.choices(skus, sku_weights)[0],
+                "quantity": rng.randint(quantity_low, quantity_high),
+            } for _ in range(rng.randint(lines_low, lines_high))],
+            "amount": f"{rng.uniform(amount_low, amount_high):.2f}",
+            "payment_method": rng.choices(methods, method_weights)[0],
+            "shipping_address": "10 Main Street, CA",
+        }
+        for _ in range(args.requests + args.warmup)
+    ]
+
+class HopRecorder:
+    """In-memory span exporter that keeps only what the hop breakdown needs."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = []
+
+    def export(self, spans):
+        from opentelemetry.sdk.trace.export import SpanExportResult
+        with self.lock:
+            for span in spans:
+                self.spans.append((
+                    span.context.span_id,
+                    span.parent.span_id if span.parent is not None else None,
+                    span.kind.name,
+                    span.name,
+                    (span.end_time - span.start_time) / 1e6,
+                ))
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        pass
+
+    def force_flush(self, timeout_millis=30000):
+        return True
+
+    def clear(self):
+        with self.lock:
+            self.spans = []
+
+    def hops(self):
+        """Duration and self time (without downstream calls) of every server span, by name."""
+        with self.lock:
+            spans = list(self.spans)
+        by_id = {span_id: (parent_id, kind) for span_id, parent_id, kind, _, _ in spans}
+        downstream = defaultdict(float)
+        for span_id, parent_id, kind, _, duration in spans:
+            if kind != 'CLIENT':
+                continue
+            # Charge the call to the nearest server span above it
+            while parent_id is not None and parent_id in by_id:
+                parent_of_parent, parent_kind = by_id[parent_id]
+                if parent_kind == 'SERVER':
+                    downstream[parent_id] += duration
+                    break
+                parent_id = parent_of_parent
+        hops = defaultdict(lambda: ([], []))
+        for span_id, _, kind, name, duration in spans:
+            if kind == 'SERVER':
+                durations, self_times = hops[name]
+                durations.append(duration)
+                self_times.append(max(duration - downstream[span_id], 0.0))
+        return hops
+
+def stub_app(name, latency):
+    """Answers every POST with success after a fixed delay, batches item by item
+    and multi-item reservations with empty allocations."""
+    from flask import Flask, request, jsonify
+
+    stub = Flask(name)
+
+    @stub.route('/<path:path>', methods=['POST'])
+    def respond(path):
+        time.sleep(latency)
+        payload = request.get_json(silent=True) or {}
+        if path.endswith('/batch'):
+            items = next((value for value in payload.values() if isinstance(value, list)), [])
+            return jsonify({"status": "success", "results": [{"status": "success", "message": "stub"} for _ in items]})
+        if isinstance(payload.get('items'), list):
+            items = [dict(item, allocations=[]) for item in payload['items']]
+            return jsonify({"status": "success", "message": "stub", "items": items})
+        return jsonify({"status": "success", "message": "stub"})
+
+    return stub
+
+def load_service(directory):
+    sys.path.insert(0, os.path.join(SERVICES_DIR, directory))
+    spec = importlib.util.spec_from_file_location(
+        directory.replace('-', '_') + '_app', os.path.join(SERVICES_DIR, directory, 'app.py'),
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def seed_stock(modules, skus, stock):
+    from sqlalchemy import text
+    inventory = modules.get('inventory')
+    if inventory is not None:
+        with inventory.app.app_context():
+            inventory.db.session.execute(
+                text("INSERT OR REPLACE INTO inventory (id, description, availability) VALUES (:id, :id, :stock)"),
+                [{"id": sku, "stock": stock} for sku in skus],
+            )
+            inventory.db.session.commit()
+    warehouse = modules.get('warehouse')
+    if warehouse is not None:
+        with warehouse.app.app_context():
+            # Replace the seed data of the service with one row per SKU and location
+            warehouse.db.session.execute(
+                text("DELETE FROM warehouse_inventory WHERE item_id = :sku"),
+                [{"sku": sku} for sku in skus],
+            )
+            warehouse.db.session.execute(
+                text(
+                    "INSERT OR REPLACE INTO warehouse_inventory "
+                    "(id, item_id, warehouse_location, available_quantity, reserved_quantity) "
+                    "VALUES (:id, :sku, :location, :stock, 0)"
+                ),
+                [
+                    {"id": f"{sku}_{location}", "sku": sku, "location": location, "stock": stock}
+                    for sku in skus
+                    for location in LOCATIONS
+                ],
+            )
+            warehouse.db.session.commit()
+
+def start_services(args, recorder):
+    """Start the services in this process and return the gateway URL."""
+    from werkzeug.serving import make_server
+    from opentelemetry import trace
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+
+    sys.path.insert(0, SERVICES_DIR)
+    from common import telemetry
+
+    # One provider for every service, recording all spans in memory
+    telemetry.defer_tracing = True
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(recorder))
+    trace.set_tracer_provider(provider)
+
+    database_dir = tempfile.mkdtemp(prefix='load-test-')
+    os.environ['FRAUD_PERCENTAGE'] = str(args.fraud_rate)
+    os.environ['NOT_FRAUD_PERCENTAGE'] = str(100 - args.fraud_rate)
+    # Rate limits and load shedding of the gateway would hide the capacity of the services
+    os.environ['ADMISSION_ENABLED'] = 'true' if args.admission else 'false'
+    stubs = {name.strip() for name in args.stub.split(',') if name.strip()}
+
+    modules = {}
+    for directory, service_name, url_variable in SERVICES:
+        if directory in stubs:
+            wsgi_app = stub_app(service_name, args.stub_latency_ms / 1000.0)
+        else:
+            os.environ['SERVICE_NAME'] = service_name
+            os.environ['DATABASE_URL'] = f"sqlite:///{database_dir}/{directory}.db"
+            module = modules[directory] = load_service(directory)
+            module.app.logger.setLevel(logging.CRITICAL)
+            if hasattr(module, 'init_db'):
+                module.init_db()
+            wsgi_app = module.app
+        server = make_server('127.0.0.1', 0, wsgi_app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.port}"
+        if url_variable is not None:
+            os.environ[url_variable] = url
+
+    skus, _ = parse_weights(args.skus)
+    seed_stock(modules, skus, args.stock)
+    return url
+
+class Results:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.outcomes = Counter()
+
+    def record(self, latency, outcome):
+        with self.lock:
+            self.latencies.append(latency)
+            self.outcomes[outcome] += 1
+
+_sessions = threading.local()
+
+def send(url, order, results, due=None):
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        session = _sessions.session = requests.Session()
+        # Every client thread has its own token bucket in the gateway
+        session.headers['X-Client-Id'] = f'load-test-{threading.current_thread().name}'
+    started = time.perf_counter() if due is None else due
+    try:
+        response = session.post(url, json=order, timeout=30)
+        try:
+            outcome = f"{response.status_code} {response.json().get('status')}"
+        except ValueError:
+            outcome = f"{response.status_code}"
+    except requests.RequestException as e:
+        outcome = type(e).__name__
+    results.record(time.perf_counter() - started, outcome)
+
+def run_closed(url, orders, concurrency, results):
+    """Every client sends its next order as soon as the previous one returns."""
+    position = iter(orders)
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                order = next(position, None)
+            if order is None:
+                return
+            send(url, order, results)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def run_open(url, orders, rate, concurrency, results):
+    """Send orders at a fixed rate, independent of how fast they complete."""
+    interval = 1.0 / rate
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for n, order in enumerate(orders):
+            due = start + n * interval
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, url, order, results, due)
+
+def run(url, orders, args):
+    results = Results()
+    started = time.perf_counter()
+    if args.rate:
+        run_open(url, orders, args.rate, args.concurrency, results)
+    else:
+        run_closed(url, orders, args.concurrency, results)
+    return results, time.perf_counter() - started
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(q * len(sorted_values)) - 1))]
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "p999": percentile(values, 0.999),
+        "max": values[-1] if values else 0.0,
+    }
+
+def report(results, elapsed, hops):
+    latency = summarize([value * 1000 for value in results.latencies])
+    summary = {
+        "requests": latency["count"],
+        "seconds": round(elapsed, 3),
+        "throughput": round(latency["count"] / elapsed, 2),
+        "latency_ms": {key: round(value, 3) for key, value in latency.items() if key != "count"},
+        "outcomes": dict(results.outcomes),
+        "hops": {},
+    }
+    for name, (durations, self_times) in sorted(hops.items()):
+        hop = summarize(durations)
+        summary["hops"][name] = {
+            "count": hop["count"],
+            "p50_ms": round(hop["p50"], 3),
+            "p95_ms": round(hop["p95"], 3),
+            "p99_ms": round(hop["p99"], 3),
+            "self_p50_ms": round(summarize(self_times)["p50"], 3),
+        }
+
+    print(f"{summary['requests']} requests in {elapsed:.2f}s, {summary['throughput']:.1f} requests/s")
+    print("latency ms: " + "  ".join(f"{key} {value:.1f}" for key, value in summary["latency_ms"].items()))
+    print("outcomes: " + ", ".join(f"{key}: {value}" for key, value in sorted(summary["outcomes"].items())))
+    if summary["hops"]:
+        print(f"\n{'hop':<32} {'count':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'self p50':>9}")
+        for name, hop in summary["hops"].items():
+            print(f"{name:<32} {hop['count']:>7} {hop['p50_ms']:>8.1f} {hop['p95_ms']:>8.1f} "
+                  f"{hop['p99_ms']:>8.1f} {hop['self_p50_ms']:>9.1f}")
+    return summary
+
+def compare(summary, baseline, tolerance):
+    """Regressions of p50/p99 latency and throughput beyond the tolerance."""
+    regressions = []
+    for key in ("p50", "p99"):
+        before, after = baseline["latency_ms"][key], summary["latency_ms"][key]
+        if after > before * (1 + tolerance):
+            regressions.append(f"{key} latency {before:.1f}ms -> {after:.1f}ms")
+    before, after = baseline["throughput"], summary["throughput"]
+    if after < before * (1 - tolerance):
+        regressions.append(f"throughput {before:.1f}/s -> {after:.1f}/s")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='gateway to target instead of starting the services in-process')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--warmup', type=int, default=50, help='requests sent first and left out of the results')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients, or the most in-flight requests with --rate')
+    parser.add_argument('--rate', type=float, help='requests per second, instead of closed-loop clients')
+    parser.add_argument('--skus', default='sku001:3,sku002:1', help='item mix as sku:weight')
+    parser.add_argument('--lines', default='1-3', help='range of line items per order')
+    parser.add_argument('--quantity', default='1-3', help='quantity range per line item')
+    parser.add_argument('--amount', default='5-500', help='amount range per order')
+    parser.add_argument('--payment-methods', default='credit_card:8,debit_card:1,gift_card:1')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--fraud-rate', type=int, default=5, help='percent of transactions flagged at random (in-process only)')
+    parser.add_argument('--stock', type=int, default=10**9, help='stock seeded for every SKU (in-process only)')
+    parser.add_argument('--stub', default='', help='services replaced with stubs, e.g. fraud,warehouse (in-process only)')
+    parser.add_argument('--stub-latency-ms', type=float, default=0.0)
+    parser.add_argument('--admission', action='store_true', help='keep the admission control of the gateway on (in-process only)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression against the baseline')
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    logging.getLogger('opentelemetry').setLevel(logging.ERROR)
+
+    recorder = HopRecorder()
+    url = args.url or start_services(args, recorder)
+    url = url.rstrip('/') + '/api/order'
+    orders = build_orders(args)
+
+    if args.warmup:
+        run(url, orders[:args.warmup], args)
+    recorder.clear()
+    results, elapsed = run(url, orders[args.warmup:], args)
+    summary = report(results, elapsed, recorder.hops())
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(summary, json.load(f), args.tolerance)
+        if regressions:
+            print("\nregressions against the baseline: " + "; ".join(regressions))
+            sys.exit(1)
+        print("\nno regressions against the baseline")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""Measure the per-request cost of tracing under different telemetry policies.
+
+Every simulated request creates the span tree of an order-service request
+(a server span, the downstream client spans and their body attributes).
+Spans are encoded to OTLP protobuf synchronously so that encoding cost and
+exported bytes are part of the measurement, nothing is sent over the network.
+A small share of requests fails or is slow, to show what tail sampling keeps.
+
+    python benchmarks/tracing_overhead.py --requests 20000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'services'))
+
+from opentelemetry import trace
+from opentelemetry.trace import SpanKind, Status, StatusCode
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor, SpanExporter, SpanExportResult
+from opentelemetry.exporter.otlp.proto.common.trace_encoder import encode_spans
+
+from common import telemetry
+
+# (name, sample ratio, tail sampling, capture bodies, max attribute length)
+POLICIES = [
+    ("tracing off", None, False, False, None),
+    ("100%, bodies, unlimited", 1.0, False, True, 1 << 20),
+    ("100%, bodies, 1024 chars", 1.0, False, True, 1024),
+    ("100%, no bodies", 1.0, False, False, 1024),
+    ("10%, no bodies", 0.1, False, False, 1024),
+    ("10% + tail, no bodies", 0.1, True, False, 1024),
+    ("1% + tail, no bodies", 0.01, True, False, 1024),
+]
+
+class EncodingExporter(SpanExporter):
+    """Encodes spans like the OTLP exporter would and counts the bytes."""
+
+    def __init__(self):
+        self.bytes = 0
+        self.spans = 0
+
+    def export(self, spans):
+        self.bytes += len(encode_spans(spans).SerializeToString())
+        self.spans += len(spans)
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        pass
+
+REQUEST_BODY = {
+    "order_id": 123,
+    "user_id": "123",
+    "payment_method": "credit_card",
+    "amount": "49.99",
+    "items": [{"item_id": f"sku{n:03d}", "quantity": 1} for n in range(20)],
+}
+RESPONSE_TEXT = json.dumps({"status": "success", "message": "Payment authorized", "detail": "x" * 2048})
+
+def simulate_request(tracer, failed, slow):
+    start_time = time.time_ns() - (2 * 10**9 if slow else 0)
+    with tracer.start_as_current_span("POST /order", kind=SpanKind.SERVER, start_time=start_time) as root:
+        root.set_attribute("http.method", "POST")
+        root.set_attribute("http.route", "/order")
+        with tracer.start_as_current_span("create_order") as span:
+            span.set_attribute("order.user_id", "123")
+            for call in ("inventory_service_call", "order_to_payment_authorization"):
+                with tracer.start_as_current_span(call) as call_span:
+                    with tracer.start_as_current_span("http_post", kind=SpanKind.CLIENT) as http_span:
+                        http_span.set_attribute("http.method", "POST")
+                        http_span.set_attribute("http.status_code", 500 if failed else 200)
+                        telemetry.record_body(http_span, "http.request_body", REQUEST_BODY)
+                        telemetry.record_body(http_span, "http.response_body", lambda: RESPONSE_TEXT)
+                    call_span.set_attribute("response.status", "failure" if failed else "success")
+        if failed:
+            root.set_status(Status(StatusCode.ERROR))
+
+def run(policy, requests, error_rate, slow_rate, seed):
+    name, ratio, tail, bodies, max_length = policy
+    random.seed(seed)
+    outcomes = [(random.random() < error_rate, random.random() < slow_rate) for _ in range(requests)]
+
+    exporter = EncodingExporter()
+    if ratio is None:
+        tracer = trace.NoOpTracerProvider().get_tracer(__name__)
+    else:
+        provider = TracerProvider(
+            sampler=telemetry.sampler(ratio, tail),
+            span_limits=telemetry.span_limits(max_length),
+        )
+        provider.add_span_processor(telemetry.span_processor(SimpleSpanProcessor(exporter), tail))
+        tracer = provider.get_tracer(__name__)
+    telemetry.CAPTURE_BODIES = bodies
+    telemetry.ATTRIBUTE_MAX_LENGTH = max_length or 0
+
+    started = time.perf_counter()
+    for failed, slow in outcomes:
+        simulate_request(tracer, failed, slow)
+    elapsed = time.perf_counter() - started
+    return elapsed / requests * 1e6, exporter.bytes / requests, exporter.spans
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--slow-rate', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"{args.requests} requests, {args.error_rate:.0%} errors, {args.slow_rate:.0%} slow")
+    print(f"{'policy':<26} {'us/request':>10} {'bytes/request':>14} {'exported spans':>15}")
+    for policy in POLICIES:
+        per_request, exported_bytes, spans = run(policy, args.requests, args.error_rate, args.slow_rate, args.seed)
+        print(f"{policy[0]:<26} {per_request:>10.1f} {exported_bytes:>14.0f} {spans:>15}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+import os
+import math
+import time
+import threading
+from collections import OrderedDict
+from common import metrics
+
+ADMISSION_ENABLED           = os.getenv('ADMISSION_ENABLED', 'true')
+# Clients are told apart by this header, or by their address without it
+ADMISSION_CLIENT_HEADER     = os.getenv('ADMISSION_CLIENT_HEADER', 'X-Client-Id')
+ADMISSION_CLIENT_RATE       = os.getenv('ADMISSION_CLIENT_RATE', 50)
+ADMISSION_CLIENT_BURST      = os.getenv('ADMISSION_CLIENT_BURST', 100)
+ADMISSION_MAX_CLIENTS       = os.getenv('ADMISSION_MAX_CLIENTS', 10000)
+# Concurrency limit of each worker, adapted to the latency of the order-service
+ADMISSION_INITIAL_LIMIT     = os.getenv('ADMISSION_INITIAL_LIMIT', 20)
+ADMISSION_MIN_LIMIT         = os.getenv('ADMISSION_MIN_LIMIT', 2)
+ADMISSION_MAX_LIMIT         = os.getenv('ADMISSION_MAX_LIMIT', 200)
+ADMISSION_LATENCY_TARGET_MS = os.getenv('ADMISSION_LATENCY_TARGET_MS', 500)
+ADMISSION_BACKOFF           = os.getenv('ADMISSION_BACKOFF', 0.9)
+# Share of the concurrency limit a priority class may fill, lower classes are shed first
+ADMISSION_PRIORITY_SHARES   = os.getenv('ADMISSION_PRIORITY_SHARES', 'critical=1.0,normal=0.9,sheddable=0.5')
+
+CRITICAL = 'critical'
+NORMAL = 'normal'
+SHEDDABLE = 'sheddable'
+PRIORITIES = (CRITICAL, NORMAL, SHEDDABLE)
+
+ADMITTED = 'admitted'
+RATE_LIMITED = 'rate_limited'
+SHED = 'shed'
+
+def parse_shares(value):
+    shares = {}
+    for entry in value.split(','):
+        if '=' in entry:
+            priority, share = entry.split('=', 1)
+            shares[priority.strip()] = float(share)
+    return shares
+
+def _is_true(value):
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+requests_total = metrics.register(metrics.Counter(
+    'gateway_admission_requests',
+    'Requests to the api-gateway by priority class and admission outcome.',
+    ('priority', 'outcome'),
+))
+limit_gauge = metrics.register(metrics.Gauge(
+    'gateway_admission_concurrency_limit',
+    'Adaptive concurrency limit of the api-gateway, summed over the workers.',
+))
+inflight_gauge = metrics.register(metrics.Gauge(
+    'gateway_admission_inflight',
+    'Requests admitted by the api-gateway and not finished yet.',
+))
+clients_gauge = metrics.register(metrics.Gauge(
+    'gateway_admission_clients',
+    'Clients with a token bucket in the api-gateway.',
+))
+
+class TokenBuckets:
+    """A token bucket per client.
+
+    Every client may send rate requests per second on average and burst
+    requests at once. Only the max_clients most recently seen clients keep
+    a bucket, a client seen again after that starts with a full one.
+    """
+
+    def __init__(self, rate=None, burst=None, max_clients=None):
+        self.rate = float(ADMISSION_CLIENT_RATE if rate is None else rate)
+        self.burst = float(ADMISSION_CLIENT_BURST if burst is None else burst)
+        self.max_clients = int(ADMISSION_MAX_CLIENTS if max_clients is None else max_clients)
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, client):
+        """Take a token of the client, returns 0 or the seconds until the next one."""
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0
+            if tokens >= 1.0:
+                tokens -= 1.0
+            else:
+                wait = (1.0 - tokens) / self.rate
+            self.buckets[client] = (tokens, now)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+            clients = len(self.buckets)
+        clients_gauge.set((), clients)
+        return wait
+
+    def refund(self, client):
+        """Give back the token of a request that was not served."""
+        with self.lock:
+            entry = self.buckets.get(client)
+            if entry is not None:
+                tokens, updated = entry
+                self.buckets[client] = (min(self.burst, tokens + 1.0), updated)
+
+class ConcurrencyLimit:
+    """Adaptive limit of the requests in progress (AIMD).
+
+    A request that finishes within the latency target while the limit is
+    at least half used raises the limit by 1/limit, about one per round of
+    requests. A slower or failed request lowers it by the backoff factor,
+    at most once per latency target, so a burst of slow responses counts
+    once. Each priority class may only fill its share of the limit, so
+    sheddable requests are turned away first.
+    """
+
+    def __init__(self, initial=None, minimum=None, maximum=None, latency_target_ms=None, backoff=None, shares=None):
+        self.minimum = float(ADMISSION_MIN_LIMIT if minimum is None else minimum)
+        self.maximum = float(ADMISSION_MAX_LIMIT if maximum is None else maximum)
+        self.limit = min(self.maximum, max(self.minimum, float(ADMISSION_INITIAL_LIMIT if initial is None else initial)))
+        self.latency_target = float(ADMISSION_LATENCY_TARGET_MS if latency_target_ms is None else latency_target_ms) / 1000.0
+        self.backoff = float(ADMISSION_BACKOFF if backoff is None else backoff)
+        self.shares = parse_shares(ADMISSION_PRIORITY_SHARES) if shares is None else shares
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.last_decrease = 0.0
+        self.increases = 0
+        self.decreases = 0
+
+    def acquire(self, priority):
+        with self.lock:
+            share = self.shares.get(priority, 1.0)
+            if self.inflight >= max(1, int(self.limit * share)):
+                return False
+            self.inflight += 1
+            inflight = self.inflight
+        inflight_gauge.set((), inflight)
+        return True
+
+    def release(self, seconds, ok):
+        now = time.monotonic()
+        with self.lock:
+            self.inflight -= 1
+            if ok and seconds <= self.latency_target:
+                if self.inflight + 1 >= self.limit / 2:
+                    self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+                    self.increases += 1
+            elif now - self.last_decrease >= self.latency_target:
+                self.limit = max(self.minimum, self.limit * self.backoff)
+                self.last_decrease = now
+                self.decreases += 1
+            inflight, limit = self.inflight, self.limit
+        inflight_gauge.set((), inflight)
+        limit_gauge.set((), int(limit))
+
+class Admission:
+    """Admits a request when its client has a token and its priority class
+    fits in the concurrency limit."""
+
+    def __init__(self, buckets=None, limit=None):
+        self.buckets = buckets or TokenBuckets()
+        self.limit = limit or ConcurrencyLimit()
+        limit_gauge.set((), int(self.limit.limit))
+
+    def admit(self, client, priority):
+        """Returns the outcome and the seconds a rejected client should wait."""
+        wait = self.buckets.take(client)
+        if wait > 0:
+            outcome, retry_after = RATE_LIMITED, wait
+        elif not self.limit.acquire(priority):
+            # Shedding is the gateway's doing, it does not count against the client's rate
+            self.buckets.refund(client)
+            outcome, retry_after = SHED, 1.0
+        else:
+            outcome, retry_after = ADMITTED, 0.0
+        requests_total.inc((priority, outcome))
+        return outcome, retry_after
+
+    def finish(self, seconds, ok):
+        """Report the latency of an admitted request, ok is False for 5xx responses."""
+        self.limit.release(seconds, ok)
+
+    def stats(self):
+        with self.limit.lock:
+            limit = {
+                "limit": round(self.limit.limit, 2),
+                "inflight": self.limit.inflight,
+                "increases": self.limit.increases,
+                "decreases": self.limit.decreases,
+                "shares": self.limit.shares,
+            }
+        with self.buckets.lock:
+            limit["clients"] = len(self.buckets.buckets)
+        return limit
+
+def priority_of(default, requested):
+    """The priority class of a request. The X-Request-Priority header can
+    lower the class of a route, never raise it."""
+    if requested in PRIORITIES and PRIORITIES.index(requested) > PRIORITIES.index(default):
+        return requested
+    return default
+
+def rejection(outcome, retry_after):
+    """Status, body and headers of a rejected request."""
+    if outcome == RATE_LIMITED:
+        status, message = 429, "Too many requests, slow down"
+    else:
+        status, message = 503, "The gateway is overloaded, try again later"
+    return status, {"status": "failure", "message": message}, {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+enabled = _is_true(ADMISSION_ENABLED)
+controller = Admission()
+
+def init_app(app, priorities):
+    """Admit the requests to the routes in priorities, a dict of
+    (method, rule) to priority class, and expose GET /debug/admission."""
+    from flask import g, jsonify, request
+
+    @app.before_request
+    def admit_request():
+        if not enabled or request.url_rule is None:
+            return None
+        default = priorities.get((request.method, request.url_rule.rule))
+        if default is None:
+            return None
+        client = request.headers.get(ADMISSION_CLIENT_HEADER) or request.remote_addr
+        priority = priority_of(default, request.headers.get('X-Request-Priority'))
+        outcome, retry_after = controller.admit(client, priority)
+        if outcome != ADMITTED:
+            status, body, headers = rejection(outcome, retry_after)
+            return jsonify(body), status, headers
+        g.admission_started = time.perf_counter()
+        return None
+
+    @app.teardown_request
+    def finish_request(exc):
+        started = g.pop('admission_started', None)
+        if started is not None:
+            status = g.pop('admission_status', 500)
+            controller.finish(time.perf_counter() - started, exc is None and status < 500)
+
+    @app.after_request
+    def record_status(response):
+        if 'admission_started' in g:
+            g.admission_status = response.status_code
+        return response
+
+    @app.route('/debug/admission', methods=['GET'])
+    def admission_stats():
+        return jsonify(controller.stats()), 200
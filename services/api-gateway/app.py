@@ -1,39 +1,41 @@
 import os
 import requests
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from opentelemetry import trace
-from opentelemetry.instrumentation.flask import FlaskInstrumentor
-from opentelemetry.instrumentation.requests import RequestsInstrumentor
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.resources import SERVICE_NAME, Resource
-from opentelemetry.sdk.trace import TracerProvider
+from common import faults, http_client, logs, metrics, profiling, telemetry, tracing
+import admission
 
-TEMPO_HOSTNAME = os.getenv('TEMPO_HOSTNAME', 'tempo')
-TEMPO_PORT     = os.getenv('TEMPO_PORT', '4317')
+ORDER_SERVICE_URL = os.getenv('ORDER_SERVICE_URL', 'http://order-service:5000')
 
 app = Flask(__name__)
 
-# Configure tracer
-trace.set_tracer_provider(TracerProvider(
-    resource=Resource.create({SERVICE_NAME: os.environ['SERVICE_NAME']})
-))
+# Configure tracing and instrument Flask, see common/telemetry.py
+telemetry.init_tracing(os.environ['SERVICE_NAME'])
+telemetry.init_app(app)
 
-# Set up the OTLP exporter
-otlp_exporter = OTLPSpanExporter(
-    endpoint=f"{TEMPO_HOSTNAME}:{TEMPO_PORT}",
-    insecure=True
-)
+# JSON logs with the trace context of every record, see common/logs.py
+logs.init_logging(os.environ['SERVICE_NAME'], app)
 
-# Configure the OpenTelemetry trace provider to 
-# use a BatchSpanProcessor with an OTLP exporter.
-trace.get_tracer_provider().add_span_processor(
-    BatchSpanProcessor(otlp_exporter)
-)
+# RED metrics with trace exemplars at GET /metrics, see common/metrics.py
+metrics.init_app(app)
 
-# Instrument Flask
-FlaskInstrumentor().instrument_app(app)
-RequestsInstrumentor().instrument()
+# Sampling profiler at GET /debug/profile, see common/profiling.py
+profiling.init_app(app)
+
+# Per-client rate limits and an adaptive concurrency limit with priority
+# classes, overload is answered with a fast 429 or 503, see admission.py
+admission.init_app(app, {
+    ('POST', '/api/order'): admission.NORMAL,
+    ('POST', '/api/orders/batch'): admission.SHEDDABLE,
+    ('GET', '/api/order/<int:order_id>'): admission.SHEDDABLE,
+})
+
+# Latency and fault injection per route and downstream, see common/faults.py
+faults.init_app(app)
+
+# Pooled keep-alive client for the order service
+order_service = http_client.client('order-service', ORDER_SERVICE_URL)
+http_client.init_app(app)
 
 # Order Service Routes
 @app.route('/api/order', methods=['POST'])
@@ -43,18 +45,72 @@ def api_create_order():
     tracer = trace.get_tracer(__name__)
 
     with tracer.start_as_current_span("request_to_order_service"):
-        current_span = trace.get_current_span()
-        trace_id = current_span.get_span_context().trace_id
-        trace_id_hex = format(trace_id, '032x')
-        app.logger.debug(f'api-gateway makes a request to order-service trace_id={trace_id_hex}')
-        response = requests.post('http://order-service:5000/order', 
-            headers={"Content-Type": "application/json"},
-            json=payload
-        )
+        app.logger.debug('api-gateway makes a request to order-service')
+        try:
+            response = order_service.post('/order',
+                headers={"Content-Type": "application/json"},
+                json=payload
+            )
+        except requests.exceptions.RequestException as e:
+            app.logger.error("Error while calling order service: %s", e)
+            return jsonify({"status": "failure", "message": "Error contacting order service"}), 500
         if response.status_code != 200:
             app.logger.error(response.text)
         
     return jsonify(response.json()), 200
 
+@app.route('/api/order/<int:order_id>', methods=['GET'])
+def api_get_order(order_id):
+    app.logger.debug('api-gateway received get request')
+    tracer = trace.get_tracer(__name__)
+
+    with tracer.start_as_current_span("request_to_order_service") as span:
+        span.set_attribute("order.order_id", order_id)
+        # The order-service answers an unchanged order with an empty 304
+        headers = {}
+        if 'If-None-Match' in request.headers:
+            headers['If-None-Match'] = request.headers['If-None-Match']
+        try:
+            response = order_service.get(f'/order/{order_id}', route='/order/<int:order_id>', headers=headers)
+        except requests.exceptions.RequestException as e:
+            app.logger.error("Error while calling order service: %s", e)
+            return jsonify({"status": "failure", "message": "Error contacting order service"}), 500
+
+    forwarded = Response(response.content, status=response.status_code, content_type=response.headers.get('Content-Type'))
+    for name in ('ETag', 'Cache-Control'):
+        if name in response.headers:
+            forwarded.headers[name] = response.headers[name]
+    return forwarded
+
+@app.route('/api/orders/batch', methods=['POST'])
+def api_create_orders_batch():
+    payload = request.get_json()
+    orders = payload.get('orders', [])
+    app.logger.debug('api-gateway received a batch of %s orders', len(orders))
+    tracer = trace.get_tracer(__name__)
+
+    with tracer.start_as_current_span("request_to_order_service_batch") as span:
+        span.set_attribute("batch.size", len(orders))
+
+        # Every order gets its own span, which the order-service links to
+        for index, order in enumerate(orders):
+            with tracer.start_as_current_span("batch_order") as order_span:
+                order_span.set_attribute("batch.index", index)
+                order['trace_context'] = tracing.item_context()
+
+        app.logger.debug('api-gateway makes a batch request to order-service')
+        try:
+            response = order_service.post('/order/batch',
+                headers={"Content-Type": "application/json"},
+                json={"orders": orders}
+            )
+        except requests.exceptions.RequestException as e:
+            app.logger.error("Error while calling order service: %s", e)
+            return jsonify({"status": "failure", "message": "Error contacting order service"}), 500
+        if response.status_code != 200:
+            app.logger.error(response.text)
+
+    return jsonify(response.json()), response.status_code
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
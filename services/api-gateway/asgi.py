@@ -0,0 +1,314 @@
+import os
+import time
+import asyncio
+import logging
+import contextlib
+import httpx
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.concurrency import run_in_threadpool
+from starlette.routing import Route
+from opentelemetry import trace
+from opentelemetry.instrumentation.starlette import StarletteInstrumentor
+from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
+from common import faults, http_client, logs, metrics, profiling, telemetry, tracing
+import admission
+
+ORDER_SERVICE_URL = os.getenv('ORDER_SERVICE_URL', 'http://order-service:5000')
+
+logger = logging.getLogger('api-gateway')
+
+# Configure tracing, see common/telemetry.py
+telemetry.init_tracing(os.environ['SERVICE_NAME'])
+
+# JSON logs with the trace context of every record, see common/logs.py
+logs.init_logging(os.environ['SERVICE_NAME'])
+
+# Instrument the async client so the trace context is propagated downstream
+HTTPXClientInstrumentor().instrument()
+
+def order_service_client():
+    # Same pool and timeout settings as the sync gateway
+    settings = http_client.settings_for('order-service')
+    return httpx.AsyncClient(
+        base_url=ORDER_SERVICE_URL,
+        limits=httpx.Limits(
+            max_connections=settings['pool_maxsize'],
+            max_keepalive_connections=settings['pool_maxsize'],
+        ),
+        timeout=httpx.Timeout(
+            settings['read_timeout'],
+            connect=settings['connect_timeout'],
+            pool=settings['pool_timeout'],
+        ),
+    )
+
+# Breaker and retry budget of the order-service calls, see common/resilience.py
+order_policy = http_client.policy('order-service')
+
+async def inject_fault(route, read_timeout):
+    """Delay an order-service call by its fault profile, and fail it or
+    reset its connection, see common/faults.py. Returns the injected error
+    response, or None to send the call."""
+    planned = faults.injector.downstream('order-service', route)
+    if planned is None:
+        return None
+    delay, fault, profile = planned
+    if read_timeout is not None and delay >= read_timeout:
+        # An order-service this slow times the call out, like a slow server would
+        await asyncio.sleep(read_timeout)
+        raise httpx.ReadTimeout("injected delay of order-service exceeded the read timeout")
+    await asyncio.sleep(delay)
+    if fault == faults.RESET:
+        raise httpx.ReadError("connection to order-service reset by an injected fault")
+    if fault == faults.ERROR:
+        return httpx.Response(profile.error_status, json=faults.error_body(profile.error_status))
+    return None
+
+async def request_order(client, method, path, route=None, **kwargs):
+    """Call the order-service through its resilience policy.
+
+    Orders are not idempotent, so a POST is only sent again when the
+    connection could not be established. A GET is also sent again after a
+    timeout or a 502/503/504. route is the path template for the metrics.
+    """
+    idempotent = method == 'GET'
+    span = trace.get_current_span()
+    started = order_policy.start()
+    attempt = 0
+    try:
+        while True:
+            attempt += 1
+            if not order_policy.admit():
+                raise http_client.CircuitOpenError("circuit breaker of order-service is open")
+            timeout = client.timeout
+            sent = time.monotonic()
+            status = 'error'
+            read_timeout = min(timeout.read, max(0.001, order_policy.remaining(started)))
+            try:
+                response = await inject_fault(route or path, read_timeout)
+                if response is None:
+                    response = await client.request(method, path, timeout=httpx.Timeout(
+                        read_timeout,
+                        connect=timeout.connect,
+                        pool=timeout.pool,
+                    ), **kwargs)
+                status = response.status_code
+            except httpx.HTTPError as e:
+                order_policy.record(False)
+                if not isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)) and not (
+                    idempotent and isinstance(e, (httpx.TimeoutException, httpx.NetworkError))
+                ):
+                    raise
+                delay = order_policy.retry_delay(attempt, started)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            finally:
+                metrics.observe_downstream('order-service', method, route or path, status, time.monotonic() - sent)
+            ok = response.status_code < 500
+            order_policy.record(ok, time.monotonic() - sent if ok else None)
+            if idempotent and response.status_code in http_client.RETRY_STATUSES:
+                delay = order_policy.retry_delay(attempt, started)
+                if delay is not None:
+                    await asyncio.sleep(delay)
+                    continue
+            return response
+    finally:
+        span.set_attribute("resilience.downstream", "order-service")
+        span.set_attribute("resilience.attempts", attempt)
+        span.set_attribute("resilience.circuit_state", order_policy.breaker.state)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    app.state.order_service = order_service_client()
+    yield
+    await app.state.order_service.aclose()
+
+def timed(route):
+    """Record the duration of a handler in the request metrics, see common/metrics.py"""
+    def decorator(handler):
+        async def timed_handler(request):
+            started = time.perf_counter()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+                return response
+            finally:
+                metrics.observe_request(request.method, route, status, time.perf_counter() - started)
+        return timed_handler
+    return decorator
+
+def admitted(default):
+    """Admit a request before its handler runs, see admission.py"""
+    def decorator(handler):
+        async def admitted_handler(request):
+            if not admission.enabled:
+                return await handler(request)
+            client = request.headers.get(admission.ADMISSION_CLIENT_HEADER) or (request.client.host if request.client else '')
+            priority = admission.priority_of(default, request.headers.get('x-request-priority'))
+            outcome, retry_after = admission.controller.admit(client, priority)
+            if outcome != admission.ADMITTED:
+                status, body, headers = admission.rejection(outcome, retry_after)
+                return JSONResponse(body, status_code=status, headers=headers)
+            started = time.perf_counter()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+                return response
+            finally:
+                admission.controller.finish(time.perf_counter() - started, status < 500)
+        return admitted_handler
+    return decorator
+
+def with_faults(method, route):
+    """Inject the faults of the route profile, see common/faults.py"""
+    def decorator(handler):
+        async def faulty_handler(request):
+            planned = faults.injector.route(method, route)
+            if planned is not None:
+                delay, fault, profile = planned
+                if delay:
+                    await asyncio.sleep(delay)
+                if fault == faults.ERROR:
+                    return JSONResponse(faults.error_body(profile.error_status), status_code=profile.error_status)
+            return await handler(request)
+        return faulty_handler
+    return decorator
+
+# Order Service Routes
+@timed('/api/order')
+@admitted(admission.NORMAL)
+@with_faults('POST', '/api/order')
+async def api_create_order(request: Request):
+    payload = await request.json()
+    logger.debug('api-gateway received post request')
+    tracer = trace.get_tracer(__name__)
+
+    with tracer.start_as_current_span("request_to_order_service"):
+        logger.debug('api-gateway makes a request to order-service')
+        try:
+            response = await request_order(request.app.state.order_service, 'POST', '/order',
+                headers={"Content-Type": "application/json"},
+                json=payload
+            )
+        except (httpx.HTTPError, http_client.CircuitOpenError) as e:
+            logger.error("Error while calling order service: %s", e)
+            return JSONResponse({"status": "failure", "message": "Error contacting order service"}, status_code=500)
+        if response.status_code != 200:
+            logger.error(response.text)
+
+    return JSONResponse(response.json(), status_code=200)
+
+@timed('/api/order/<int:order_id>')
+@admitted(admission.SHEDDABLE)
+@with_faults('GET', '/api/order/<int:order_id>')
+async def api_get_order(request: Request):
+    order_id = request.path_params['order_id']
+    logger.debug('api-gateway received get request')
+    tracer = trace.get_tracer(__name__)
+
+    with tracer.start_as_current_span("request_to_order_service") as span:
+        span.set_attribute("order.order_id", order_id)
+        # The order-service answers an unchanged order with an empty 304
+        headers = {}
+        if 'if-none-match' in request.headers:
+            headers['If-None-Match'] = request.headers['if-none-match']
+        try:
+            response = await request_order(request.app.state.order_service, 'GET', f'/order/{order_id}',
+                route='/order/<int:order_id>', headers=headers)
+        except (httpx.HTTPError, http_client.CircuitOpenError) as e:
+            logger.error("Error while calling order service: %s", e)
+            return JSONResponse({"status": "failure", "message": "Error contacting order service"}, status_code=500)
+
+    forwarded = {name: response.headers[name] for name in ('Content-Type', 'ETag', 'Cache-Control') if name in response.headers}
+    return Response(response.content, status_code=response.status_code, headers=forwarded)
+
+@timed('/api/orders/batch')
+@admitted(admission.SHEDDABLE)
+@with_faults('POST', '/api/orders/batch')
+async def api_create_orders_batch(request: Request):
+    payload = await request.json()
+    orders = payload.get('orders', [])
+    logger.debug('api-gateway received a batch of %s orders', len(orders))
+    tracer = trace.get_tracer(__name__)
+
+    with tracer.start_as_current_span("request_to_order_service_batch") as span:
+        span.set_attribute("batch.size", len(orders))
+
+        # Every order gets its own span, which the order-service links to
+        for index, order in enumerate(orders):
+            with tracer.start_as_current_span("batch_order") as order_span:
+                order_span.set_attribute("batch.index", index)
+                order['trace_context'] = tracing.item_context()
+
+        logger.debug('api-gateway makes a batch request to order-service')
+        try:
+            response = await request_order(request.app.state.order_service, 'POST', '/order/batch',
+                headers={"Content-Type": "application/json"},
+                json={"orders": orders}
+            )
+        except (httpx.HTTPError, http_client.CircuitOpenError) as e:
+            logger.error("Error while calling order service: %s", e)
+            return JSONResponse({"status": "failure", "message": "Error contacting order service"}, status_code=500)
+        if response.status_code != 200:
+            logger.error(response.text)
+
+    return JSONResponse(response.json(), status_code=response.status_code)
+
+async def telemetry_stats(request: Request):
+    return JSONResponse(telemetry.stats(), status_code=200)
+
+async def resilience_stats(request: Request):
+    return JSONResponse({"order-service": order_policy.stats()}, status_code=200)
+
+async def admission_stats(request: Request):
+    return JSONResponse(admission.controller.stats(), status_code=200)
+
+async def debug_faults(request: Request):
+    body = None
+    if request.method == 'PUT':
+        try:
+            body = await request.json()
+        except ValueError:
+            body = None
+    status, payload = faults.admin(request.method, request.headers.get('x-faults-token'), body)
+    return JSONResponse(payload, status_code=status)
+
+async def debug_profile(request: Request):
+    # Samples the event loop thread from a pool thread for the seconds of the profile
+    status, body = await run_in_threadpool(profiling.debug_profile, request.headers.get('x-profile-token'),
+                                           request.query_params.get('seconds'), request.query_params.get('interval_ms'))
+    if status != 200:
+        return JSONResponse(body, status_code=status)
+    return PlainTextResponse(body, status_code=200)
+
+async def debug_profile_stats(request: Request):
+    return JSONResponse(profiling.profiler.stats(), status_code=200)
+
+async def metrics_endpoint(request: Request):
+    body, content_type = metrics.exposition(request.headers.get('accept'))
+    return Response(body, status_code=200, headers={"Content-Type": content_type})
+
+app = Starlette(
+    routes=[
+        Route('/api/order', api_create_order, methods=['POST']),
+        Route('/api/order/{order_id:int}', api_get_order, methods=['GET']),
+        Route('/api/orders/batch', api_create_orders_batch, methods=['POST']),
+        Route('/debug/telemetry', telemetry_stats, methods=['GET']),
+        Route('/debug/resilience', resilience_stats, methods=['GET']),
+        Route('/debug/admission', admission_stats, methods=['GET']),
+        Route('/debug/faults', debug_faults, methods=['GET', 'PUT', 'DELETE']),
+        Route('/debug/profile', debug_profile, methods=['GET']),
+        Route('/debug/profile/stats', debug_profile_stats, methods=['GET']),
+        Route('/metrics', metrics_endpoint, methods=['GET']),
+    ],
+    lifespan=lifespan,
+)
+
+# Instrument Starlette
+StarletteInstrumentor.instrument_app(app)
@@ -0,0 +1,206 @@
+import os
+import csv
+import sys
+import hmac
+import json
+import time
+import codecs
+import contextlib
+from opentelemetry import trace
+
+# POST /<service>/import requires this token in the X-Import-Token header,
+# and is disabled while it is empty. The CLI command does not need it.
+CATALOG_IMPORT_TOKEN        = os.getenv('CATALOG_IMPORT_TOKEN', '')
+# Rows per executemany, and rows per transaction
+CATALOG_IMPORT_BATCH_SIZE   = os.getenv('CATALOG_IMPORT_BATCH_SIZE', 5000)
+CATALOG_IMPORT_COMMIT_ROWS  = os.getenv('CATALOG_IMPORT_COMMIT_ROWS', 50000)
+
+FORMATS = ('csv', 'jsonl')
+# set: the quantities of the input replace the stored ones
+# add: they are added to the stored ones, e.g. for a delta of received stock
+MODES = ('set', 'add')
+
+class ImportFailed(Exception):
+    """A row of the input could not be imported, the rows committed before stay."""
+
+    def __init__(self, message, line):
+        super().__init__(f"line {line}: {message}")
+        self.line = line
+        self.imported = 0
+
+def read_rows(lines, fmt):
+    """Rows of a CSV file with a header line or of a JSONL file as dicts,
+    with their line number. Reads one line at a time."""
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            raise ImportFailed(f"invalid JSON: {e}", number)
+        if not isinstance(row, dict):
+            raise ImportFailed("every line must be a JSON object", number)
+        yield number, row
+
+def quantity(row, name):
+    """A non-negative integer column of a row."""
+    value = row.get(name)
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        number = -1
+    if number < 0 or isinstance(value, (bool, float)):
+        raise ValueError(f"{name} must be a non-negative integer, got {value!r}")
+    return number
+
+def required(row, name):
+    value = row.get(name)
+    if value is None or str(value).strip() == '':
+        raise ValueError(f"{name} is required")
+    return str(value).strip()
+
+class Importer:
+    """Upserts a stream of rows in batches.
+
+    Every batch_size rows are written with one executemany of the upsert
+    query, and every commit_rows rows are committed, so memory stays bounded
+    by a batch and a failed row only loses the rows of its transaction.
+    Upserts that would not change a row do not count as changed, the queries
+    skip them, so a delta import of a few changed rows writes only those.
+    """
+
+    def __init__(self, db, parse_row, query, batch_size=None, commit_rows=None, progress=None):
+        self.db = db
+        self.parse_row = parse_row
+        self.query = query
+        self.batch_size = int(CATALOG_IMPORT_BATCH_SIZE if batch_size is None else batch_size)
+        self.commit_rows = max(self.batch_size, int(CATALOG_IMPORT_COMMIT_ROWS if commit_rows is None else commit_rows))
+        self.progress = progress
+        self.rows = 0
+        self.changed = 0
+        self.committed = 0
+        self.started = None
+
+    def _write(self, batch):
+        self.changed += self.db.session.execute(self.query, batch).rowcount
+        self.rows += len(batch)
+
+    def _commit(self):
+        self.db.session.commit()
+        self.committed = self.rows
+        if self.progress is not None:
+            self.progress(self.summary())
+
+    def run(self, rows):
+        self.started = time.perf_counter()
+        batch = []
+        try:
+            for line, row in rows:
+                try:
+                    batch.append(self.parse_row(row))
+                except ValueError as e:
+                    raise ImportFailed(str(e), line)
+                if len(batch) >= self.batch_size:
+                    self._write(batch)
+                    batch = []
+                    if self.rows - self.committed >= self.commit_rows:
+                        self._commit()
+            if batch:
+                self._write(batch)
+            if self.rows > self.committed or not self.rows:
+                self._commit()
+        except ImportFailed as e:
+            self.db.session.rollback()
+            e.imported = self.committed
+            raise
+        except Exception:
+            self.db.session.rollback()
+            raise
+        return self.summary()
+
+    def summary(self):
+        seconds = time.perf_counter() - self.started
+        return {
+            "rows": self.rows,
+            "changed": self.changed,
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(self.rows / seconds, 1) if seconds > 0 else 0.0,
+        }
+
+def init_app(app, db, name, parse_row, queries):
+    """Import rows into the catalog of a service, streamed from CSV or JSONL
+    input, with POST /<name>/import and the `flask import-catalog` command.
+
+    parse_row turns a row of the input into the parameters of the queries,
+    or raises ValueError, queries has the upsert query of every mode.
+    """
+    import click
+    from flask import jsonify, request
+
+    def parse_options(fmt, mode):
+        if fmt not in FORMATS:
+            raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {', '.join(MODES)}")
+
+    @app.route(f'/{name}/import', methods=['POST'])
+    def import_catalog():
+        token = request.headers.get('X-Import-Token', '')
+        if not CATALOG_IMPORT_TOKEN:
+            return jsonify({"status": "failure", "message": "Imports are disabled, set CATALOG_IMPORT_TOKEN"}), 404
+        if not hmac.compare_digest(token.encode(), CATALOG_IMPORT_TOKEN.encode()):
+            return jsonify({"status": "failure", "message": "Invalid import token"}), 403
+        content_type = request.mimetype or ''
+        fmt = request.args.get('format', 'csv' if 'csv' in content_type else 'jsonl')
+        mode = request.args.get('mode', 'set')
+        try:
+            parse_options(fmt, mode)
+        except ValueError as e:
+            return jsonify({"status": "failure", "message": str(e)}), 400
+
+        def progress(summary):
+            app.logger.info('%s import: %s rows, %s rows/s', name, summary['rows'], summary['rows_per_second'])
+
+        # The body is read a line at a time, never as a whole
+        lines = codecs.iterdecode(request.stream, request.mimetype_params.get('charset', 'utf-8'))
+        importer = Importer(db, parse_row, queries[mode], progress=progress)
+        try:
+            summary = importer.run(read_rows(lines, fmt))
+        except ImportFailed as e:
+            return jsonify({"status": "failure", "message": str(e), "rows_committed": e.imported}), 400
+        span = trace.get_current_span()
+        span.set_attribute("catalog.import.rows", summary['rows'])
+        span.set_attribute("catalog.import.changed", summary['changed'])
+        return jsonify(dict(summary, status="success", mode=mode)), 200
+
+    @app.cli.command('import-catalog')
+    @click.argument('path')
+    @click.option('--format', 'fmt', type=click.Choice(FORMATS), help='Input format, by default from the file name.')
+    @click.option('--mode', type=click.Choice(MODES), default='set', show_default=True)
+    @click.option('--batch-size', type=int, help='Rows per executemany.')
+    @click.option('--commit-rows', type=int, help='Rows per transaction.')
+    def import_catalog_command(path, fmt, mode, batch_size, commit_rows):
+        """Import a CSV or JSONL file, or - for standard input, into the catalog."""
+        fmt = fmt or ('csv' if path.endswith('.csv') else 'jsonl')
+
+        def progress(summary):
+            click.echo(f"{summary['rows']:,} rows, {summary['changed']:,} changed, "
+                       f"{summary['rows_per_second']:,.0f} rows/s", err=True)
+
+        if path == '-':
+            source = contextlib.nullcontext(sys.stdin)
+        else:
+            source = open(path, encoding='utf-8', newline='')
+        with source as lines:
+            importer = Importer(db, parse_row, queries[mode], batch_size, commit_rows, progress)
+            try:
+                summary = importer.run(read_rows(lines, fmt))
+            except ImportFailed as e:
+                raise click.ClickException(f"{e}, {e.imported:,} rows were committed before")
+        click.echo(f"imported {summary['rows']:,} rows into {name} in {summary['seconds']}s "
+                   f"({summary['rows_per_second']:,.0f} rows/s), {summary['changed']:,} changed")
@@ -0,0 +1,45 @@
+import os
+from sqlalchemy import event
+
+SQLITE_BUSY_TIMEOUT_MS = os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000)
+SQLITE_SYNCHRONOUS     = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+
+def sqlite_engine_options():
+    """Engine options for a SQLite database shared by many request threads."""
+    return {
+        "connect_args": {
+            "timeout": int(SQLITE_BUSY_TIMEOUT_MS) / 1000.0,
+            "check_same_thread": False,
+        },
+    }
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # WAL lets readers run alongside the single writer, the busy timeout makes
+    # concurrent writers wait for the lock instead of failing with "database is locked"
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT_MS)}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.close()
+
+def _disable_pysqlite_begin(dbapi_connection, connection_record):
+    # Let SQLAlchemy emit BEGIN itself instead of the pysqlite driver
+    dbapi_connection.isolation_level = None
+
+def _begin_immediate(connection):
+    connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+def enable_sqlite_wal(app, db, begin_immediate=False):
+    """Configure the SQLite engine of db for concurrent workers.
+
+    With begin_immediate every transaction takes the write lock up front, so a
+    transaction that reads stock levels and then updates them can not fail on
+    a snapshot that another writer has changed in the meantime.
+    """
+    with app.app_context():
+        if db.engine.dialect.name != 'sqlite':
+            return
+        event.listen(db.engine, 'connect', _set_sqlite_pragmas)
+        if begin_immediate:
+            event.listen(db.engine, 'connect', _disable_pysqlite_begin)
+            event.listen(db.engine, 'begin', _begin_immediate)
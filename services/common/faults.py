@@ -0,0 +1,315 @@
+import os
+import json
+import time
+import hmac
+import random
+import threading
+from opentelemetry import trace
+
+# Fault profiles as JSON: {"routes": {<route>: <profile>}, "downstreams": {<downstream>: <profile>}}
+FAULT_PROFILES       = os.getenv('FAULT_PROFILES', '')
+# The workers of a server share the profiles through this file, which
+# PUT /debug/faults writes, see common/gunicorn_conf.py
+FAULT_PROFILES_FILE  = os.getenv('FAULT_PROFILES_FILE', '')
+FAULTS_RELOAD_INTERVAL_MS = os.getenv('FAULTS_RELOAD_INTERVAL_MS', 1000)
+# PUT and DELETE /debug/faults require this token in the X-Faults-Token
+# header, and are disabled while it is empty
+FAULTS_TOKEN         = os.getenv('FAULTS_TOKEN', '')
+# Seed of the random draws, to replay the same faults
+FAULTS_SEED          = os.getenv('FAULTS_SEED', '')
+
+# Parameters of each latency distribution, in milliseconds but sigma and alpha
+DISTRIBUTIONS = {
+    'fixed': ('ms',),
+    'uniform': ('min_ms', 'max_ms'),
+    'normal': ('mean_ms', 'stddev_ms'),
+    'lognormal': ('median_ms', 'sigma'),
+    'pareto': ('scale_ms', 'alpha'),
+}
+
+ERROR = 'error'
+RESET = 'reset'
+
+class InvalidProfile(ValueError):
+    pass
+
+def _rate(value, name):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0.0 <= value <= 1.0:
+        raise InvalidProfile(f"{name} must be a number within 0 and 1")
+    return float(value)
+
+class Latency:
+    """Delays drawn from a distribution, applied to a share of the calls and capped at max_ms."""
+
+    def __init__(self, spec):
+        if not isinstance(spec, dict):
+            raise InvalidProfile("latency must be an object")
+        self.distribution = spec.get('distribution', 'fixed')
+        if self.distribution not in DISTRIBUTIONS:
+            raise InvalidProfile(f"distribution must be one of {', '.join(DISTRIBUTIONS)}")
+        self.params = {}
+        for name in DISTRIBUTIONS[self.distribution]:
+            value = spec.get(name, 0.0 if name == 'min_ms' else None)
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                raise InvalidProfile(f"{self.distribution} latency needs a non-negative {name}")
+            self.params[name] = float(value)
+        if self.distribution == 'pareto' and self.params['alpha'] <= 0:
+            raise InvalidProfile("pareto latency needs an alpha above 0")
+        self.max_ms = spec.get('max_ms')
+        if self.max_ms is not None and (isinstance(self.max_ms, bool) or not isinstance(self.max_ms, (int, float)) or self.max_ms < 0):
+            raise InvalidProfile("max_ms must be a non-negative number")
+        self.rate = _rate(spec.get('rate', 1.0), 'rate')
+        self.spec = spec
+
+    def draw(self, rng):
+        """A delay in seconds."""
+        if self.rate < 1.0 and rng.random() >= self.rate:
+            return 0.0
+        p = self.params
+        if self.distribution == 'fixed':
+            ms = p['ms']
+        elif self.distribution == 'uniform':
+            ms = rng.uniform(p['min_ms'], p['max_ms'])
+        elif self.distribution == 'normal':
+            ms = rng.gauss(p['mean_ms'], p['stddev_ms'])
+        elif self.distribution == 'lognormal':
+            ms = p['median_ms'] * rng.lognormvariate(0.0, p['sigma'])
+        else:
+            ms = p['scale_ms'] * rng.paretovariate(p['alpha'])
+        if self.max_ms is not None:
+            ms = min(ms, self.max_ms)
+        return max(0.0, ms) / 1000.0
+
+class Profile:
+    """Latency, errors and connection resets injected into the calls of a
+    route or to a downstream.
+
+    A call is first delayed, then fails with error_status at error_rate,
+    or, for downstreams, has its connection reset at reset_rate.
+    """
+
+    KEYS = ('latency', 'error_rate', 'error_status', 'reset_rate')
+
+    def __init__(self, spec, resets=True):
+        if not isinstance(spec, dict):
+            raise InvalidProfile("a profile must be an object")
+        unknown = set(spec) - set(self.KEYS)
+        if unknown:
+            raise InvalidProfile(f"unknown profile keys: {', '.join(sorted(unknown))}")
+        self.latency = Latency(spec['latency']) if spec.get('latency') is not None else None
+        self.error_rate = _rate(spec.get('error_rate', 0.0), 'error_rate')
+        self.error_status = spec.get('error_status', 503)
+        if not isinstance(self.error_status, int) or not 400 <= self.error_status <= 599:
+            raise InvalidProfile("error_status must be an HTTP error status")
+        self.reset_rate = _rate(spec.get('reset_rate', 0.0), 'reset_rate')
+        if self.reset_rate and not resets:
+            # A server can not reset the connection of a request it is answering
+            raise InvalidProfile("connection resets are injected on downstreams, not on routes")
+        self.spec = spec
+
+    def plan(self, rng):
+        """The delay in seconds and the fault of one call, ERROR, RESET or None."""
+        delay = self.latency.draw(rng) if self.latency is not None else 0.0
+        draw = rng.random()
+        if draw < self.reset_rate:
+            return delay, RESET
+        if draw < self.reset_rate + self.error_rate:
+            return delay, ERROR
+        return delay, None
+
+def parse(config):
+    """Routes and downstreams with their profiles, raises InvalidProfile."""
+    if not isinstance(config, dict):
+        raise InvalidProfile("the fault profiles must be an object")
+    unknown = set(config) - {'routes', 'downstreams'}
+    if unknown:
+        raise InvalidProfile(f"unknown keys: {', '.join(sorted(unknown))}, use routes and downstreams")
+    parsed = {}
+    for kind in ('routes', 'downstreams'):
+        entries = config.get(kind) or {}
+        if not isinstance(entries, dict):
+            raise InvalidProfile(f"{kind} must be an object")
+        profiles = {}
+        for key, spec in entries.items():
+            try:
+                profiles[key] = Profile(spec, resets=kind == 'downstreams')
+            except InvalidProfile as e:
+                raise InvalidProfile(f"{kind}.{key}: {e}")
+        parsed[kind] = profiles
+    return parsed
+
+class FaultInjector:
+    """Holds the fault profiles of this process.
+
+    A route profile is found by "<METHOD> <rule>", then "<rule>", then "*",
+    a downstream profile by "<downstream> <path>", then "<downstream>",
+    then "*". With a path set, the profiles are read from that file when it
+    changes, at most every reload interval, so one update reaches every
+    worker of a server.
+    """
+
+    def __init__(self, config=None, path=None, reload_interval_ms=None, seed=None):
+        self.path = path or None
+        self.reload_interval = float(FAULTS_RELOAD_INTERVAL_MS if reload_interval_ms is None else reload_interval_ms) / 1000.0
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.config = {"routes": {}, "downstreams": {}}
+        self.profiles = parse(self.config)
+        self.loaded_mtime = None
+        self.checked = 0.0
+        self.counts = {}
+        if config:
+            self.apply(config)
+
+    def apply(self, config):
+        profiles = parse(config)
+        with self.lock:
+            self.config = {"routes": dict(config.get('routes') or {}), "downstreams": dict(config.get('downstreams') or {})}
+            self.profiles = profiles
+
+    def setdefault(self, kind, key, spec):
+        """Add a profile for key unless one is configured."""
+        config = {name: dict(entries) for name, entries in self.config.items()}
+        config[kind].setdefault(key, spec)
+        self.apply(config)
+
+    def update(self, config):
+        """Replace the profiles, in every worker when they share a file."""
+        parse(config)
+        if self.path is not None:
+            # Written beside the final file and renamed, a worker never reads half of it
+            temporary = f'{self.path}.{os.getpid()}.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(config, f)
+            os.replace(temporary, self.path)
+        self.apply(config)
+        if self.path is not None:
+            self.loaded_mtime = os.stat(self.path).st_mtime_ns
+
+    def _reload(self):
+        now = time.monotonic()
+        if self.path is None or now - self.checked < self.reload_interval:
+            return
+        self.checked = now
+        mtime = None
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self.loaded_mtime:
+                return
+            with open(self.path) as f:
+                config = json.load(f)
+            self.apply(config)
+            self.loaded_mtime = mtime
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            # Keep the profiles that work, the file is fixed by the next update
+            self.loaded_mtime = mtime
+            trace.get_current_span().set_attribute("fault.reload_error", str(e))
+
+    def _find(self, kind, keys):
+        self._reload()
+        profiles = self.profiles[kind]
+        if not profiles:
+            return None, None
+        for key in keys:
+            profile = profiles.get(key)
+            if profile is not None:
+                return key, profile
+        return None, None
+
+    def plan(self, kind, keys):
+        """The delay in seconds, the fault and the profile of a call, or
+        None when no profile applies. Recorded on the current span."""
+        key, profile = self._find(kind, keys)
+        if profile is None:
+            return None
+        delay, fault = profile.plan(self.rng)
+        with self.lock:
+            counts = self.counts.setdefault(f"{kind}:{key}", {"calls": 0, "delay_seconds": 0.0, ERROR: 0, RESET: 0})
+            counts["calls"] += 1
+            counts["delay_seconds"] += delay
+            if fault is not None:
+                counts[fault] += 1
+        span = trace.get_current_span()
+        span.set_attribute("fault.profile", f"{kind}:{key}")
+        if delay:
+            span.set_attribute("fault.delay_ms", round(delay * 1000.0, 3))
+        if fault is not None:
+            span.set_attribute("fault.injected", fault)
+        return delay, fault, profile
+
+    def route(self, method, rule):
+        return self.plan('routes', (f"{method} {rule}", rule, '*'))
+
+    def downstream(self, name, path):
+        return self.plan('downstreams', (f"{name} {path}", name, '*'))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "profiles": self.config,
+                "shared_file": self.path,
+                "injected": {key: dict(counts, delay_seconds=round(counts["delay_seconds"], 6)) for key, counts in self.counts.items()},
+            }
+
+def _initial_config():
+    if not FAULT_PROFILES:
+        return None
+    try:
+        return json.loads(FAULT_PROFILES)
+    except ValueError as e:
+        raise InvalidProfile(f"FAULT_PROFILES is not valid JSON: {e}")
+
+injector = FaultInjector(_initial_config(), FAULT_PROFILES_FILE, seed=FAULTS_SEED or None)
+
+def is_true(value):
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+def error_body(status):
+    return {"status": "failure", "message": f"Injected fault, status {status}"}
+
+def authorize(token):
+    """None when the admin token is right, otherwise the status and message to answer."""
+    if not FAULTS_TOKEN:
+        return 404, "Fault injection updates are disabled, set FAULTS_TOKEN"
+    if not hmac.compare_digest((token or '').encode(), FAULTS_TOKEN.encode()):
+        return 403, "Invalid faults token"
+    return None
+
+def admin(method, token, body):
+    """Status and body of GET, PUT and DELETE /debug/faults."""
+    if method != 'GET':
+        denied = authorize(token)
+        if denied is not None:
+            return denied[0], {"status": "failure", "message": denied[1]}
+        try:
+            injector.update(body if method == 'PUT' else {"routes": {}, "downstreams": {}})
+        except InvalidProfile as e:
+            return 400, {"status": "failure", "message": str(e)}
+    return 200, injector.stats()
+
+def init_app(app):
+    """Inject the faults of the route profiles into the requests of a Flask
+    service, and manage the profiles at /debug/faults."""
+    from flask import jsonify, request
+
+    @app.before_request
+    def inject_route_fault():
+        if request.url_rule is None or request.path.startswith('/debug/faults'):
+            return None
+        planned = injector.route(request.method, request.url_rule.rule)
+        if planned is None:
+            return None
+        delay, fault, profile = planned
+        if delay:
+            time.sleep(delay)
+        if fault == ERROR:
+            return jsonify(error_body(profile.error_status)), profile.error_status
+        return None
+
+    @app.route('/debug/faults', methods=['GET', 'PUT', 'DELETE'])
+    def debug_faults():
+        body = request.get_json(silent=True) if request.method == 'PUT' else None
+        status, payload = admin(request.method, request.headers.get('X-Faults-Token'), body)
+        return jsonify(payload), status
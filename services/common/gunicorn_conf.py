@@ -0,0 +1,83 @@
+"""Production server settings shared by the Flask services.
+
+    gunicorn -c common/gunicorn_conf.py app:app
+
+The app is loaded once in the master, which runs the init_db() of the
+service (schema and seed data) before the workers are forked. Tracing is
+started in each worker after fork, so every worker has its own export
+thread. When a worker exits its write-behind buffers are flushed, then the
+spans still queued are exported.
+The workers write their metrics to a shared directory, so a scrape of
+/metrics returns the counts of the whole server, and read the fault
+profiles set at runtime from a shared file. Every live worker has its own
+slot, WEB_WORKER_SLOT, e.g. for the worker bits of the order ids.
+"""
+import os
+import sys
+import tempfile
+import multiprocessing
+
+# gunicorn does not put the working directory on the path before loading the config
+sys.path.insert(0, os.getcwd())
+
+from common import faults, metrics, telemetry
+
+WEB_PORT             = os.getenv('WEB_PORT', 5000)
+WEB_WORKERS          = os.getenv('WEB_WORKERS', multiprocessing.cpu_count())
+WEB_THREADS          = os.getenv('WEB_THREADS', 8)
+WEB_TIMEOUT          = os.getenv('WEB_TIMEOUT', 30)
+WEB_GRACEFUL_TIMEOUT = os.getenv('WEB_GRACEFUL_TIMEOUT', 20)
+WEB_KEEPALIVE        = os.getenv('WEB_KEEPALIVE', 5)
+
+bind = f"0.0.0.0:{WEB_PORT}"
+workers = int(WEB_WORKERS)
+threads = int(WEB_THREADS)
+worker_class = 'gthread'
+timeout = int(WEB_TIMEOUT)
+graceful_timeout = int(WEB_GRACEFUL_TIMEOUT)
+keepalive = int(WEB_KEEPALIVE)
+preload_app = True
+accesslog = '-'
+
+# The app module only records its service name while it is preloaded
+telemetry.defer_tracing = True
+
+# The workers share their metrics through snapshot files, see common/metrics.py
+metrics_directory = metrics.METRICS_DIR or tempfile.mkdtemp(prefix='metrics-')
+
+# The workers share the fault profiles set at runtime through a file, see common/faults.py
+faults_file = faults.FAULT_PROFILES_FILE or os.path.join(tempfile.mkdtemp(prefix='faults-'), 'faults.json')
+
+def _service_module(server):
+    return sys.modules[server.app.app_uri.split(':')[0]]
+
+def on_starting(server):
+    service = _service_module(server)
+    if hasattr(service, 'init_db'):
+        service.init_db()
+        # Connections opened by the master must not be shared with the workers
+        with service.app.app_context():
+            service.db.engine.dispose()
+
+# Worker slots, a restarted worker takes the slot of the one it replaces
+MAX_WORKER_SLOTS = 128
+
+def pre_fork(server, worker):
+    used = {getattr(other, 'slot', None) for other in server.WORKERS.values()}
+    free = [slot for slot in range(MAX_WORKER_SLOTS) if slot not in used]
+    if not free:
+        raise RuntimeError(f"no free worker slot, at most {MAX_WORKER_SLOTS} workers are supported")
+    worker.slot = free[0]
+
+def post_fork(server, worker):
+    os.environ['WEB_WORKER_SLOT'] = str(worker.slot)
+    telemetry.init_deferred_tracing()
+    # Queries of the master, e.g. by init_db(), would be counted by every worker
+    metrics.reset()
+    metrics.directory = metrics_directory
+    faults.injector.path = faults_file
+
+def worker_exit(server, worker):
+    # Flushes the write-behind buffers first, their spans are still exported
+    telemetry.shutdown()
+    metrics.write_snapshot()
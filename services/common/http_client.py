@@ -0,0 +1,368 @@
+import os
+import json
+import time
+import errno
+import threading
+import contextvars
+import requests
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import EmptyPoolError, NewConnectionError
+from opentelemetry import trace
+from common import faults, metrics, resilience
+
+# Defaults for every downstream, each one can be overridden per downstream
+# with the upper-cased service name as prefix, e.g. FRAUD_SERVICE_POOL_MAXSIZE
+HTTP_POOL_MAXSIZE     = os.getenv('HTTP_POOL_MAXSIZE', 20)
+HTTP_POOL_BLOCK       = os.getenv('HTTP_POOL_BLOCK', 'true')
+HTTP_POOL_TIMEOUT     = os.getenv('HTTP_POOL_TIMEOUT', 5.0)
+HTTP_CONNECT_TIMEOUT  = os.getenv('HTTP_CONNECT_TIMEOUT', 1.0)
+HTTP_READ_TIMEOUT     = os.getenv('HTTP_READ_TIMEOUT', 10.0)
+# Total time for a call including its retries, see common/resilience.py
+HTTP_DEADLINE               = os.getenv('HTTP_DEADLINE', 15.0)
+HTTP_RETRY_ATTEMPTS         = os.getenv('HTTP_RETRY_ATTEMPTS', 3)
+HTTP_RETRY_BACKOFF          = os.getenv('HTTP_RETRY_BACKOFF', 0.05)
+HTTP_RETRY_BACKOFF_MAX      = os.getenv('HTTP_RETRY_BACKOFF_MAX', 1.0)
+HTTP_RETRY_BUDGET_RATIO     = os.getenv('HTTP_RETRY_BUDGET_RATIO', 0.2)
+HTTP_RETRY_BUDGET_MIN       = os.getenv('HTTP_RETRY_BUDGET_MIN', 10)
+HTTP_BREAKER_FAILURES       = os.getenv('HTTP_BREAKER_FAILURES', 5)
+HTTP_BREAKER_RESET_TIMEOUT  = os.getenv('HTTP_BREAKER_RESET_TIMEOUT', 5.0)
+HTTP_HEDGE                  = os.getenv('HTTP_HEDGE', 'false')
+HTTP_HEDGE_PERCENTILE       = os.getenv('HTTP_HEDGE_PERCENTILE', 95)
+HTTP_HEDGE_MIN_DELAY        = os.getenv('HTTP_HEDGE_MIN_DELAY', 0.01)
+
+# Gateway errors that are retried when the call is idempotent
+RETRY_STATUSES = (502, 503, 504)
+
+def _env_prefix(name):
+    return name.upper().replace('-', '_') + '_'
+
+def _setting(name, key, default):
+    return os.getenv(_env_prefix(name) + key, default)
+
+def _is_true(value):
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+def settings_for(name):
+    """Resolve pool size and timeouts for a downstream from the environment."""
+    return {
+        "pool_maxsize": int(_setting(name, 'POOL_MAXSIZE', HTTP_POOL_MAXSIZE)),
+        "pool_block": _is_true(_setting(name, 'POOL_BLOCK', HTTP_POOL_BLOCK)),
+        "pool_timeout": float(_setting(name, 'POOL_TIMEOUT', HTTP_POOL_TIMEOUT)),
+        "connect_timeout": float(_setting(name, 'CONNECT_TIMEOUT', HTTP_CONNECT_TIMEOUT)),
+        "read_timeout": float(_setting(name, 'READ_TIMEOUT', HTTP_READ_TIMEOUT)),
+    }
+
+def policy_settings(name):
+    """Resolve deadline, retry, breaker and hedge settings for a downstream."""
+    return {
+        "deadline": float(_setting(name, 'DEADLINE', HTTP_DEADLINE)),
+        "retry_attempts": int(_setting(name, 'RETRY_ATTEMPTS', HTTP_RETRY_ATTEMPTS)),
+        "retry_backoff": float(_setting(name, 'RETRY_BACKOFF', HTTP_RETRY_BACKOFF)),
+        "retry_backoff_max": float(_setting(name, 'RETRY_BACKOFF_MAX', HTTP_RETRY_BACKOFF_MAX)),
+        "retry_budget_ratio": float(_setting(name, 'RETRY_BUDGET_RATIO', HTTP_RETRY_BUDGET_RATIO)),
+        "retry_budget_min": float(_setting(name, 'RETRY_BUDGET_MIN', HTTP_RETRY_BUDGET_MIN)),
+        "breaker_failures": int(_setting(name, 'BREAKER_FAILURES', HTTP_BREAKER_FAILURES)),
+        "breaker_reset_timeout": float(_setting(name, 'BREAKER_RESET_TIMEOUT', HTTP_BREAKER_RESET_TIMEOUT)),
+        "hedge": _is_true(_setting(name, 'HEDGE', HTTP_HEDGE)),
+        "hedge_percentile": float(_setting(name, 'HEDGE_PERCENTILE', HTTP_HEDGE_PERCENTILE)),
+        "hedge_min_delay": float(_setting(name, 'HEDGE_MIN_DELAY', HTTP_HEDGE_MIN_DELAY)),
+    }
+
+def policy(name):
+    return resilience.Policy(name, **policy_settings(name))
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """The circuit breaker of the downstream is open, nothing was sent."""
+
+class PoolExhaustedError(requests.exceptions.ConnectionError):
+    """No pooled connection became free within the pool timeout."""
+
+def not_sent(error):
+    """Whether the request never reached the downstream, so any call can be retried."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+
+def within_deadline(timeout, remaining):
+    """Shorten the read timeout so that no attempt outlives the deadline of the call."""
+    connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    return (connect_timeout, max(0.001, min(read_timeout, remaining)))
+
+def retryable(error, idempotent):
+    # Retrying would only add load to a saturated pool or an open breaker
+    if isinstance(error, (CircuitOpenError, PoolExhaustedError)):
+        return False
+    if not_sent(error):
+        return True
+    return idempotent and isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+class PoolStats:
+    """Connection pool counters for a single downstream."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hits = 0
+        self.misses = 0
+        self.exhausted = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def record_checkout(self, wait_seconds, reused):
+        with self._lock:
+            self.requests += 1
+            if reused:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.wait_seconds_total += wait_seconds
+            if wait_seconds > self.wait_seconds_max:
+                self.wait_seconds_max = wait_seconds
+
+    def record_exhausted(self):
+        with self._lock:
+            self.exhausted += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hits": self.hits,
+                "misses": self.misses,
+                "exhausted": self.exhausted,
+                "wait_seconds_total": round(self.wait_seconds_total, 6),
+                "wait_seconds_max": round(self.wait_seconds_max, 6),
+            }
+
+def _instrumented_pool(base, stats, pool_timeout):
+    class InstrumentedPool(base):
+        def _get_conn(self, timeout=None):
+            if timeout is None:
+                timeout = pool_timeout
+            start = time.perf_counter()
+            try:
+                conn = super()._get_conn(timeout=timeout)
+            except EmptyPoolError:
+                stats.record_exhausted()
+                raise
+            # A pooled keep-alive connection still holds its socket, a fresh
+            # or reset one connects on first use
+            stats.record_checkout(time.perf_counter() - start, getattr(conn, 'sock', None) is not None)
+            return conn
+
+    InstrumentedPool.__name__ = 'Instrumented' + base.__name__
+    return InstrumentedPool
+
+class InstrumentedAdapter(HTTPAdapter):
+    def __init__(self, stats, pool_timeout, **kwargs):
+        self.stats = stats
+        self.pool_timeout = pool_timeout
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _instrumented_pool(HTTPConnectionPool, self.stats, self.pool_timeout),
+            "https": _instrumented_pool(HTTPSConnectionPool, self.stats, self.pool_timeout),
+        }
+
+class DownstreamClient:
+    """Keep-alive session for one downstream service with a bounded connection pool.
+
+    Calls go through the resilience policy of the downstream: they fail fast
+    while its circuit breaker is open, are retried with jittered backoff
+    within the retry budget and the deadline, and idempotent calls can be
+    hedged. Calls are idempotent when they are GETs, carry an
+    Idempotency-Key header or pass idempotent=True; other calls are only
+    retried when the connection could not be established.
+    """
+
+    def __init__(self, name, base_url, pool_maxsize, pool_block, pool_timeout,
+                 connect_timeout, read_timeout, policy=None):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.stats = PoolStats()
+        self.policy = policy
+        # Threads start on first use, so they are created after a fork
+        self.hedge_pool = None
+        if policy is not None and policy.hedge:
+            self.hedge_pool = ThreadPoolExecutor(max_workers=pool_maxsize, thread_name_prefix=f'{name}-hedge')
+        self.session = requests.Session()
+        adapter = InstrumentedAdapter(
+            self.stats,
+            pool_timeout,
+            pool_connections=1,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+            max_retries=0,
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url(self, path):
+        return f"{self.base_url}{path}"
+
+    def send(self, method, path, route=None, **kwargs):
+        """route is the path template recorded in the metrics, e.g. for paths with ids."""
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            response = self.inject_fault(path, route or path, kwargs.get('timeout'))
+            if response is None:
+                response = self.session.request(method, self.url(path), **kwargs)
+            status = response.status_code
+            return response
+        except EmptyPoolError as e:
+            raise PoolExhaustedError(f"{self.name} connection pool exhausted: {e}")
+        finally:
+            metrics.observe_downstream(self.name, method, route or path, status, time.perf_counter() - started)
+
+    def inject_fault(self, path, route, timeout):
+        """Delay the call by the fault profile of the downstream, and fail
+        it or reset its connection, see common/faults.py. Returns the
+        injected error response, or None to send the call."""
+        planned = faults.injector.downstream(self.name, route)
+        if planned is None:
+            return None
+        delay, fault, profile = planned
+        read_timeout = timeout[1] if isinstance(timeout, tuple) else timeout
+        if read_timeout is not None and delay >= read_timeout:
+            # A downstream this slow times the call out, like a slow server would
+            time.sleep(read_timeout)
+            raise requests.exceptions.ReadTimeout(f"injected delay of {self.name} exceeded the read timeout")
+        time.sleep(delay)
+        if fault == faults.RESET:
+            raise requests.exceptions.ConnectionError(
+                ConnectionResetError(errno.ECONNRESET, f"connection to {self.name} reset by an injected fault"))
+        if fault == faults.ERROR:
+            response = requests.Response()
+            response.status_code = profile.error_status
+            response.reason = 'Injected Fault'
+            response.url = self.url(path)
+            response.headers['Content-Type'] = 'application/json'
+            response._content = json.dumps(faults.error_body(profile.error_status)).encode()
+            return response
+        return None
+
+    def request(self, method, path, idempotent=None, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if kwargs['timeout'] is None:
+            raise ValueError(f"calls to {self.name} require a timeout")
+        if self.policy is None:
+            return self.send(method, path, **kwargs)
+        if idempotent is None:
+            idempotent = method in ('GET', 'HEAD') or 'Idempotency-Key' in (kwargs.get('headers') or {})
+
+        span = trace.get_current_span()
+        started = self.policy.start()
+        attempt = 0
+        try:
+            while True:
+                attempt += 1
+                if not self.policy.admit():
+                    raise CircuitOpenError(f"circuit breaker of {self.name} is open")
+                kwargs['timeout'] = within_deadline(kwargs['timeout'], self.policy.remaining(started))
+                try:
+                    response = self.attempt(method, path, idempotent, span, **kwargs)
+                except requests.exceptions.RequestException as e:
+                    if not retryable(e, idempotent):
+                        raise
+                    delay = self.policy.retry_delay(attempt, started)
+                    if delay is None:
+                        raise
+                else:
+                    if not (idempotent and response.status_code in RETRY_STATUSES):
+                        return response
+                    delay = self.policy.retry_delay(attempt, started)
+                    if delay is None:
+                        return response
+                time.sleep(delay)
+        finally:
+            span.set_attribute("resilience.downstream", self.name)
+            span.set_attribute("resilience.attempts", attempt)
+            span.set_attribute("resilience.circuit_state", self.policy.breaker.state)
+
+    def attempt(self, method, path, idempotent, span, **kwargs):
+        """Send one attempt, and a hedged copy when it is slower than usual."""
+        hedge_delay = self.policy.hedge_delay() if idempotent and self.hedge_pool is not None else None
+        if hedge_delay is None:
+            return self.timed_send(method, path, **kwargs)
+
+        # Both requests run in the pool with the current span as parent
+        first = self.hedge_pool.submit(contextvars.copy_context().run, self.timed_send, method, path, **kwargs)
+        done, _ = wait([first], timeout=hedge_delay)
+        if done or not self.policy.allow_hedge():
+            return first.result()
+        span.set_attribute("resilience.hedged", True)
+        second = self.hedge_pool.submit(contextvars.copy_context().run, self.timed_send, method, path, **kwargs)
+        pending = {first, second}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            # An idempotency key answers the copy of a call that is still in
+            # progress with 409, the other request has the real answer then
+            winner = next((
+                future for future in done
+                if future.exception() is None and (future.result().status_code != 409 or not pending)
+            ), None)
+            if winner is not None or not pending:
+                winner = winner or done.pop()
+                if winner is second:
+                    self.policy.count("hedge_wins")
+                    span.set_attribute("resilience.hedge_won", True)
+                return winner.result()
+
+    def timed_send(self, method, path, **kwargs):
+        sent = time.monotonic()
+        try:
+            response = self.send(method, path, **kwargs)
+        except requests.exceptions.RequestException:
+            self.policy.record(False)
+            raise
+        ok = response.status_code < 500
+        self.policy.record(ok, time.monotonic() - sent if ok else None)
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def client(name, base_url):
+    """Return the shared client for a downstream, creating it on first use."""
+    existing = _clients.get(name)
+    if existing is not None:
+        return existing
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = DownstreamClient(name, base_url, policy=policy(name), **settings_for(name))
+        return _clients[name]
+
+def pool_stats():
+    return {name: c.stats.snapshot() for name, c in list(_clients.items())}
+
+def resilience_stats():
+    return {name: c.policy.stats() for name, c in list(_clients.items()) if c.policy is not None}
+
+def init_app(app):
+    """Expose the pool counters of this service at GET /debug/http-pools and
+    the retry, breaker and hedge counters at GET /debug/resilience."""
+    from flask import jsonify
+
+    @app.route('/debug/http-pools', methods=['GET'])
+    def http_pool_stats():
+        return jsonify(pool_stats()), 200
+
+    @app.route('/debug/resilience', methods=['GET'])
+    def http_resilience_stats():
+        return jsonify(resilience_stats()), 200
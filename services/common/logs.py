@@ -0,0 +1,126 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from opentelemetry import trace
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+# json for Loki, text for reading logs in a terminal
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+# Records wait here for the listener thread, records that do not fit are dropped
+LOG_QUEUE_SIZE = os.getenv('LOG_QUEUE_SIZE', 10000)
+
+# Attributes every LogRecord has, anything else was passed with extra=
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class TraceContextFilter(logging.Filter):
+    """Adds the trace and span id of the current span to every record.
+
+    Runs in the thread that logs, where the span is current.
+    """
+
+    def __init__(self, service_name):
+        super().__init__()
+        self.service_name = service_name
+
+    def filter(self, record):
+        span_context = trace.get_current_span().get_span_context()
+        if span_context.is_valid:
+            record.trace_id = format(span_context.trace_id, '032x')
+            record.span_id = format(span_context.span_id, '016x')
+        else:
+            record.trace_id = None
+            record.span_id = None
+        record.service = self.service_name
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, extra= fields are added as keys."""
+
+    def format(self, record):
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname.lower(),
+            "service": getattr(record, 'service', None),
+            "logger": record.name,
+            "message": record.getMessage(),
+            "trace_id": getattr(record, 'trace_id', None),
+            "span_id": getattr(record, 'span_id', None),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s [%(service)s] %(name)s: %(message)s trace_id=%(trace_id)s')
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Hands records to the listener thread without formatting them.
+
+    The message is formatted by the listener, so a record costs the caller
+    a queue put. The listener is started on first use, so every forked
+    worker gets its own thread.
+    """
+
+    def __init__(self, log_queue, handler):
+        super().__init__(log_queue)
+        self.handler = handler
+        self.listener = None
+        self.listener_pid = None
+        self.listener_lock = threading.Lock()
+        self.dropped = 0
+
+    def _ensure_listener(self):
+        if self.listener_pid == os.getpid():
+            return
+        with self.listener_lock:
+            if self.listener_pid == os.getpid():
+                return
+            self.listener_pid = os.getpid()
+            self.listener = QueueListener(self.queue, self.handler, respect_handler_level=True)
+            self.listener.start()
+            atexit.register(self.listener.stop)
+
+    def prepare(self, record):
+        # The queue stays in this process, the record does not need pickling
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+_queue_handler = None
+
+def init_logging(service_name, app=None):
+    """Send the records of every logger through the queue as JSON on stdout."""
+    global _queue_handler
+    if _queue_handler is None:
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else TextFormatter())
+        _queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=int(LOG_QUEUE_SIZE)), output)
+        _queue_handler.addFilter(TraceContextFilter(service_name))
+        root = logging.getLogger()
+        root.handlers = [_queue_handler]
+        root.setLevel(LOG_LEVEL.upper())
+    if app is not None:
+        # Flask logs through the root logger instead of its own stderr handler
+        from flask.logging import default_handler
+        app.logger.removeHandler(default_handler)
+        app.logger.setLevel(logging.NOTSET)
+
+def stats():
+    if _queue_handler is None:
+        return {}
+    return {"queued": _queue_handler.queue.qsize(), "dropped": _queue_handler.dropped}
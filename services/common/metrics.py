@@ -0,0 +1,313 @@
+import os
+import json
+import time
+import atexit
+import bisect
+import threading
+from opentelemetry import trace
+from common import telemetry
+
+# Workers of a gunicorn server write their metrics to this directory, and a
+# scrape of any worker returns the sum of all of them, see common/gunicorn_conf.py
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+METRICS_SNAPSHOT_INTERVAL_MS = os.getenv('METRICS_SNAPSHOT_INTERVAL_MS', 1000)
+
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+TEXT_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+class Histogram:
+    """Latency histogram with one series per label values.
+
+    Every bucket keeps the trace id of its latest observation as exemplar,
+    so a bucket in Grafana links to a trace in Tempo.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, labels, value, trace_id=None):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, [None] * (len(self.buckets) + 1)]
+            series[0][index] += 1
+            series[1] += value
+            if trace_id is not None:
+                series[2][index] = (trace_id, value, time.time())
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(labels), list(counts), total, list(exemplars)]
+                    for labels, (counts, total, exemplars) in self.series.items()]
+
+    def reset(self):
+        with self.lock:
+            self.series = {}
+
+server_requests = Histogram(
+    'http_server_request_duration_seconds',
+    'Duration of the HTTP requests served by this service.',
+    ('method', 'route', 'status'),
+    REQUEST_BUCKETS,
+)
+client_requests = Histogram(
+    'http_client_request_duration_seconds',
+    'Duration of the HTTP requests sent to downstream services, per attempt.',
+    ('downstream', 'method', 'path', 'status'),
+    REQUEST_BUCKETS,
+)
+db_queries = Histogram(
+    'db_query_duration_seconds',
+    'Duration of the SQL statements executed by this service.',
+    ('operation',),
+    QUERY_BUCKETS,
+)
+
+class Counter:
+    """Monotonic count with one series per label values, summed over the workers."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def inc(self, labels=(), amount=1):
+        _ensure_thread()
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(labels), value] for labels, value in self.series.items()]
+
+    def reset(self):
+        with self.lock:
+            self.series = {}
+
+class Gauge(Counter):
+    """Current value with one series per label values, summed over the workers."""
+
+    kind = 'gauge'
+
+    def set(self, labels=(), value=0):
+        _ensure_thread()
+        with self.lock:
+            self.series[labels] = value
+
+METRICS = [server_requests, client_requests, db_queries]
+
+def register(metric):
+    """Add a Counter or Gauge of a service to the scrapes, returns it."""
+    METRICS.append(metric)
+    return metric
+
+def _kind(name):
+    return next((metric.kind for metric in METRICS if metric.name == name), None)
+
+def _trace_id(seconds):
+    # Only traces that reach Tempo make useful exemplars: sampled ones, and
+    # with tail sampling the unsampled ones that are slow enough to be kept
+    span_context = trace.get_current_span().get_span_context()
+    if not span_context.is_valid:
+        return None
+    if not span_context.trace_flags.sampled and not (
+        telemetry.tail_sampling_enabled() and seconds * 1000.0 >= float(telemetry.TRACE_TAIL_LATENCY_MS)
+    ):
+        return None
+    return format(span_context.trace_id, '032x')
+
+def observe_request(method, route, status, seconds):
+    _ensure_thread()
+    server_requests.observe((method, route, str(status)), seconds, _trace_id(seconds))
+
+def observe_downstream(downstream, method, path, status, seconds):
+    """status is the response status code, or 'error' when none came back."""
+    _ensure_thread()
+    client_requests.observe((downstream, method, path, str(status)), seconds, _trace_id(seconds))
+
+def observe_query(statement, seconds):
+    _ensure_thread()
+    words = statement.split(None, 1)
+    db_queries.observe((words[0].upper() if words else '',), seconds, _trace_id(seconds))
+
+# Set by the gunicorn config, every worker writes its snapshot file here
+directory = METRICS_DIR or None
+_thread_pid = None
+_thread_lock = threading.Lock()
+
+def _ensure_thread():
+    # Started on first use, so every forked worker gets its own thread
+    global _thread_pid
+    if directory is None or _thread_pid == os.getpid():
+        return
+    with _thread_lock:
+        if _thread_pid == os.getpid():
+            return
+        _thread_pid = os.getpid()
+        threading.Thread(target=_run, name='metrics-snapshot', daemon=True).start()
+        atexit.register(write_snapshot)
+
+def _run():
+    interval = float(METRICS_SNAPSHOT_INTERVAL_MS) / 1000.0
+    while True:
+        time.sleep(interval)
+        try:
+            write_snapshot()
+        except OSError:
+            pass
+
+def snapshot():
+    return {metric.name: metric.snapshot() for metric in METRICS}
+
+def write_snapshot():
+    # Written beside the final file and renamed, a reader never sees half of it
+    path = os.path.join(directory, f'{os.getpid()}.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot(), f)
+    os.replace(path + '.tmp', path)
+
+def reset():
+    """Forget the observations made so far, e.g. those of the gunicorn master."""
+    for metric in METRICS:
+        metric.reset()
+
+def _merge(into, snapshot):
+    for name, series in snapshot.items():
+        kind = _kind(name)
+        if kind is None:
+            continue
+        merged = into.setdefault(name, {})
+        if kind != 'histogram':
+            for labels, value in series:
+                merged[tuple(labels)] = merged.get(tuple(labels), 0) + value
+            continue
+        for labels, counts, total, exemplars in series:
+            key = tuple(labels)
+            if key not in merged:
+                merged[key] = [list(counts), total, list(exemplars)]
+                continue
+            current = merged[key]
+            current[0] = [a + b for a, b in zip(current[0], counts)]
+            current[1] += total
+            current[2] = [
+                a if b is None or (a is not None and a[2] >= b[2]) else b
+                for a, b in zip(current[2], exemplars)
+            ]
+
+def collect():
+    """Series of this process, summed with those of the other workers."""
+    merged = {}
+    _merge(merged, snapshot())
+    if directory is None:
+        return merged
+    own = f'{os.getpid()}.json'
+    for filename in os.listdir(directory):
+        if filename == own or not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, filename)) as f:
+                _merge(merged, json.load(f))
+        except (OSError, ValueError):
+            continue
+    return merged
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}'
+
+def render(openmetrics=True):
+    """The metrics in the OpenMetrics text format, which carries the
+    exemplars, or in the Prometheus text format without them."""
+    merged = collect()
+    lines = []
+    for metric in METRICS:
+        if metric.kind == 'histogram':
+            _render_histogram(lines, metric, merged, openmetrics)
+            continue
+        # OpenMetrics names the family of a counter without its _total suffix
+        sample = f'{metric.name}_total' if metric.kind == 'counter' else metric.name
+        family = metric.name if openmetrics else sample
+        lines.append(f'# HELP {family} {metric.documentation}')
+        lines.append(f'# TYPE {family} {metric.kind}')
+        for values, value in sorted(merged.get(metric.name, {}).items()):
+            lines.append(f'{sample}{_labels(metric.labelnames, values) if values else ""} {value!r}')
+    if openmetrics:
+        lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+def _render_histogram(lines, histogram, merged, openmetrics):
+    lines.append(f'# HELP {histogram.name} {histogram.documentation}')
+    lines.append(f'# TYPE {histogram.name} histogram')
+    bounds = [repr(float(bound)) for bound in histogram.buckets] + ['+Inf']
+    for values, (counts, total, exemplars) in sorted(merged.get(histogram.name, {}).items()):
+        cumulative = 0
+        for bound, count, exemplar in zip(bounds, counts, exemplars):
+            cumulative += count
+            le = f'le="{bound}"'
+            line = f'{histogram.name}_bucket{_labels(histogram.labelnames, values, le)} {cumulative}'
+            if openmetrics and exemplar is not None:
+                line += f' # {{trace_id="{exemplar[0]}"}} {exemplar[1]!r} {round(exemplar[2], 3)}'
+            lines.append(line)
+        lines.append(f'{histogram.name}_count{_labels(histogram.labelnames, values)} {cumulative}')
+        lines.append(f'{histogram.name}_sum{_labels(histogram.labelnames, values)} {total!r}')
+
+def exposition(accept):
+    """Body and content type of a scrape, by the Accept header of the scraper."""
+    openmetrics = 'application/openmetrics-text' in (accept or '')
+    return render(openmetrics), OPENMETRICS_CONTENT_TYPE if openmetrics else TEXT_CONTENT_TYPE
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_started = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_metrics_started', None)
+    if started is not None:
+        observe_query(statement, time.perf_counter() - started)
+
+def init_app(app, db=None):
+    """Time the requests of a Flask service and the queries of its database,
+    and expose them at GET /metrics."""
+    from flask import Response, g, request
+    from sqlalchemy import event
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request_duration(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            observe_request(request.method, route, response.status_code, time.perf_counter() - started)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        body, content_type = exposition(request.headers.get('Accept'))
+        return Response(body, status=200, content_type=content_type)
+
+    if db is not None:
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(db.engine, 'after_cursor_execute', _after_cursor_execute)
@@ -0,0 +1,224 @@
+import os
+import sys
+import hmac
+import math
+import time
+import threading
+from collections import Counter, deque
+from opentelemetry import trace
+from common import telemetry
+
+# GET /debug/profile requires this token in the X-Profile-Token header, and
+# is disabled while it is empty
+PROFILE_TOKEN                   = os.getenv('PROFILE_TOKEN', '')
+PROFILE_INTERVAL_MS             = os.getenv('PROFILE_INTERVAL_MS', 10)
+PROFILE_MAX_SECONDS             = os.getenv('PROFILE_MAX_SECONDS', 60)
+# Continuous sampling: requests slower than PROFILE_SLOW_REQUEST_MS get the
+# stacks sampled while they ran as attributes of their span
+PROFILE_CONTINUOUS              = os.getenv('PROFILE_CONTINUOUS', 'false')
+PROFILE_CONTINUOUS_INTERVAL_MS  = os.getenv('PROFILE_CONTINUOUS_INTERVAL_MS', 50)
+PROFILE_CONTINUOUS_WINDOW_SECONDS = os.getenv('PROFILE_CONTINUOUS_WINDOW_SECONDS', 30)
+PROFILE_SLOW_REQUEST_MS         = os.getenv('PROFILE_SLOW_REQUEST_MS', 500)
+PROFILE_SNIPPET_STACKS          = os.getenv('PROFILE_SNIPPET_STACKS', 3)
+PROFILE_SNIPPET_DEPTH           = os.getenv('PROFILE_SNIPPET_DEPTH', 8)
+
+# A shorter interval would keep a core busy with sampling for the whole profile
+MIN_INTERVAL_MS = 1
+
+_frame_names = {}
+
+def _frame_name(code):
+    name = _frame_names.get(code)
+    if name is None:
+        name = _frame_names[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return name
+
+def _stack(frame):
+    """Function names of a stack from the outermost frame to the innermost."""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    names.reverse()
+    return tuple(names)
+
+def sample(exclude=()):
+    """The current stack of every thread but those in exclude, by thread id."""
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    return {
+        ident: (names.get(ident, str(ident)),) + _stack(frame)
+        for ident, frame in sys._current_frames().items()
+        if ident not in exclude
+    }
+
+def fold(stacks):
+    """Counted stacks in the folded format of flamegraph.pl and speedscope."""
+    return ''.join(f"{';'.join(stack)} {count}\n" for stack, count in stacks.most_common())
+
+class Profiler:
+    """Samples the stacks of all threads of this process.
+
+    profile() samples for a number of seconds in the calling thread and
+    returns the counted stacks. With continuous sampling on, a background
+    thread keeps the recent samples of every thread at a low rate, and
+    recent(ident, since) returns those of one thread, e.g. to find out
+    where a slow request spent its time.
+    """
+
+    def __init__(self, continuous_interval_ms=None, window_seconds=None):
+        self.continuous_interval = float(PROFILE_CONTINUOUS_INTERVAL_MS if continuous_interval_ms is None else continuous_interval_ms) / 1000.0
+        window = float(PROFILE_CONTINUOUS_WINDOW_SECONDS if window_seconds is None else window_seconds)
+        self.window_samples = max(1, int(window / self.continuous_interval))
+        self.lock = threading.Lock()
+        self.profile_lock = threading.Lock()
+        self.thread = None
+        self.thread_pid = None
+        self.samples = {}
+        self.continuous_samples = 0
+        self.profiles = 0
+        self.annotated = 0
+
+    def profile(self, seconds, interval):
+        """Counted stacks of every other thread, sampled every interval for
+        seconds. Returns None while another profile is running."""
+        if not self.profile_lock.acquire(blocking=False):
+            return None
+        try:
+            stacks = Counter()
+            own = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                stacks.update(sample(exclude=(own, self.thread and self.thread.ident)).values())
+                time.sleep(interval)
+            with self.lock:
+                self.profiles += 1
+            return stacks
+        finally:
+            self.profile_lock.release()
+
+    def ensure_continuous(self):
+        # Started on first use, so every forked worker gets its own thread
+        if self.thread_pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread_pid == os.getpid():
+                return
+            self.thread_pid = os.getpid()
+            self.samples = {}
+            self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            time.sleep(self.continuous_interval)
+            now = time.time()
+            stacks = sample(exclude=(own,))
+            with self.lock:
+                for ident in list(self.samples):
+                    if ident not in stacks:
+                        del self.samples[ident]
+                for ident, stack in stacks.items():
+                    samples = self.samples.get(ident)
+                    if samples is None:
+                        samples = self.samples[ident] = deque(maxlen=self.window_samples)
+                    samples.append((now, stack))
+                self.continuous_samples += 1
+
+    def recent(self, ident, since):
+        """Counted stacks of one thread sampled since a time.time() timestamp."""
+        with self.lock:
+            samples = list(self.samples.get(ident, ()))
+        return Counter(stack for at, stack in samples if at >= since)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "continuous": self.thread_pid == os.getpid(),
+                "continuous_samples": self.continuous_samples,
+                "profiles": self.profiles,
+                "annotated_spans": self.annotated,
+            }
+
+profiler = Profiler()
+
+def snippet(stacks, max_stacks=None, max_depth=None):
+    """The most frequent stacks cut to their innermost frames, short enough
+    for a span attribute."""
+    max_stacks = int(PROFILE_SNIPPET_STACKS if max_stacks is None else max_stacks)
+    max_depth = int(PROFILE_SNIPPET_DEPTH if max_depth is None else max_depth)
+    trimmed = Counter()
+    for stack, count in stacks.items():
+        trimmed[stack[-max_depth:]] += count
+    folded = fold(Counter(dict(trimmed.most_common(max_stacks))))
+    return folded[:telemetry.ATTRIBUTE_MAX_LENGTH]
+
+def annotate_slow_span(span, threshold_ms=None):
+    """Attach the stacks sampled while span ran in this thread, when it ran
+    longer than the threshold."""
+    threshold = float(PROFILE_SLOW_REQUEST_MS if threshold_ms is None else threshold_ms)
+    start_time = getattr(span, 'start_time', None)
+    if start_time is None or not span.is_recording():
+        return
+    started = start_time / 1e9
+    if (time.time() - started) * 1000.0 < threshold:
+        return
+    stacks = profiler.recent(threading.get_ident(), started)
+    if not stacks:
+        return
+    span.set_attribute("profile.samples", sum(stacks.values()))
+    span.set_attribute("profile.stacks", snippet(stacks))
+    with profiler.lock:
+        profiler.annotated += 1
+
+def _is_true(value):
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+def debug_profile(token, seconds, interval_ms):
+    """Status and body of GET /debug/profile, folded stacks as text or a
+    failure as a dict. Blocks for the seconds of the profile."""
+    if not PROFILE_TOKEN:
+        return 404, {"status": "failure", "message": "Profiling is disabled, set PROFILE_TOKEN"}
+    if not hmac.compare_digest((token or '').encode(), PROFILE_TOKEN.encode()):
+        return 403, {"status": "failure", "message": "Invalid profile token"}
+    try:
+        seconds = float(10 if seconds is None else seconds)
+        interval = float(PROFILE_INTERVAL_MS if interval_ms is None else interval_ms) / 1000.0
+    except ValueError:
+        return 400, {"status": "failure", "message": "seconds and interval_ms must be numbers"}
+    if not 0 < seconds <= float(PROFILE_MAX_SECONDS):
+        return 400, {"status": "failure", "message": f"seconds must be within 0 and {PROFILE_MAX_SECONDS}"}
+    if not math.isfinite(interval) or interval < MIN_INTERVAL_MS / 1000.0:
+        return 400, {"status": "failure", "message": f"interval_ms must be at least {MIN_INTERVAL_MS}"}
+    stacks = profiler.profile(seconds, interval)
+    if stacks is None:
+        return 409, {"status": "failure", "message": "Another profile is running"}
+    return 200, fold(stacks)
+
+def init_app(app):
+    """Expose GET /debug/profile?seconds=N, which samples the other threads
+    of the worker for N seconds and returns folded stacks, and attach the
+    stacks of slow requests to their spans with continuous sampling on."""
+    from flask import Response, jsonify, request
+
+    @app.route('/debug/profile', methods=['GET'])
+    def debug_profile_endpoint():
+        status, body = debug_profile(request.headers.get('X-Profile-Token'),
+                                     request.args.get('seconds'), request.args.get('interval_ms'))
+        if status != 200:
+            return jsonify(body), status
+        return Response(body, status=200, content_type='text/plain; charset=utf-8')
+
+    @app.route('/debug/profile/stats', methods=['GET'])
+    def debug_profile_stats():
+        return jsonify(profiler.stats()), 200
+
+    if _is_true(PROFILE_CONTINUOUS):
+        @app.before_request
+        def start_continuous_profiler():
+            profiler.ensure_continuous()
+
+        # Runs before the teardown of the Flask instrumentation ends the span
+        @app.teardown_request
+        def annotate_slow_request(exc):
+            annotate_slow_span(trace.get_current_span())
@@ -0,0 +1,223 @@
+import time
+import random
+import threading
+from collections import deque
+
+# Circuit breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitBreaker:
+    """Fails fast after consecutive failures of a downstream.
+
+    After failure_threshold failures in a row the breaker opens and calls are
+    rejected without being sent. Once reset_timeout seconds have passed a
+    single trial call is let through (half open): success closes the
+    breaker, failure opens it again. A threshold of 0 disables the breaker.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.opened = 0
+
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = HALF_OPEN
+                self.trial_in_flight = False
+            if self.trial_in_flight:
+                return False
+            self.trial_in_flight = True
+            return True
+
+    def record(self, ok):
+        with self.lock:
+            if ok:
+                self.failures = 0
+                self.state = CLOSED
+                self.trial_in_flight = False
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or (
+                self.state == CLOSED and self.failure_threshold and self.failures >= self.failure_threshold
+            ):
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.trial_in_flight = False
+                self.opened += 1
+
+class RetryBudget:
+    """Token bucket that keeps retries and hedges to a share of the calls.
+
+    Every call adds ratio tokens and every retry takes one, on top of
+    min_per_second tokens that are added over time so that a quiet service
+    can still retry. At most max(1, min_per_second) tokens are kept.
+    """
+
+    def __init__(self, ratio, min_per_second):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.capacity = max(1.0, float(min_per_second))
+        self.lock = threading.Lock()
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.min_per_second)
+        self.updated = now
+
+    def deposit(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens < 1.0:
+                return False
+            self.tokens -= 1.0
+            return True
+
+class LatencyWindow:
+    """Latencies of the most recent successful calls, for the hedge delay."""
+
+    MIN_SAMPLES = 20
+    REFRESH_EVERY = 64
+
+    def __init__(self, size=512):
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=size)
+        self.since_refresh = 0
+        self.cached = {}
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.since_refresh += 1
+            if self.since_refresh >= self.REFRESH_EVERY:
+                self.cached = {}
+                self.since_refresh = 0
+
+    def percentile(self, q):
+        """The q-th percentile, or None while there are too few samples."""
+        with self.lock:
+            if len(self.samples) < self.MIN_SAMPLES:
+                return None
+            if q not in self.cached:
+                ordered = sorted(self.samples)
+                self.cached[q] = ordered[min(len(ordered) - 1, int(len(ordered) * q / 100.0))]
+            return self.cached[q]
+
+class Policy:
+    """Retry, circuit breaker and hedging decisions for one downstream.
+
+    The policy does not send anything itself, the HTTP clients ask it
+    whether to send a call, whether and when to retry or hedge it, and
+    report every outcome back.
+    """
+
+    def __init__(self, name, deadline, retry_attempts, retry_backoff, retry_backoff_max,
+                 retry_budget_ratio, retry_budget_min, breaker_failures, breaker_reset_timeout,
+                 hedge, hedge_percentile, hedge_min_delay):
+        self.name = name
+        self.deadline = deadline
+        self.retry_attempts = retry_attempts
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset_timeout)
+        self.budget = RetryBudget(retry_budget_ratio, retry_budget_min)
+        self.latencies = LatencyWindow()
+        self.lock = threading.Lock()
+        self.counters = {
+            "calls": 0,
+            "attempts": 0,
+            "failures": 0,
+            "retries": 0,
+            "retries_denied": 0,
+            "short_circuited": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+        }
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.counters[key] += amount
+
+    def start(self):
+        """Start a call, returns its start time."""
+        self.count("calls")
+        self.budget.deposit()
+        return time.monotonic()
+
+    def remaining(self, started):
+        return self.deadline - (time.monotonic() - started)
+
+    def admit(self):
+        """Whether an attempt may be sent, False while the breaker is open."""
+        if self.breaker.allow():
+            self.count("attempts")
+            return True
+        self.count("short_circuited")
+        return False
+
+    def record(self, ok, seconds=None):
+        self.breaker.record(ok)
+        if ok and seconds is not None:
+            self.latencies.add(seconds)
+        if not ok:
+            self.count("failures")
+
+    def retry_delay(self, attempt, started):
+        """Seconds to wait before the next attempt, or None to give up.
+
+        Exponential backoff with full jitter, within the attempt limit, the
+        retry budget and the deadline of the call.
+        """
+        if attempt >= self.retry_attempts:
+            return None
+        delay = random.uniform(0, min(self.retry_backoff_max, self.retry_backoff * 2 ** (attempt - 1)))
+        if delay >= self.remaining(started) or not self.budget.withdraw():
+            self.count("retries_denied")
+            return None
+        self.count("retries")
+        return delay
+
+    def hedge_delay(self):
+        """Seconds after which to send a hedged request, None when not hedging."""
+        if not self.hedge:
+            return None
+        latency = self.latencies.percentile(self.hedge_percentile)
+        if latency is None:
+            return None
+        return max(self.hedge_min_delay, latency)
+
+    def allow_hedge(self):
+        # Hedges spend the retry budget and are not sent to a failing downstream
+        if self.breaker.state != CLOSED or not self.budget.withdraw():
+            return False
+        self.count("hedges")
+        self.count("attempts")
+        return True
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+        counters["circuit_state"] = self.breaker.state
+        counters["circuit_opened"] = self.breaker.opened
+        counters["hedge_delay_seconds"] = self.hedge_delay()
+        return counters
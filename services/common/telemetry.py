@@ -0,0 +1,399 @@
+import os
+import copy
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from grpc import Compression
+from opentelemetry import trace
+from opentelemetry.trace import SpanContext, TraceFlags, StatusCode
+from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+from opentelemetry.sdk.trace import SpanLimits, SpanProcessor, TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+from opentelemetry.sdk.trace.sampling import (
+    Decision,
+    ParentBased,
+    SamplingResult,
+    StaticSampler,
+    TraceIdRatioBased,
+)
+from common import logs
+
+TEMPO_HOSTNAME = os.getenv('TEMPO_HOSTNAME', 'tempo')
+TEMPO_PORT     = os.getenv('TEMPO_PORT', '4317')
+# Export: OTLP compression and batching of the span queue
+TRACE_EXPORT_COMPRESSION        = os.getenv('TRACE_EXPORT_COMPRESSION', 'gzip')
+TRACE_EXPORT_TIMEOUT_SECONDS    = os.getenv('TRACE_EXPORT_TIMEOUT_SECONDS', 10)
+TRACE_EXPORT_MAX_QUEUE_SIZE     = os.getenv('TRACE_EXPORT_MAX_QUEUE_SIZE', 8192)
+TRACE_EXPORT_MAX_BATCH_SIZE     = os.getenv('TRACE_EXPORT_MAX_BATCH_SIZE', 1024)
+TRACE_EXPORT_SCHEDULE_DELAY_MS  = os.getenv('TRACE_EXPORT_SCHEDULE_DELAY_MS', 1000)
+# Head sampling: share of new traces that are exported
+TRACE_SAMPLE_RATIO          = os.getenv('TRACE_SAMPLE_RATIO', 1.0)
+# Tail sampling: keep error and slow traces that head sampling left out
+TRACE_TAIL_SAMPLING         = os.getenv('TRACE_TAIL_SAMPLING', 'true')
+TRACE_TAIL_LATENCY_MS       = os.getenv('TRACE_TAIL_LATENCY_MS', 500)
+TRACE_TAIL_MAX_TRACES       = os.getenv('TRACE_TAIL_MAX_TRACES', 5000)
+TRACE_TAIL_MAX_SPANS        = os.getenv('TRACE_TAIL_MAX_SPANS', 256)
+# Attribute budgets
+TRACE_ATTRIBUTE_MAX_LENGTH  = os.getenv('TRACE_ATTRIBUTE_MAX_LENGTH', 1024)
+TRACE_SPAN_ATTRIBUTE_COUNT  = os.getenv('TRACE_SPAN_ATTRIBUTE_COUNT', 64)
+TRACE_CAPTURE_BODIES        = os.getenv('TRACE_CAPTURE_BODIES', 'false')
+TRACE_REDACT_FIELDS         = os.getenv('TRACE_REDACT_FIELDS', 'user_id,payment_method,shipping_address')
+
+REDACTED = '[REDACTED]'
+
+def _is_true(value):
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+CAPTURE_BODIES = _is_true(TRACE_CAPTURE_BODIES)
+ATTRIBUTE_MAX_LENGTH = int(TRACE_ATTRIBUTE_MAX_LENGTH)
+REDACT_FIELDS = frozenset(field.strip() for field in TRACE_REDACT_FIELDS.split(',') if field.strip())
+
+def span_limits(max_attribute_length=None):
+    return SpanLimits(
+        max_attribute_length=ATTRIBUTE_MAX_LENGTH if max_attribute_length is None else max_attribute_length,
+        max_span_attributes=int(TRACE_SPAN_ATTRIBUTE_COUNT),
+    )
+
+def tail_sampling_enabled():
+    return float(TRACE_SAMPLE_RATIO) < 1.0 and _is_true(TRACE_TAIL_SAMPLING)
+
+RECORD_ONLY = StaticSampler(Decision.RECORD_ONLY)
+
+class RecordingRatioSampler(TraceIdRatioBased):
+    """Ratio sampler that still records the traces it does not sample, so the
+    tail-sampling processor can export them when they turn out slow or failed."""
+
+    def should_sample(self, parent_context, trace_id, name, kind=None, attributes=None, links=None, trace_state=None):
+        result = super().should_sample(parent_context, trace_id, name, kind, attributes, links, trace_state)
+        if result.decision == Decision.DROP:
+            return SamplingResult(Decision.RECORD_ONLY, attributes, result.trace_state)
+        return result
+
+    def get_description(self):
+        return f"RecordingRatioSampler{{{self.rate}}}"
+
+def sampler(ratio=None, tail_sampling=None):
+    ratio = float(TRACE_SAMPLE_RATIO if ratio is None else ratio)
+    if tail_sampling is None:
+        tail_sampling = tail_sampling_enabled()
+    if not tail_sampling:
+        return ParentBased(TraceIdRatioBased(ratio))
+    return ParentBased(
+        RecordingRatioSampler(ratio),
+        remote_parent_not_sampled=RECORD_ONLY,
+        local_parent_not_sampled=RECORD_ONLY,
+    )
+
+def _sampled_copy(span):
+    sampled = copy.copy(span)
+    context = span.context
+    sampled._context = SpanContext(
+        context.trace_id,
+        context.span_id,
+        context.is_remote,
+        TraceFlags(TraceFlags.SAMPLED),
+        context.trace_state,
+    )
+    return sampled
+
+class TailSamplingProcessor(SpanProcessor):
+    """Buffers the spans of traces that were recorded but not sampled.
+
+    When the local root span of such a trace ends, the buffered spans are
+    handed to the delegate processor if the trace failed or was slower than
+    the latency threshold, and dropped otherwise. Sampled spans pass straight
+    through. The buffer holds at most max_traces traces, the oldest pending
+    trace is dropped when it is full.
+    """
+
+    def __init__(self, delegate, latency_threshold_ms, max_traces, max_spans_per_trace):
+        self.delegate = delegate
+        self.latency_threshold_ns = int(float(latency_threshold_ms) * 1e6)
+        self.max_traces = int(max_traces)
+        self.max_spans_per_trace = int(max_spans_per_trace)
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.kept = 0
+        self.dropped = 0
+        self.overflowed = 0
+
+    def on_start(self, span, parent_context=None):
+        self.delegate.on_start(span, parent_context=parent_context)
+
+    def on_end(self, span):
+        if span.context.trace_flags.sampled:
+            self.delegate.on_end(span)
+            return
+
+        trace_id = span.context.trace_id
+        local_root = span.parent is None or span.parent.is_remote
+        with self.lock:
+            spans = self.pending.get(trace_id)
+            if spans is None:
+                spans = self.pending[trace_id] = []
+                if len(self.pending) > self.max_traces:
+                    self.pending.popitem(last=False)
+                    self.overflowed += 1
+            if len(spans) < self.max_spans_per_trace:
+                spans.append(span)
+            if not local_root:
+                return
+            self.pending.pop(trace_id, None)
+
+        keep = self._keep(span, spans)
+        with self.lock:
+            if keep:
+                self.kept += 1
+            else:
+                self.dropped += 1
+        if keep:
+            for each in spans:
+                self.delegate.on_end(_sampled_copy(each))
+
+    def _keep(self, root, spans):
+        if root.end_time - root.start_time >= self.latency_threshold_ns:
+            return True
+        return any(each.status.status_code == StatusCode.ERROR for each in spans)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending_traces": len(self.pending),
+                "kept_traces": self.kept,
+                "dropped_traces": self.dropped,
+                "overflowed_traces": self.overflowed,
+            }
+
+    def shutdown(self):
+        self.delegate.shutdown()
+
+    def force_flush(self, timeout_millis=30000):
+        return self.delegate.force_flush(timeout_millis)
+
+def span_processor(delegate, tail_sampling=None):
+    """Wrap the export processor with tail sampling when it is enabled."""
+    if tail_sampling is None:
+        tail_sampling = tail_sampling_enabled()
+    if not tail_sampling:
+        return delegate
+    return TailSamplingProcessor(
+        delegate,
+        TRACE_TAIL_LATENCY_MS,
+        TRACE_TAIL_MAX_TRACES,
+        TRACE_TAIL_MAX_SPANS,
+    )
+
+COMPRESSION = {
+    'none': Compression.NoCompression,
+    'deflate': Compression.Deflate,
+    'gzip': Compression.Gzip,
+}
+
+class CountingExporter(SpanExporter):
+    """Counts exported and failed spans and the time spent exporting."""
+
+    def __init__(self, delegate):
+        self.delegate = delegate
+        self.lock = threading.Lock()
+        self.exported = 0
+        self.failed = 0
+        self.batches = 0
+        self.export_seconds_total = 0.0
+        self.export_seconds_max = 0.0
+
+    def export(self, spans):
+        started = time.perf_counter()
+        result = self.delegate.export(spans)
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.batches += 1
+            if result == SpanExportResult.SUCCESS:
+                self.exported += len(spans)
+            else:
+                self.failed += len(spans)
+            self.export_seconds_total += elapsed
+            self.export_seconds_max = max(self.export_seconds_max, elapsed)
+        return result
+
+    def shutdown(self):
+        self.delegate.shutdown()
+
+    def force_flush(self, timeout_millis=30000):
+        return self.delegate.force_flush(timeout_millis)
+
+class ExportProcessor(BatchSpanProcessor):
+    """BatchSpanProcessor that counts the spans it queues and the spans it
+    drops because the queue is full, i.e. the exporter cannot keep up."""
+
+    def __init__(self, exporter, max_queue_size, max_export_batch_size, schedule_delay_millis):
+        self.counting_exporter = CountingExporter(exporter)
+        super().__init__(
+            self.counting_exporter,
+            max_queue_size=max_queue_size,
+            max_export_batch_size=max_export_batch_size,
+            schedule_delay_millis=schedule_delay_millis,
+        )
+        self.max_queue_size = max_queue_size
+        self.counter_lock = threading.Lock()
+        self.queued = 0
+        self.dropped = 0
+
+    def queue_depth(self):
+        # The queue moved into a shared BatchProcessor in newer SDK versions
+        batch_processor = getattr(self, '_batch_processor', self)
+        queue = getattr(batch_processor, '_queue', None)
+        if queue is None:
+            queue = getattr(batch_processor, 'queue', ())
+        return len(queue)
+
+    def on_end(self, span):
+        if not span.context.trace_flags.sampled:
+            return
+        full = self.queue_depth() >= self.max_queue_size
+        with self.counter_lock:
+            if full:
+                self.dropped += 1
+            else:
+                self.queued += 1
+        super().on_end(span)
+
+    def stats(self):
+        exporter = self.counting_exporter
+        with self.counter_lock:
+            queued, dropped = self.queued, self.dropped
+        with exporter.lock:
+            return {
+                "queue_depth": self.queue_depth(),
+                "max_queue_size": self.max_queue_size,
+                "queued_spans": queued,
+                "dropped_spans": dropped,
+                "exported_spans": exporter.exported,
+                "failed_spans": exporter.failed,
+                "export_batches": exporter.batches,
+                "export_seconds_total": round(exporter.export_seconds_total, 6),
+                "export_seconds_max": round(exporter.export_seconds_max, 6),
+            }
+
+def otlp_exporter():
+    return OTLPSpanExporter(
+        endpoint=f"{TEMPO_HOSTNAME}:{TEMPO_PORT}",
+        insecure=True,
+        timeout=float(TRACE_EXPORT_TIMEOUT_SECONDS),
+        compression=COMPRESSION[TRACE_EXPORT_COMPRESSION.lower()],
+    )
+
+# Set by init_tracing
+tracer_provider = None
+export_processor = None
+root_processor = None
+
+# Set by the gunicorn config before the app is loaded: the app only records
+# its service name, and every worker creates the provider and its export
+# thread after fork with init_deferred_tracing()
+defer_tracing = False
+_deferred = None
+
+def init_tracing(service_name, exporter=None):
+    """Install the tracer provider of this process: sampling policy, attribute
+    limits, and the tuned batch export to Tempo behind optional tail sampling."""
+    global tracer_provider, export_processor, root_processor, _deferred
+    if defer_tracing:
+        _deferred = (service_name, exporter)
+        return None
+    provider = TracerProvider(
+        resource=Resource.create({SERVICE_NAME: service_name}),
+        sampler=sampler(),
+        span_limits=span_limits(),
+    )
+    export_processor = ExportProcessor(
+        otlp_exporter() if exporter is None else exporter,
+        max_queue_size=int(TRACE_EXPORT_MAX_QUEUE_SIZE),
+        max_export_batch_size=int(TRACE_EXPORT_MAX_BATCH_SIZE),
+        schedule_delay_millis=float(TRACE_EXPORT_SCHEDULE_DELAY_MS),
+    )
+    root_processor = span_processor(export_processor)
+    provider.add_span_processor(root_processor)
+    trace.set_tracer_provider(provider)
+    tracer_provider = provider
+    return provider
+
+def init_deferred_tracing():
+    global defer_tracing
+    defer_tracing = False
+    if _deferred is not None:
+        return init_tracing(*_deferred)
+    return None
+
+# Flushes of the write-behind buffers of a service, they run before the
+# tracer shuts down so the spans of the last writes are exported too
+_flushes = []
+
+def flush_before_shutdown(flush):
+    if flush not in _flushes:
+        _flushes.append(flush)
+
+def shutdown():
+    """Flush the write-behind buffers, then export the spans still queued and
+    stop the export thread."""
+    for flush in list(_flushes):
+        try:
+            flush()
+        except Exception:
+            logging.getLogger(__name__).exception('flush before shutdown failed')
+    if tracer_provider is not None:
+        tracer_provider.shutdown()
+
+def stats():
+    return {
+        "export": export_processor.stats() if export_processor is not None else None,
+        "tail_sampling": root_processor.stats() if isinstance(root_processor, TailSamplingProcessor) else None,
+        "logs": logs.stats(),
+    }
+
+def init_app(app, sqlalchemy=False):
+    """Instrument a Flask service and expose the exporter counters at
+    GET /debug/telemetry."""
+    from flask import jsonify
+    from opentelemetry.instrumentation.flask import FlaskInstrumentor
+    from opentelemetry.instrumentation.requests import RequestsInstrumentor
+
+    FlaskInstrumentor().instrument_app(app)
+    RequestsInstrumentor().instrument()
+    if sqlalchemy:
+        from opentelemetry.instrumentation.sqlalchemy import SQLAlchemyInstrumentor
+        SQLAlchemyInstrumentor().instrument()
+
+    @app.route('/debug/telemetry', methods=['GET'])
+    def telemetry_stats():
+        return jsonify(stats()), 200
+
+def _redact(value):
+    if isinstance(value, dict):
+        return {key: REDACTED if key in REDACT_FIELDS else _redact(each) for key, each in value.items()}
+    if isinstance(value, list):
+        return [_redact(each) for each in value]
+    return value
+
+def record_body(span, key, body):
+    """Set a request or response body as span attribute when body capture is on.
+
+    body can be a callable so the body is only built when it is captured.
+    JSON bodies are redacted, and every body is cut to the attribute length
+    budget here so the SDK does not log a truncation warning per span.
+    """
+    if not CAPTURE_BODIES or not span.is_recording():
+        return
+    if callable(body):
+        body = body()
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', 'replace')
+    if isinstance(body, str):
+        try:
+            body = json.loads(body)
+        except ValueError:
+            span.set_attribute(key, body[:ATTRIBUTE_MAX_LENGTH])
+            return
+    span.set_attribute(key, json.dumps(_redact(body), separators=(',', ':'))[:ATTRIBUTE_MAX_LENGTH])
@@ -0,0 +1,17 @@
+from opentelemetry import trace, propagate
+from opentelemetry.trace import Link
+
+def item_context():
+    """Serialize the current span context so a batch item can carry it downstream."""
+    carrier = {}
+    propagate.inject(carrier)
+    return carrier
+
+def item_links(carrier):
+    """Span links to the upstream span of a single batch item."""
+    if not carrier:
+        return []
+    span_context = trace.get_current_span(propagate.extract(carrier)).get_span_context()
+    if not span_context.is_valid:
+        return []
+    return [Link(span_context)]
@@ -1,62 +1,72 @@
 import os
-import random
 import requests
+from datetime import datetime
 from flask import Flask, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from opentelemetry import trace
-from opentelemetry.instrumentation.flask import FlaskInstrumentor
-from opentelemetry.instrumentation.sqlalchemy import SQLAlchemyInstrumentor
-from opentelemetry.instrumentation.requests import RequestsInstrumentor
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.resources import SERVICE_NAME, Resource
-from opentelemetry.sdk.trace import TracerProvider
-
-TEMPO_HOSTNAME = os.getenv('TEMPO_HOSTNAME', 'tempo')
-TEMPO_PORT     = os.getenv('TEMPO_PORT', '4317')
-FRAUD_PERCENTAGE = os.getenv('FRAUD_PERCENTAGE', 5)
-NOT_FRAUD_PERCENTAGE = os.getenv('NOT_FRAUD_PERCENTAGE', 95)
+from common import faults, logs, metrics, profiling, telemetry, tracing
+import decisions
+import scoring
+
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:////sqlite.db')
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////sqlite.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 db = SQLAlchemy(app)
 
-# Configure tracer
-trace.set_tracer_provider(TracerProvider(
-    resource=Resource.create({SERVICE_NAME: "fraud-service"})
-))
-
-# Set up the OTLP exporter
-otlp_exporter = OTLPSpanExporter(
-    endpoint=f"{TEMPO_HOSTNAME}:{TEMPO_PORT}",
-    insecure=True
-)
-
-# Configure OpenTelemetry trace provider to 
-# use BatchSpanProcessor with the OTLP exporter.
-trace.get_tracer_provider().add_span_processor(
-    BatchSpanProcessor(otlp_exporter)
-)
-
-# Instrument Flask
-FlaskInstrumentor().instrument_app(app)
-SQLAlchemyInstrumentor().instrument()
-RequestsInstrumentor().instrument()
-
-# Example model
+# Configure tracing and instrument Flask, see common/telemetry.py
+telemetry.init_tracing(os.environ['SERVICE_NAME'])
+telemetry.init_app(app, sqlalchemy=True)
+
+# JSON logs with the trace context of every record, see common/logs.py
+logs.init_logging(os.environ['SERVICE_NAME'], app)
+
+# RED metrics with trace exemplars at GET /metrics, see common/metrics.py
+metrics.init_app(app, db)
+
+# Sampling profiler at GET /debug/profile, see common/profiling.py
+profiling.init_app(app)
+
+# Latency and fault injection per route and downstream, see common/faults.py
+faults.init_app(app)
+
+# Audit trail of fraud decisions
 class FraudDetecton(db.Model):
+    __table_args__ = (
+        db.Index('ix_fraud_detecton_user_created', 'user_id', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.String(20))
     user_id = db.Column(db.String(20))
     payment_method = db.Column(db.String(20))
     amount = db.Column(db.String(10))
     is_fraud = db.Column(db.Boolean)
+    score = db.Column(db.Float)
+    rules_triggered = db.Column(db.String)
+    created_at = db.Column(db.DateTime)
 
-def fraud_probability():
-    decisions = { "fraud": int(FRAUD_PERCENTAGE), "not_fraud": int(NOT_FRAUD_PERCENTAGE) }
-    decision = random.choice([each for each in decisions for this in range(decisions[each])])
-    response = [True if decision == 'fraud' else False][0]
-    return response
+# Rule based scoring, see scoring.py for the rules and their settings
+scoring_engine = scoring.build_engine()
+
+# Decisions are recorded off the request path, see decisions.py
+decision_recorder = decisions.DecisionRecorder(app, db, FraudDetecton)
+
+def score_transaction(span, order_id, user_id, payment_method, amount):
+    decision = scoring_engine.evaluate(scoring.Transaction(order_id, user_id, payment_method, amount))
+    span.set_attribute("fraud.score", decision.score)
+    span.set_attribute("fraud.rules_triggered", decision.triggered)
+    span.set_attribute("fraud.is_fraudulent", decision.is_fraud)
+    decision_recorder.record({
+        "order_id": None if order_id is None else str(order_id),
+        "user_id": None if user_id is None else str(user_id),
+        "payment_method": None if payment_method is None else str(payment_method),
+        "amount": None if amount is None else str(amount),
+        "is_fraud": decision.is_fraud,
+        "score": decision.score,
+        "rules_triggered": ",".join(decision.triggered),
+        "created_at": datetime.utcnow(),
+    })
+    return decision.is_fraud
 
 @app.route('/fraud/check', methods=['POST'])
 def check_fraud():
@@ -68,10 +78,6 @@ def check_fraud():
     amount = payload.get("amount")
 
     with tracer.start_as_current_span("check_fraud"):
-        current_span = trace.get_current_span()
-        trace_id = current_span.get_span_context().trace_id
-        trace_id_hex = format(trace_id, '032x')
-        app.logger.info(f"[fraud-service] logged trace_id={trace_id_hex}")
 
         # Simulate fraud detection logic
         with tracer.start_as_current_span("analyze_transaction") as span:
@@ -80,21 +86,77 @@ def check_fraud():
             span.set_attribute("fraud.payment_method", payment_method)
             span.set_attribute("fraud.amount", amount)
 
-            # Basic Fraud detection logic
-            # Randomly flag transactions as fraudulent for demonstration
-            is_fraudulent = fraud_probability()
-            span.set_attribute("fraud.is_fraudulent", is_fraudulent)
-
-            # TODO: record activity to database
+            is_fraudulent = score_transaction(span, order_id, user_id, payment_method, amount)
 
             if is_fraudulent:
-                app.logger.warning(f"Transaction flagged as fraudulent: order_id={order_id}, user_id={user_id}")
+                app.logger.warning("Transaction flagged as fraudulent: order_id=%s, user_id=%s", order_id, user_id)
                 return jsonify({"status": "fraudulent", "message": "Transaction is fraudulent"}), 200
             else:
-                app.logger.info(f"Transaction passed fraud check: order_id={order_id}, user_id={user_id}")
+                app.logger.info("Transaction passed fraud check: order_id=%s, user_id=%s", order_id, user_id)
                 return jsonify({"status": "legitimate", "message": "Transaction is legitimate"}), 200
 
-if __name__ == '__main__':
+@app.route('/fraud/check/batch', methods=['POST'])
+def check_fraud_batch():
+    tracer = trace.get_tracer(__name__)
+    transactions = request.get_json().get('transactions', [])
+
+    with tracer.start_as_current_span("check_fraud_batch") as batch_span:
+        batch_span.set_attribute("batch.size", len(transactions))
+
+        results = []
+        for index, transaction in enumerate(transactions):
+            order_id = transaction.get("order_id")
+            user_id = transaction.get("user_id")
+            links = tracing.item_links(transaction.get('trace_context'))
+            with tracer.start_as_current_span("analyze_transaction", links=links) as span:
+                span.set_attribute("batch.index", index)
+                span.set_attribute("fraud.order_id", order_id)
+                span.set_attribute("fraud.user_id", user_id)
+                span.set_attribute("fraud.payment_method", transaction.get("payment_method"))
+                span.set_attribute("fraud.amount", transaction.get("amount"))
+
+                is_fraudulent = score_transaction(
+                    span, order_id, user_id, transaction.get("payment_method"), transaction.get("amount")
+                )
+
+                if is_fraudulent:
+                    app.logger.warning("Transaction flagged as fraudulent: order_id=%s, user_id=%s", order_id, user_id)
+                    results.append({"status": "fraudulent", "message": "Transaction is fraudulent"})
+                else:
+                    results.append({"status": "legitimate", "message": "Transaction is legitimate"})
+
+        return jsonify({"status": "success", "results": results}), 200
+
+@app.route('/fraud/users/<user_id>/decisions', methods=['GET'])
+def recent_decisions(user_id):
+    """Latest decisions of a user, newest first. Decisions show up once they are flushed."""
+    limit = min(request.args.get('limit', 20, type=int), 500)
+    rows = (
+        FraudDetecton.query
+        .filter_by(user_id=user_id)
+        .order_by(FraudDetecton.created_at.desc())
+        .limit(limit)
+        .all()
+    )
+    return jsonify({"user_id": user_id, "decisions": [{
+        "order_id": row.order_id,
+        "payment_method": row.payment_method,
+        "amount": row.amount,
+        "is_fraud": row.is_fraud,
+        "score": row.score,
+        "rules_triggered": row.rules_triggered.split(',') if row.rules_triggered else [],
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+    } for row in rows]}), 200
+
+@app.route('/fraud/recorder/stats', methods=['GET'])
+def decision_recorder_stats():
+    return jsonify(decision_recorder.stats()), 200
+
+def init_db():
+    """Create the schema and seed data, runs once before the server starts."""
     with app.app_context():
         db.create_all()
+
+if __name__ == '__main__':
+    init_db()
     app.run(debug=True, host='0.0.0.0', port=5000)
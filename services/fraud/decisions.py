@@ -0,0 +1,177 @@
+import os
+import time
+import queue
+import atexit
+import threading
+from sqlalchemy.exc import OperationalError
+from common import telemetry
+
+# Decisions wait in a bounded queue and are inserted in bulk by a background
+# thread every FRAUD_RECORD_FLUSH_INTERVAL_MS, or sooner once
+# FRAUD_RECORD_BATCH_SIZE are waiting
+FRAUD_RECORD_QUEUE_SIZE = os.getenv('FRAUD_RECORD_QUEUE_SIZE', 10000)
+FRAUD_RECORD_BATCH_SIZE = os.getenv('FRAUD_RECORD_BATCH_SIZE', 500)
+FRAUD_RECORD_FLUSH_INTERVAL_MS = os.getenv('FRAUD_RECORD_FLUSH_INTERVAL_MS', 200)
+
+class DecisionRecorder:
+    """Audit trail of fraud decisions, written behind the request.
+
+    record() puts a decision on a bounded queue and returns. A background
+    thread drains the queue and inserts the decisions with one executemany
+    per batch_size rows. When the queue is full the caller flushes it
+    itself, which slows the requests down instead of losing decisions. When
+    that flush fails the error is logged and the decision is dropped if the
+    queue is still full, scoring never fails on the audit write. Queued
+    decisions are flushed at exit.
+
+    While the database is unavailable the rows of a failed batch are queued
+    again. A batch it rejects for another reason is written row by row, and
+    the rows that still fail are logged and dropped.
+    """
+
+    def __init__(self, app, db, model, queue_size=None, batch_size=None, interval_ms=None):
+        self.app = app
+        self.db = db
+        self.model = model
+        self.queue = queue.Queue(maxsize=int(FRAUD_RECORD_QUEUE_SIZE if queue_size is None else queue_size))
+        self.batch_size = int(FRAUD_RECORD_BATCH_SIZE if batch_size is None else batch_size)
+        self.interval = float(FRAUD_RECORD_FLUSH_INTERVAL_MS if interval_ms is None else interval_ms) / 1000.0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread_pid = None
+        self.recorded = 0
+        self.written = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.dropped = 0
+        self.backpressure = 0
+        self.flush_seconds_total = 0.0
+
+    def _ensure_thread(self):
+        # Started on first use, so every forked worker gets its own thread
+        if self.thread_pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread_pid == os.getpid():
+                return
+            self.thread_pid = os.getpid()
+            threading.Thread(target=self._run, name='fraud-recorder', daemon=True).start()
+            atexit.register(self.flush)
+            telemetry.flush_before_shutdown(self.flush)
+
+    def record(self, decision):
+        """Queue a decision, a dict of model columns."""
+        self._ensure_thread()
+        try:
+            self.queue.put_nowait(decision)
+        except queue.Full:
+            with self.lock:
+                self.backpressure += 1
+            try:
+                self.flush()
+            except Exception:
+                # Scoring does not wait for the audit trail, the rows of the
+                # failed flush are queued again
+                self.app.logger.exception('fraud decision flush failed')
+            try:
+                self.queue.put_nowait(decision)
+            except queue.Full:
+                with self.lock:
+                    self.dropped += 1
+                return
+        with self.lock:
+            self.recorded += 1
+        if self.queue.qsize() >= self.batch_size:
+            self.wakeup.set()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('fraud decision flush failed')
+
+    def _drain(self):
+        rows = []
+        while len(rows) < self.batch_size:
+            try:
+                rows.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def flush(self):
+        """Write every queued decision, returns the number written."""
+        written = 0
+        with self.flush_lock:
+            while True:
+                rows = self._drain()
+                if not rows:
+                    return written
+                started = time.perf_counter()
+                try:
+                    self._write(rows)
+                    batch_written = len(rows)
+                except OperationalError:
+                    self._requeue(rows)
+                    raise
+                except Exception:
+                    self.app.logger.exception('fraud decision batch failed, writing its %s rows one by one', len(rows))
+                    batch_written = self._write_each(rows)
+                written += batch_written
+                with self.lock:
+                    self.flushes += 1
+                    self.written += batch_written
+                    self.flush_seconds_total += time.perf_counter() - started
+
+    def _write_each(self, rows):
+        """Write a failed batch row by row, returns how many were written."""
+        written = 0
+        for position, row in enumerate(rows):
+            try:
+                self._write([row])
+                written += 1
+            except OperationalError:
+                self._requeue(rows[position:])
+                raise
+            except Exception:
+                self.app.logger.exception('dropping the fraud decision of order %s, it cannot be written',
+                                          row.get('order_id'))
+                with self.lock:
+                    self.dropped += 1
+        return written
+
+    def _requeue(self, rows):
+        # Keep what fits for the next flush, the rest is counted as dropped
+        dropped = 0
+        for row in rows:
+            try:
+                self.queue.put_nowait(row)
+            except queue.Full:
+                dropped += 1
+        with self.lock:
+            self.failed_flushes += 1
+            self.dropped += dropped
+
+    def _write(self, rows):
+        with self.app.app_context():
+            # A list of parameter sets runs as a single executemany
+            self.db.session.execute(self.model.__table__.insert(), rows)
+            self.db.session.commit()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queued": self.queue.qsize(),
+                "recorded": self.recorded,
+                "written": self.written,
+                "flushes": self.flushes,
+                "failed_flushes": self.failed_flushes,
+                "dropped": self.dropped,
+                "backpressure": self.backpressure,
+                "average_batch": round(self.written / self.flushes, 2) if self.flushes else 0.0,
+                "flush_seconds_total": round(self.flush_seconds_total, 6),
+            }
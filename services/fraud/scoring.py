@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import random
+import threading
+from array import array
+from collections import OrderedDict
+
+FRAUD_PERCENTAGE = os.getenv('FRAUD_PERCENTAGE', 5)
+NOT_FRAUD_PERCENTAGE = os.getenv('NOT_FRAUD_PERCENTAGE', 95)
+FRAUD_SCORE_THRESHOLD = os.getenv('FRAUD_SCORE_THRESHOLD', 1.0)
+FRAUD_VELOCITY_WINDOW_SECONDS = os.getenv('FRAUD_VELOCITY_WINDOW_SECONDS', 60)
+FRAUD_VELOCITY_MAX_TRANSACTIONS = os.getenv('FRAUD_VELOCITY_MAX_TRANSACTIONS', 10)
+FRAUD_VELOCITY_MAX_AMOUNT = os.getenv('FRAUD_VELOCITY_MAX_AMOUNT', 5000)
+FRAUD_AMOUNT_THRESHOLD = os.getenv('FRAUD_AMOUNT_THRESHOLD', 2000)
+FRAUD_PAYMENT_METHOD_RISK = os.getenv('FRAUD_PAYMENT_METHOD_RISK', 'credit_card=0.0,debit_card=0.0,gift_card=0.4,crypto=0.6')
+FRAUD_MAX_TRACKED_USERS = os.getenv('FRAUD_MAX_TRACKED_USERS', 100000)
+# Optional JSON file with the rule set, replaces the rules built from the variables above
+FRAUD_RULES_FILE = os.getenv('FRAUD_RULES_FILE')
+
+def parse_amount(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+class SlidingWindow:
+    """Timestamps and amounts of the latest transactions of one user.
+
+    Entries live in a fixed-size ring buffer, so memory per user is bounded by
+    capacity. Expired entries are evicted from the head as new ones arrive,
+    which keeps every update amortized O(1).
+    """
+
+    __slots__ = ('window', 'capacity', 'timestamps', 'amounts', 'head', 'size', 'total')
+
+    def __init__(self, window, capacity):
+        self.window = window
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.amounts = array('d', bytes(8 * capacity))
+        self.head = 0
+        self.size = 0
+        self.total = 0.0
+
+    def _evict_oldest(self):
+        self.total -= self.amounts[self.head]
+        self.head = (self.head + 1) % self.capacity
+        self.size -= 1
+
+    def expire(self, now):
+        cutoff = now - self.window
+        while self.size and self.timestamps[self.head] <= cutoff:
+            self._evict_oldest()
+
+    def add(self, now, amount):
+        self.expire(now)
+        if self.size == self.capacity:
+            self._evict_oldest()
+        tail = (self.head + self.size) % self.capacity
+        self.timestamps[tail] = now
+        self.amounts[tail] = amount
+        self.size += 1
+        self.total += amount
+
+class VelocityTracker:
+    """Sliding windows for the most recently seen users, least recently seen are dropped."""
+
+    def __init__(self, window, capacity, max_users):
+        self.window = window
+        self.capacity = capacity
+        self.max_users = max_users
+        self.users = OrderedDict()
+        self.lock = threading.Lock()
+
+    def record(self, user_id, amount, now):
+        """Add a transaction and return (count, total amount) inside the window."""
+        with self.lock:
+            window = self.users.get(user_id)
+            if window is None:
+                window = self.users[user_id] = SlidingWindow(self.window, self.capacity)
+                if len(self.users) > self.max_users:
+                    self.users.popitem(last=False)
+            else:
+                self.users.move_to_end(user_id)
+            window.add(now, amount)
+            return window.size, window.total
+
+class Transaction:
+    __slots__ = ('order_id', 'user_id', 'payment_method', 'amount', 'timestamp')
+
+    def __init__(self, order_id, user_id, payment_method, amount, timestamp=None):
+        self.order_id = order_id
+        self.user_id = user_id
+        self.payment_method = payment_method
+        self.amount = parse_amount(amount)
+        self.timestamp = time.monotonic() if timestamp is None else timestamp
+
+class VelocityRule:
+    name = 'velocity'
+
+    def __init__(self, window_seconds, max_transactions, max_amount, weight, max_users):
+        self.max_transactions = max_transactions
+        self.max_amount = max_amount
+        self.weight = weight
+        # One extra slot is enough to tell that the limit was exceeded
+        self.tracker = VelocityTracker(window_seconds, max_transactions + 1, max_users)
+
+    def score(self, transaction):
+        count, total = self.tracker.record(transaction.user_id, transaction.amount, transaction.timestamp)
+        if count > self.max_transactions or total > self.max_amount:
+            return self.weight
+        return 0.0
+
+class AmountRule:
+    name = 'amount'
+
+    def __init__(self, threshold, weight):
+        self.threshold = threshold
+        self.weight = weight
+
+    def score(self, transaction):
+        return self.weight if transaction.amount >= self.threshold else 0.0
+
+class PaymentMethodRule:
+    name = 'payment_method'
+
+    def __init__(self, risk, default=0.0):
+        self.risk = risk
+        self.default = default
+
+    def score(self, transaction):
+        # The configured methods are strings, a list or dict in the body is not one of them
+        if not isinstance(transaction.payment_method, str):
+            return self.default
+        return self.risk.get(transaction.payment_method, self.default)
+
+class RandomRule:
+    """Flags the configured share of transactions, keeps the demo producing fraud."""
+    name = 'random'
+
+    def __init__(self, probability, weight):
+        self.probability = probability
+        self.weight = weight
+
+    def score(self, transaction):
+        return self.weight if random.random() < self.probability else 0.0
+
+class Decision:
+    __slots__ = ('score', 'is_fraud', 'triggered')
+
+    def __init__(self, score, is_fraud, triggered):
+        self.score = score
+        self.is_fraud = is_fraud
+        self.triggered = triggered
+
+class ScoringEngine:
+    def __init__(self, rules, threshold):
+        self.rules = rules
+        self.threshold = threshold
+
+    def evaluate(self, transaction):
+        score = 0.0
+        triggered = []
+        # Every rule runs so velocity windows see every transaction
+        for rule in self.rules:
+            points = rule.score(transaction)
+            if points:
+                score += points
+                triggered.append(rule.name)
+        return Decision(score, score >= self.threshold, triggered)
+
+def parse_risk(value):
+    risk = {}
+    for entry in value.split(','):
+        if '=' in entry:
+            method, points = entry.split('=', 1)
+            risk[method.strip()] = float(points)
+    return risk
+
+RULE_TYPES = {
+    'velocity': lambda config: VelocityRule(
+        float(config['window_seconds']),
+        int(config['max_transactions']),
+        float(config.get('max_amount', float('inf'))),
+        float(config.get('weight', 1.0)),
+        int(config.get('max_users', FRAUD_MAX_TRACKED_USERS)),
+    ),
+    'amount': lambda config: AmountRule(float(config['threshold']), float(config.get('weight', 1.0))),
+    'payment_method': lambda config: PaymentMethodRule(config['risk'], float(config.get('default', 0.0))),
+    'random': lambda config: RandomRule(float(config['probability']), float(config.get('weight', 1.0))),
+}
+
+def rules_from_config(config):
+    return [RULE_TYPES[rule['type']](rule) for rule in config]
+
+def default_rules():
+    fraud, not_fraud = int(FRAUD_PERCENTAGE), int(NOT_FRAUD_PERCENTAGE)
+    rules = [
+        VelocityRule(
+            float(FRAUD_VELOCITY_WINDOW_SECONDS),
+            int(FRAUD_VELOCITY_MAX_TRANSACTIONS),
+            float(FRAUD_VELOCITY_MAX_AMOUNT),
+            1.0,
+            int(FRAUD_MAX_TRACKED_USERS),
+        ),
+        AmountRule(float(FRAUD_AMOUNT_THRESHOLD), 0.6),
+        PaymentMethodRule(parse_risk(FRAUD_PAYMENT_METHOD_RISK)),
+    ]
+    if fraud > 0:
+        rules.append(RandomRule(fraud / float(fraud + not_fraud), 1.0))
+    return rules
+
+def build_engine():
+    if FRAUD_RULES_FILE:
+        with open(FRAUD_RULES_FILE) as f:
+            config = json.load(f)
+        return ScoringEngine(rules_from_config(config['rules']), float(config.get('threshold', FRAUD_SCORE_THRESHOLD)))
+    return ScoringEngine(default_rules(), float(FRAUD_SCORE_THRESHOLD))
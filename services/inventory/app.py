@@ -1,48 +1,48 @@
 import os
 import sys
-import time
-import random
 import requests
 from flask import Flask, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text
+from sqlalchemy import bindparam, text
 from opentelemetry import trace
-from opentelemetry.instrumentation.flask import FlaskInstrumentor
-from opentelemetry.instrumentation.sqlalchemy import SQLAlchemyInstrumentor
-from opentelemetry.instrumentation.requests import RequestsInstrumentor
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.resources import SERVICE_NAME, Resource
-from opentelemetry.sdk.trace import TracerProvider
-
-TEMPO_HOSTNAME = os.getenv('TEMPO_HOSTNAME', 'tempo')
-TEMPO_PORT     = os.getenv('TEMPO_PORT', '4317')
-CHAOS_MONKEY_ENABLED = os.getenv('CHAOS_MONKEY_ENABLED', False)
+from common import catalog, database, faults, http_client, logs, metrics, profiling, telemetry, tracing
+
+# Delays every warehouse call by up to a second, a shortcut for a fault
+# profile of the warehouse-service, see common/faults.py
+CHAOS_MONKEY_ENABLED = os.getenv('CHAOS_MONKEY_ENABLED', 'false')
 INVENTORY_AVAILABILITY = os.getenv('INVENTORY_AVAILABILITY', 100)
+WAREHOUSE_SERVICE_URL = os.getenv('WAREHOUSE_SERVICE_URL', 'http://warehouse-service:5000')
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:////sqlite.db')
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////sqlite.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = database.sqlite_engine_options()
 db = SQLAlchemy(app)
+database.enable_sqlite_wal(app, db)
 
-# Configure tracer
-trace.set_tracer_provider(TracerProvider(
-    resource=Resource.create({SERVICE_NAME: os.environ['SERVICE_NAME']})
-))
+# Configure tracing and instrument Flask, see common/telemetry.py
+telemetry.init_tracing(os.environ['SERVICE_NAME'])
+telemetry.init_app(app, sqlalchemy=True)
 
-# Set up the OTLP exporter
-otlp_exporter = OTLPSpanExporter(
-    endpoint=f"{TEMPO_HOSTNAME}:{TEMPO_PORT}",
-    insecure=True
-)
+# JSON logs with the trace context of every record, see common/logs.py
+logs.init_logging(os.environ['SERVICE_NAME'], app)
 
-trace.get_tracer_provider().add_span_processor(
-    BatchSpanProcessor(otlp_exporter)
-)
+# RED metrics with trace exemplars at GET /metrics, see common/metrics.py
+metrics.init_app(app, db)
+
+# Sampling profiler at GET /debug/profile, see common/profiling.py
+profiling.init_app(app)
+
+# Latency and fault injection per route and downstream, see common/faults.py
+faults.init_app(app)
+if faults.is_true(CHAOS_MONKEY_ENABLED):
+    faults.injector.setdefault('downstreams', 'warehouse-service', {
+        "latency": {"distribution": "uniform", "min_ms": 0, "max_ms": 1000}
+    })
 
-# Instrument Flask
-FlaskInstrumentor().instrument_app(app)
-SQLAlchemyInstrumentor().instrument()
-RequestsInstrumentor().instrument()
+# Pooled keep-alive client for the warehouse service
+warehouse_service = http_client.client('warehouse-service', WAREHOUSE_SERVICE_URL)
+http_client.init_app(app)
 
 # Inventory model
 class Inventory(db.Model):
@@ -50,10 +50,130 @@ class Inventory(db.Model):
     description = db.Column(db.String(80))
     availability = db.Column(db.Integer)
 
-def chaos_monkey():
-    if CHAOS_MONKEY_ENABLED:
-        time.sleep(random.random())
-    return CHAOS_MONKEY_ENABLED
+# Reserve stock with a single conditional UPDATE, the row is only changed
+# when enough stock is left so concurrent workers can never oversell
+RESERVE_QUERY = text(
+    "UPDATE inventory SET availability = availability - :quantity "
+    "WHERE id = :item_id AND availability >= :quantity"
+)
+RELEASE_QUERY = text("UPDATE inventory SET availability = availability + :quantity WHERE id = :item_id")
+# Stock of every item of an order with a single query
+LEVELS_QUERY = text("SELECT id, availability FROM inventory WHERE id IN :item_ids").bindparams(
+    bindparam('item_ids', expanding=True)
+)
+
+# Bulk catalog import, an item of the input sets or adds to the stock of an
+# item. Rows that would not change are skipped, see common/catalog.py
+IMPORT_QUERIES = {
+    'set': text(
+        "INSERT INTO inventory (id, description, availability) VALUES (:id, :description, :availability) "
+        "ON CONFLICT (id) DO UPDATE SET "
+        "description = COALESCE(excluded.description, description), availability = excluded.availability "
+        "WHERE availability IS NOT excluded.availability "
+        "OR description IS NOT COALESCE(excluded.description, description)"
+    ),
+    'add': text(
+        "INSERT INTO inventory (id, description, availability) VALUES (:id, :description, :availability) "
+        "ON CONFLICT (id) DO UPDATE SET "
+        "description = COALESCE(excluded.description, description), availability = availability + excluded.availability "
+        "WHERE excluded.availability > 0 "
+        "OR description IS NOT COALESCE(excluded.description, description)"
+    ),
+}
+
+def import_row(row):
+    """Parameters of the import queries for a row with id, availability and
+    an optional description."""
+    return {
+        "id": catalog.required(row, 'id'),
+        "description": row.get('description') or None,
+        "availability": catalog.quantity(row, 'availability'),
+    }
+
+catalog.init_app(app, db, 'inventory', import_row, IMPORT_QUERIES)
+
+def reserve_inventory(item_id, quantity):
+    result = db.session.execute(RESERVE_QUERY, {"item_id": item_id, "quantity": quantity})
+    return result.rowcount == 1
+
+def line_quantities(items):
+    """Total quantity per item, an order may list the same item twice."""
+    quantities = {}
+    for item in items:
+        quantities[item['item_id']] = quantities.get(item['item_id'], 0) + item['quantity']
+    return quantities
+
+def valid_items(items):
+    return bool(items) and all(
+        isinstance(item.get('quantity'), int) and item['quantity'] > 0 for item in items
+    )
+
+def reserve_items(items):
+    """Reserve all items in the current transaction, or none of them.
+
+    Returns the ids of the items that are short of stock, the transaction is
+    rolled back in that case.
+    """
+    quantities = line_quantities(items)
+    rows = db.session.execute(LEVELS_QUERY, {"item_ids": list(quantities)}).all()
+    available = {row.id: row.availability for row in rows}
+    short = [item_id for item_id, quantity in quantities.items() if available.get(item_id, 0) < quantity]
+    if not short:
+        params = [{"item_id": item_id, "quantity": quantity} for item_id, quantity in quantities.items()]
+        result = db.session.execute(RESERVE_QUERY, params)
+        if result.rowcount == len(params):
+            return []
+        # Another worker took the stock between the query and the update
+        short = [item_id for item_id in quantities]
+    db.session.rollback()
+    return short
+
+def reserve_lines(lines):
+    """Reserve the lines of one order of a batch, undoing them when one is short."""
+    reserved = []
+    for line in lines:
+        if not reserve_inventory(line['item_id'], line['quantity']):
+            if reserved:
+                db.session.execute(RELEASE_QUERY, reserved)
+            return False
+        reserved.append({"item_id": line['item_id'], "quantity": line['quantity']})
+    return True
+
+def release_items(items):
+    """Give the items back in the current transaction, False for unknown items."""
+    params = [{"item_id": item_id, "quantity": quantity} for item_id, quantity in line_quantities(items).items()]
+    result = db.session.execute(RELEASE_QUERY, params)
+    return result.rowcount == len(params)
+
+def release_allocations(items):
+    """Release the warehouse locations of items, returns an error message or None."""
+    try:
+        response = warehouse_service.post('/warehouse/release', json={"items": [{
+            "item_id": item['item_id'],
+            "allocations": item['allocations']
+        } for item in items]})
+    except requests.exceptions.RequestException as e:
+        app.logger.error("Error while calling warehouse service: %s", e)
+        return "Error contacting warehouse service"
+    if response.status_code != 200:
+        app.logger.error('Warehouse release failed: %s', response.text)
+        return "Warehouse release failed"
+    return None
+
+def release_failed_orders(failed):
+    """Give back the stock of batch orders the warehouse could not reserve,
+    and the warehouse reservations of their other lines."""
+    tracer = trace.get_tracer(__name__)
+    with tracer.start_as_current_span("release_inventory") as span:
+        span.set_attribute("batch.size", len(failed))
+        release_items([line for each in failed for line in each['lines']])
+        db.session.commit()
+        allocated = [item for each in failed for item in each.get('allocated') or [] if item['allocations']]
+        if allocated:
+            error = release_allocations(allocated)
+            if error is not None:
+                # Their holds expire and give the stock back
+                app.logger.error('Releasing the warehouse reservations of failed orders failed: %s', error)
 
 @app.route('/inventory/check', methods=['POST'])
 def inventory_check():
@@ -64,52 +184,36 @@ def inventory_check():
     tracer = trace.get_tracer(__name__)
 
     with tracer.start_as_current_span("check_availability"):
-        # Access the current span
-        current_span = trace.get_current_span()
-
-        # Get the trace ID from the current span
-        trace_id = current_span.get_span_context().trace_id
-
-        # Format the trace ID into a hexadecimal string
-        trace_id_hex = format(trace_id, '032x')
-
-        # Log the trace ID
-        app.logger.debug(f"inventory-service about to make a database query. trace_id={trace_id_hex}")
+        app.logger.debug("inventory-service about to make a database query")
 
         with tracer.start_as_current_span("query_inventory_database") as span:
-            inventory_item = Inventory.query.filter_by(id=item_id).first()
-            sql_query = f"SELECT * FROM inventory WHERE item_id = {item_id}"
-            span.set_attribute("db.query", sql_query)
+            reserved = reserve_inventory(item_id, quantity)
+            db.session.commit()
+            span.set_attribute("db.query", RESERVE_QUERY.text)
             span.set_attribute("inventory.item_id", item_id)
             span.set_attribute("inventory.requested_quantity", quantity)
-            span.set_attribute("inventory.availability", inventory_item.availability)
+            span.set_attribute("inventory.reserved", reserved)
 
-            if inventory_item and inventory_item.availability >= quantity:
-                # Reduce the availability with the quantity amount
-                inventory_item.availability -= quantity
-                db.session.commit()
-                app.logger.debug(f'the availability in the inv db is {inventory_item.availability}')
+            if reserved:
+                app.logger.debug('reserved %s of %s in the inv db', quantity, item_id)
                 # Make the call to Warehouse Service
-                chaos_monkey()
                 with tracer.start_as_current_span("inventory_to_warehouse_call") as span:
                     span.set_attribute("inventory.item_id", item_id)
                     span.set_attribute("inventory.requested_quantity", quantity)
-                    span.set_attribute("inventory.availability", inventory_item.availability)
-                    warehouse_url = 'http://warehouse-service:5000/warehouse/reserve'
+                    warehouse_url = warehouse_service.url('/warehouse/reserve')
                     span.set_attribute("inventory.warehouse_url", warehouse_url)
 
                     with tracer.start_as_current_span("http_post_warehouse_reserve") as http_span:
                         try:
-                            response = requests.post(
-                                warehouse_url,
+                            response = warehouse_service.post(
+                                '/warehouse/reserve',
                                 json={"item_id": item_id, "quantity": quantity}
                             )
-                            chaos_monkey()
                             http_span.set_attribute("http.method", "POST")
                             http_span.set_attribute("http.url", warehouse_url)
                             http_span.set_attribute("http.status_code", response.status_code)
-                            http_span.set_attribute("http.request_body", f"item_id={item_id}, quantity={quantity}")
-                            http_span.set_attribute("http.response_body", response.text)
+                            telemetry.record_body(http_span, "http.request_body", {"item_id": item_id, "quantity": quantity})
+                            telemetry.record_body(http_span, "http.response_body", lambda: response.text)
                             http_span.set_attribute("http.response_time", response.elapsed.total_seconds())
 
                             with tracer.start_as_current_span("warehouse_response_handling") as resp_span:
@@ -117,20 +221,255 @@ def inventory_check():
                                     resp_span.set_attribute("response.status", "success")
                                     resp_span.set_attribute("response.message", "Reservation successful")
                                 else:
-                                    app.logger.debug(f'[inventory-service] {response.status_code} status code : {response.text}') 
+                                    app.logger.debug('[inventory-service] %s status code : %s', response.status_code, response.text) 
                                     resp_span.set_attribute("response.status", "failure")
                                     resp_span.set_attribute("response.message", response.text)
 
                         except requests.exceptions.RequestException as e:
                             http_span.set_attribute("http.error", str(e))
-                            app.logger.error(f"Error while calling warehouse service: {e}")
+                            app.logger.error("Error while calling warehouse service: %s", e)
                             return jsonify({"status": "failure", "message": "Error contacting warehouse service"}), 500
 
-                return jsonify({"status": "success", "message": "Inventory available and reserved"}), 200
+                # The warehouse locations are needed to release the reservation again
+                allocations = response.json().get('allocations') if response.status_code == 200 else None
+                return jsonify({
+                    "status": "success",
+                    "message": "Inventory available and reserved",
+                    "allocations": allocations
+                }), 200
             else:
                 return jsonify({"status": "failure", "message": "Insufficient inventory"}), 400
-        
-if __name__ == '__main__':
+
+@app.route('/inventory/check/items', methods=['POST'])
+def inventory_check_items():
+    """Check and reserve every line item of one order, all or nothing."""
+    items = request.get_json().get('items', [])
+    if not valid_items(items):
+        return jsonify({"status": "failure", "message": "Items need an item_id and a positive quantity"}), 400
+    app.logger.debug('inventory-service received an order with %s items', len(items))
+    tracer = trace.get_tracer(__name__)
+
+    with tracer.start_as_current_span("check_availability") as current_span:
+        current_span.set_attribute("inventory.item_count", len(items))
+        app.logger.debug("inventory-service about to make a database query")
+
+        # One query for the stock of all items and one transaction for the updates
+        with tracer.start_as_current_span("query_inventory_database") as span:
+            span.set_attribute("db.query", LEVELS_QUERY.text)
+            span.set_attribute("inventory.item_ids", [item['item_id'] for item in items])
+            span.set_attribute("inventory.requested_quantities", [item['quantity'] for item in items])
+            short = reserve_items(items)
+            if not short:
+                db.session.commit()
+            span.set_attribute("inventory.reserved", not short)
+            if short:
+                return jsonify({"status": "failure", "message": "Insufficient inventory", "item_ids": short}), 400
+
+        # A single call to Warehouse Service for all items
+        with tracer.start_as_current_span("inventory_to_warehouse_call") as span:
+            span.set_attribute("inventory.item_count", len(items))
+            warehouse_url = warehouse_service.url('/warehouse/reserve/items')
+            span.set_attribute("inventory.warehouse_url", warehouse_url)
+            warehouse_items = [{"item_id": item['item_id'], "quantity": item['quantity']} for item in items]
+
+            with tracer.start_as_current_span("http_post_warehouse_reserve") as http_span:
+                try:
+                    response = warehouse_service.post('/warehouse/reserve/items', json={"items": warehouse_items})
+                    http_span.set_attribute("http.method", "POST")
+                    http_span.set_attribute("http.url", warehouse_url)
+                    http_span.set_attribute("http.status_code", response.status_code)
+                    telemetry.record_body(http_span, "http.request_body", {"items": warehouse_items})
+                    telemetry.record_body(http_span, "http.response_body", lambda: response.text)
+                    http_span.set_attribute("http.response_time", response.elapsed.total_seconds())
+                except requests.exceptions.RequestException as e:
+                    http_span.set_attribute("http.error", str(e))
+                    app.logger.error("Error while calling warehouse service: %s", e)
+                    response = None
+
+            if response is None or response.status_code != 200:
+                # All or nothing: give the stock back when the warehouse could not reserve it
+                if response is not None:
+                    app.logger.debug('[inventory-service] %s status code : %s', response.status_code, response.text)
+                span.set_attribute("response.status", "failure")
+                release_items(items)
+                db.session.commit()
+                if response is None:
+                    return jsonify({"status": "failure", "message": "Error contacting warehouse service"}), 500
+                if response.status_code == 400:
+                    return jsonify({"status": "failure", "message": "Insufficient inventory in warehouse"}), 400
+                return jsonify({"status": "failure", "message": "Warehouse reservation failed"}), 500
+            span.set_attribute("response.status", "success")
+
+        # The warehouse locations are needed to release the reservation again
+        return jsonify({
+            "status": "success",
+            "message": "Inventory available and reserved",
+            "items": response.json().get('items')
+        }), 200
+
+@app.route('/inventory/check/batch', methods=['POST'])
+def inventory_check_batch():
+    items = request.get_json().get('items', [])
+    app.logger.debug('inventory-service received a batch of %s items', len(items))
+    tracer = trace.get_tracer(__name__)
+
+    with tracer.start_as_current_span("check_availability_batch") as batch_span:
+        batch_span.set_attribute("batch.size", len(items))
+        app.logger.debug("inventory-service about to make a database query")
+
+        results = [None] * len(items)
+        reserved = []
+
+        # One transaction for the whole batch
+        with tracer.start_as_current_span("query_inventory_database") as span:
+            span.set_attribute("db.query", RESERVE_QUERY.text)
+
+            for index, item in enumerate(items):
+                # An entry is a single item or the line items of one order
+                lines = item.get('items') or [item]
+                links = tracing.item_links(item.get('trace_context'))
+                with tracer.start_as_current_span("check_availability", links=links) as item_span:
+                    item_span.set_attribute("batch.index", index)
+                    item_span.set_attribute("inventory.item_ids", [line['item_id'] for line in lines])
+                    item_span.set_attribute("inventory.requested_quantities", [line['quantity'] for line in lines])
+                    reserved_item = valid_items(lines) and reserve_lines(lines)
+                    item_span.set_attribute("inventory.reserved", reserved_item)
+                    if reserved_item:
+                        results[index] = {"status": "success", "message": "Inventory available and reserved"}
+                        reserved.append({
+                            "index": index,
+                            "lines": lines,
+                            "trace_context": tracing.item_context(),
+                        })
+                    else:
+                        results[index] = {"status": "failure", "message": "Insufficient inventory"}
+
+            db.session.commit()
+
+        # Make a single call to Warehouse Service for every reserved item
+        failed = []
+        if reserved:
+            with tracer.start_as_current_span("inventory_to_warehouse_batch_call") as span:
+                span.set_attribute("batch.size", len(reserved))
+                try:
+                    response = warehouse_service.post(
+                        '/warehouse/reserve/batch',
+                        json={"items": [{
+                            "item_id": line['item_id'],
+                            "quantity": line['quantity'],
+                            "trace_context": each['trace_context'],
+                        } for each in reserved for line in each['lines']]}
+                    )
+                    span.set_attribute("http.status_code", response.status_code)
+                except requests.exceptions.RequestException as e:
+                    span.set_attribute("http.error", str(e))
+                    app.logger.error("Error while calling warehouse service: %s", e)
+                    response = None
+
+                if response is None or response.status_code != 200:
+                    # Holds the warehouse may have made before the error expire unconfirmed
+                    if response is not None:
+                        app.logger.error('[inventory-service] %s status code : %s', response.status_code, response.text)
+                    span.set_attribute("response.status", "failure")
+                    message = "Error contacting warehouse service" if response is None else "Warehouse reservation failed"
+                    for each in reserved:
+                        results[each['index']] = {"status": "failure", "message": message}
+                        failed.append(each)
+                else:
+                    span.set_attribute("response.status", "success")
+                    # The warehouse answers per line, the holds go back to the order they belong to
+                    line_results = iter(response.json()['results'])
+                    for each in reserved:
+                        lines = [(line, next(line_results, None) or {}) for line in each['lines']]
+                        allocated = [{
+                            "item_id": line['item_id'],
+                            "quantity": line['quantity'],
+                            "allocations": result.get('allocations') or [],
+                        } for line, result in lines if result.get('status') == 'success']
+                        if len(allocated) == len(lines):
+                            results[each['index']]["items"] = allocated
+                            continue
+                        # All or nothing per order, the lines the warehouse did reserve go back
+                        results[each['index']] = {"status": "failure", "message": "Insufficient inventory in warehouse"}
+                        each['allocated'] = allocated
+                        failed.append(each)
+                    span.set_attribute("inventory.warehouse_failures", len(failed))
+
+        if failed:
+            release_failed_orders(failed)
+
+        return jsonify({"status": "success", "results": results}), 200
+
+@app.route('/inventory/release', methods=['POST'])
+def inventory_release():
+    # items: [{"item_id": ..., "quantity": ..., "allocations": [...]}] as returned by /inventory/check/items
+    items = request.get_json().get('items', [])
+    if not valid_items(items):
+        return jsonify({"status": "failure", "message": "Items need an item_id and a positive quantity"}), 400
+    tracer = trace.get_tracer(__name__)
+
+    with tracer.start_as_current_span("release_inventory") as span:
+        span.set_attribute("inventory.item_ids", [item['item_id'] for item in items])
+        span.set_attribute("inventory.released_quantities", [item['quantity'] for item in items])
+        if not release_items(items):
+            db.session.rollback()
+            return jsonify({"status": "failure", "message": "Unknown item"}), 404
+        db.session.commit()
+
+        allocated = [item for item in items if item.get('allocations')]
+        if allocated:
+            error = release_allocations(allocated)
+            if error is not None:
+                return jsonify({"status": "failure", "message": error}), 500
+
+        return jsonify({"status": "success", "message": f"Released {len(items)} items"}), 200
+
+@app.route('/inventory/restock', methods=['POST'])
+def inventory_restock():
+    # items: [{"item_id": ..., "quantity": ...}], the stock of warehouse holds that expired
+    items = request.get_json().get('items', [])
+    if not valid_items(items):
+        return jsonify({"status": "failure", "message": "Items need an item_id and a positive quantity"}), 400
+    tracer = trace.get_tracer(__name__)
+
+    with tracer.start_as_current_span("restock_inventory") as span:
+        span.set_attribute("inventory.item_ids", [item['item_id'] for item in items])
+        span.set_attribute("inventory.restocked_quantities", [item['quantity'] for item in items])
+        # Unlike a release there is no caller to fail, the stock of items no
+        # longer sold here is dropped
+        if not release_items(items):
+            app.logger.warning('Restocked items include unknown items: %s', [item['item_id'] for item in items])
+        db.session.commit()
+        return jsonify({"status": "success", "message": f"Restocked {len(items)} items"}), 200
+
+@app.route('/inventory/confirm', methods=['POST'])
+def inventory_confirm():
+    # items: [{"item_id": ..., "quantity": ..., "allocations": [...]}] as returned by /inventory/check/items
+    items = request.get_json().get('items', [])
+    tracer = trace.get_tracer(__name__)
+
+    with tracer.start_as_current_span("confirm_reservation") as span:
+        hold_ids = [each['hold_id'] for item in items for each in item.get('allocations') or [] if each.get('hold_id')]
+        span.set_attribute("inventory.item_ids", [item['item_id'] for item in items])
+        span.set_attribute("inventory.hold_count", len(hold_ids))
+        if not hold_ids:
+            return jsonify({"status": "success", "message": "Nothing to confirm"}), 200
+        try:
+            # Confirming a hold twice is harmless, the call can be retried
+            response = warehouse_service.post('/warehouse/confirm', json={"hold_ids": hold_ids}, idempotent=True)
+        except requests.exceptions.RequestException as e:
+            app.logger.error("Error while calling warehouse service: %s", e)
+            return jsonify({"status": "failure", "message": "Error contacting warehouse service"}), 500
+        if response.status_code != 200:
+            app.logger.error('Warehouse confirm failed: %s', response.text)
+            return jsonify(response.json()), response.status_code
+        # Holds that expired or were released before the confirmation
+        lost = response.json().get('lost') or []
+        span.set_attribute("inventory.lost_holds", len(lost))
+        return jsonify({"status": "success", "message": f"Confirmed {len(items)} items", "lost": lost}), 200
+
+def init_db():
+    """Create the schema and seed data, runs once before the server starts."""
     with app.app_context():
         db.create_all()
         insert_query = text(
@@ -141,4 +480,7 @@ if __name__ == '__main__':
             {"id": "sku001", "description": "test inventory", "availability": int(INVENTORY_AVAILABILITY)},
         )
         db.session.commit()
+
+if __name__ == '__main__':
+    init_db()
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -1,163 +1,627 @@
 import os
 import sys
 import time
-import random
+import uuid
 import requests
+import contextvars
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from opentelemetry import trace
-from opentelemetry.instrumentation.flask import FlaskInstrumentor
-from opentelemetry.instrumentation.sqlalchemy import SQLAlchemyInstrumentor
-from opentelemetry.instrumentation.requests import RequestsInstrumentor
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.resources import SERVICE_NAME, Resource
-from opentelemetry.sdk.trace import TracerProvider
+from common import faults, http_client, logs, metrics, profiling, telemetry, tracing
+import orders
 
-TEMPO_HOSTNAME = os.getenv('TEMPO_HOSTNAME', 'tempo')
-TEMPO_PORT     = os.getenv('TEMPO_PORT', '4317')
+INVENTORY_SERVICE_URL = os.getenv('INVENTORY_SERVICE_URL', 'http://inventory-service:5000')
+PAYMENT_SERVICE_URL = os.getenv('PAYMENT_SERVICE_URL', 'http://payment-service:5000')
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:////sqlite.db')
+# sequential: inventory, then payment; concurrent: both at once with compensation
+ORDER_ORCHESTRATION = os.getenv('ORDER_ORCHESTRATION', 'sequential')
+ORDER_STAGE_WORKERS = os.getenv('ORDER_STAGE_WORKERS', 32)
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////sqlite.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 db = SQLAlchemy(app)
 
-trace.set_tracer_provider(TracerProvider(
-    resource=Resource.create({SERVICE_NAME: os.environ['SERVICE_NAME']})
-))
+# Configure tracing and instrument Flask, see common/telemetry.py
+telemetry.init_tracing(os.environ['SERVICE_NAME'])
+telemetry.init_app(app, sqlalchemy=True)
 
-otlp_exporter = OTLPSpanExporter(
-    endpoint=f"{TEMPO_HOSTNAME}:{TEMPO_PORT}",
-    insecure=True
-)
+# JSON logs with the trace context of every record, see common/logs.py
+logs.init_logging(os.environ['SERVICE_NAME'], app)
 
-trace.get_tracer_provider().add_span_processor(
-    BatchSpanProcessor(otlp_exporter)
-)
+# RED metrics with trace exemplars at GET /metrics, see common/metrics.py
+metrics.init_app(app, db)
 
-# Instrument Flask
-FlaskInstrumentor().instrument_app(app)
-SQLAlchemyInstrumentor().instrument()
-RequestsInstrumentor().instrument()
+# Sampling profiler at GET /debug/profile, see common/profiling.py
+profiling.init_app(app)
+
+# Latency and fault injection per route and downstream, see common/faults.py
+faults.init_app(app)
+
+# Pooled keep-alive clients for downstream services
+inventory_service = http_client.client('inventory-service', INVENTORY_SERVICE_URL)
+payment_service = http_client.client('payment-service', PAYMENT_SERVICE_URL)
+http_client.init_app(app)
+
+# Runs the payment stage next to the inventory stage in concurrent mode
+stage_pool = ThreadPoolExecutor(max_workers=int(ORDER_STAGE_WORKERS), thread_name_prefix='order-stage')
 
 # Order model
 class Order(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    description = db.Column(db.String(80))
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.String)
+    # Line items: [{"item_id": ..., "quantity": ...}]
+    items = db.Column(db.JSON, nullable=False)
+    amount = db.Column(db.String)
+    payment_method = db.Column(db.String)
+    status = db.Column(db.String(20), nullable=False, index=True)
+    failure_reason = db.Column(db.String, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+# Unique, time-ordered order ids, batched order writes and cached order reads
+order_ids = orders.SnowflakeGenerator()
+order_writer = orders.OrderWriter(app, db, Order)
+order_cache = orders.OrderCache()
+
+def order_items(payload):
+    """The line items of an order, None when one of them is not an item_id
+    with a positive quantity."""
+    items = payload.get('items') or []
+    if not isinstance(items, list):
+        return None
+    lines = []
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('item_id'), str):
+            return None
+        quantity = item.get('quantity')
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity <= 0:
+            return None
+        lines.append({"item_id": item['item_id'], "quantity": quantity})
+    return lines
+
+def payment_method_of(payload):
+    # Stored as a string like the other columns, missing stays missing so
+    # the payment service still rejects it
+    payment_method = payload.get('payment_method')
+    return None if payment_method is None else str(payment_method)
+
+def new_order(order_id, payload, items):
+    order = {
+        "id": order_id,
+        "user_id": str(payload.get('user_id')),
+        "items": items,
+        "amount": str(payload.get('amount')),
+        "payment_method": payment_method_of(payload),
+        "status": orders.CREATED,
+        "failure_reason": None,
+        "created_at": datetime.utcnow(),
+    }
+    order_writer.save(order)
+    return order
+
+def update_order(order, status, failure_reason=None):
+    order['status'] = status
+    order['failure_reason'] = failure_reason
+    order_writer.save(order)
+    order_cache.invalidate(order['id'])
+
+def read_order(order_id):
+    """The (view, etag) of an order from the cache, the write-behind buffer
+    or the database, None for unknown orders."""
+    cached = order_cache.get(order_id)
+    if cached is not None:
+        trace.get_current_span().set_attribute("order.cache_hit", True)
+        return cached
+    trace.get_current_span().set_attribute("order.cache_hit", False)
+    order = order_writer.get(order_id)
+    if order is None:
+        row = db.session.get(Order, order_id)
+        if row is None:
+            return None
+        order = {column.name: getattr(row, column.name) for column in Order.__table__.columns}
+    return order_cache.put(order)
+
+class StageResult:
+    """Outcome of the inventory or the payment stage of an order."""
+
+    def __init__(self, ok, order_status=None, message=None, status_code=200, category=None, data=None):
+        self.ok = ok
+        self.order_status = order_status
+        self.message = message
+        self.status_code = status_code
+        self.category = category
+        self.data = data or {}
+
+def inventory_stage(items):
+    tracer = trace.get_tracer(__name__)
+
+    # Call 1: Inventory Service, every line item in a single all-or-nothing call
+    with tracer.start_as_current_span("inventory_service_call") as span:
+        span.set_attribute("inventory.skus", [item['item_id'] for item in items])
+        span.set_attribute("inventory.requested_quantities", [item['quantity'] for item in items])
+        app.logger.debug('order-service makes a post request to inventory-service')
+        try:
+            response = inventory_service.post("/inventory/check/items",
+                json={'items': items}, headers={"Content-Type": "application/json"}
+            )
+        except requests.exceptions.RequestException as e:
+            app.logger.error("Error while calling inventory service: %s", e)
+            return StageResult(False, orders.FAILED, "Error contacting inventory service", 500)
+
+        # Handle inventory service response
+        if response.status_code != 200:
+            app.logger.error('Inventory check failed: %s', response.text)
+            return StageResult(False, orders.OUT_OF_STOCK, "Inventory capacity failure", 400)
+        return StageResult(True, data=response.json())
+
+def payment_stage(order_id, user_id, payment_method, amount, idempotency_key):
+    tracer = trace.get_tracer(__name__)
+
+    # Call 2: Payment Authorization
+    with tracer.start_as_current_span("order_to_payment_authorization") as span:
+        span.set_attribute("order.order_id", order_id)
+        span.set_attribute("order.user_id", user_id)
+        span.set_attribute("order.payment_method", payment_method)
+        span.set_attribute("order.amount", amount)
+        payment_url = payment_service.url('/payment/authorize')
+        span.set_attribute("order.payment_url", payment_url)
+
+        with tracer.start_as_current_span("http_post_payment_authorization") as http_span:
+            try:
+                response = payment_service.post(
+                    '/payment/authorize',
+                    json={
+                        "order_id": order_id,
+                        "user_id": user_id,
+                        "payment_method": payment_method,
+                        "amount": amount
+                    },
+                    headers={"Idempotency-Key": idempotency_key}
+                )
+            except requests.exceptions.RequestException as e:
+                http_span.set_attribute("http.error", str(e))
+                app.logger.error("Error while calling payment service: %s", e)
+                return StageResult(False, orders.FAILED, "Error contacting payment service", 500)
+
+            http_span.set_attribute("http.method", "POST")
+            http_span.set_attribute("http.url", payment_url)
+            http_span.set_attribute("http.status_code", response.status_code)
+            telemetry.record_body(http_span, "http.request_body", {
+                "order_id": order_id,
+                "user_id": user_id,
+                "payment_method": payment_method,
+                "amount": amount
+            })
+            telemetry.record_body(http_span, "http.response_body", lambda: response.text)
+            http_span.set_attribute("http.response_time", response.elapsed.total_seconds())
+
+            with tracer.start_as_current_span("payment_response_handling") as resp_span:
+                if response.status_code == 200:
+                    resp_span.set_attribute("response.status", "success")
+                    resp_span.set_attribute("response.message", "Payment authorized")
+                    return StageResult(True)
+
+                resp_span.set_attribute("response.status", "failure")
+                resp_span.set_attribute("response.message", response.text)
+                app.logger.error('payment authorization error: %s', response.text)
+                app.logger.error('error_reason: %s', response.json())
+                return StageResult(
+                    False, orders.PAYMENT_FAILED, "Payment authorization failed", 400,
+                    category=response.json().get('category')
+                )
+
+def release_inventory(reserved_items):
+    """Compensation: return a reservation whose payment failed."""
+    tracer = trace.get_tracer(__name__)
+    with tracer.start_as_current_span("release_inventory") as span:
+        span.set_attribute("order.compensation", "release_inventory")
+        try:
+            response = inventory_service.post('/inventory/release', json={"items": reserved_items})
+            span.set_attribute("http.status_code", response.status_code)
+            if response.status_code != 200:
+                app.logger.error('Inventory release failed: %s', response.text)
+        except requests.exceptions.RequestException as e:
+            app.logger.error("Error while releasing inventory: %s", e)
+
+def send_confirmations(entries):
+    """Confirm the reservations of a batch of completed orders with one
+    call, the span links to the order of every entry."""
+    tracer = trace.get_tracer(__name__)
+    links = [trace.Link(span_context) for _, span_context in entries if span_context.is_valid]
+    with tracer.start_as_current_span("confirm_inventory_batch", links=links) as span:
+        span.set_attribute("batch.size", len(entries))
+        response = inventory_service.post('/inventory/confirm', json={
+            "items": [item for items, _ in entries for item in items]
+        }, idempotent=True)
+        span.set_attribute("http.status_code", response.status_code)
+        if response.status_code >= 500:
+            raise requests.exceptions.HTTPError(f"inventory confirm failed: {response.text}")
+        if response.status_code != 200:
+            app.logger.error('Inventory confirm failed: %s', response.text)
+            return 0
+        # The other holds are confirmed, these expired or were released and
+        # their stock may be sold again
+        lost = set(response.json().get('lost') or [])
+        if not lost:
+            return 0
+        span.set_attribute("order.lost_holds", len(lost))
+        affected = 0
+        for items, span_context in entries:
+            order_lost = [
+                each['hold_id'] for item in items for each in item.get('allocations') or []
+                if each.get('hold_id') in lost
+            ]
+            if order_lost:
+                affected += 1
+                app.logger.error('Holds %s of trace %s expired before their confirmation',
+                                 order_lost, format(span_context.trace_id, '032x'))
+        return affected
+
+# Unconfirmed warehouse holds expire, completed orders confirm theirs behind the request
+hold_confirmer = orders.HoldConfirmer(app, send_confirmations)
+
+def confirmations_backed_up():
+    # Reserving more stock would only add to the queue of unconfirmed holds
+    app.logger.warning('Turning away an order, %s orders wait for their confirmation', hold_confirmer.max_pending)
+    return jsonify({
+        "status": "failure",
+        "message": "Inventory confirmations are backed up, try again later"
+    }), 503, {"Retry-After": "1"}
+
+def confirm_inventory(reserved_items):
+    if reserved_items:
+        hold_confirmer.confirm(reserved_items, trace.get_current_span().get_span_context())
+
+def void_payment(order_id, idempotency_key):
+    """Compensation: void an authorization whose order is out of stock."""
+    tracer = trace.get_tracer(__name__)
+    with tracer.start_as_current_span("void_payment") as span:
+        span.set_attribute("order.compensation", "void_payment")
+        try:
+            response = payment_service.post('/payment/void', json={
+                "order_id": order_id,
+                "idempotency_key": idempotency_key
+            }, idempotent=True)
+            span.set_attribute("http.status_code", response.status_code)
+            if response.status_code != 200:
+                app.logger.error('Payment void failed: %s', response.text)
+        except requests.exceptions.RequestException as e:
+            app.logger.error("Error while voiding payment: %s", e)
+
+def run_stages_concurrently(items, payment_args):
+    """Reserve inventory and authorize the payment at the same time, and undo
+    the side that succeeded when the other one failed."""
+    order_id, idempotency_key = payment_args[0], payment_args[-1]
+    # The payment branch runs in the pool with the current span as parent
+    context = contextvars.copy_context()
+    payment_future = stage_pool.submit(context.run, payment_stage, *payment_args)
+    inventory = inventory_stage(items)
+    payment = payment_future.result()
+
+    if inventory.ok and not payment.ok:
+        release_inventory(inventory.data.get('items'))
+    # An authorization that failed with an error may still have gone through
+    if not inventory.ok and (payment.ok or payment.order_status == orders.FAILED):
+        void_payment(order_id, idempotency_key)
+    return inventory, payment
 
 @app.route('/order', methods=['POST'])
 def create_order():
-    headers = {"Content-Type": "application/json"}
     payload = request.get_json()
-    item_id = payload.get('items')[0].get('item_id')
-    quantity = payload.get('items')[0].get('quantity')
-    payment_method = payload.get('payment_method')
+    items = order_items(payload)
+    payment_method = payment_method_of(payload)
     amount = payload.get('amount')
     user_id = payload.get('user_id')
 
     app.logger.debug('order-service received a post request')
+    if items is None:
+        return jsonify({"status": "failure", "message": "Items need an item_id and a positive quantity"}), 400
+    if not items:
+        return jsonify({"status": "failure", "message": "Order has no items"}), 400
+    if hold_confirmer.full():
+        return confirmations_backed_up()
     tracer = trace.get_tracer(__name__)
 
-    with tracer.start_as_current_span("create_order"):
-        # Access the current span
-        current_span = trace.get_current_span()
+    with tracer.start_as_current_span("create_order") as current_span:
+        trace_id_hex = format(current_span.get_span_context().trace_id, '032x')
 
-        # Get the trace ID from the current span
-        trace_id = current_span.get_span_context().trace_id
+        order_id = order_ids.next_id()
+        order = new_order(order_id, payload, items)
+        current_span.set_attribute("order.order_id", order_id)
+        current_span.set_attribute("order.item_count", len(items))
+        current_span.set_attribute("order.orchestration", ORDER_ORCHESTRATION)
+        # Retries of the payment call reuse this key so the payment is authorized only once
+        idempotency_key = uuid.uuid4().hex
+        payment_args = (order_id, user_id, payment_method, amount, idempotency_key)
 
-        # Format the trace ID into a hexadecimal string
-        trace_id_hex = format(trace_id, '032x')
+        if ORDER_ORCHESTRATION == 'concurrent':
+            inventory, payment = run_stages_concurrently(items, payment_args)
+        else:
+            inventory, payment = inventory_stage(items), None
+            if inventory.ok:
+                update_order(order, orders.RESERVED)
+                payment = payment_stage(*payment_args)
+                if not payment.ok:
+                    release_inventory(inventory.data.get('items'))
 
-        # Log the trace ID
-        app.logger.info(f"logged trace_id={trace_id_hex}")
+        failed = next((stage for stage in (inventory, payment) if stage is not None and not stage.ok), None)
+        if failed is not None:
+            update_order(order, failed.order_status, failed.category or failed.message)
+            body = {
+                "status": "failure",
+                "message": failed.message,
+                "order_id": order_id,
+                "trace_id": trace_id_hex
+            }
+            if failed.category is not None:
+                body["category"] = failed.category
+            return jsonify(body), failed.status_code
 
-        # TODO: capture order
-        order_id = random.randint(1,1000)
+        # Payment was authorized
+        update_order(order, orders.COMPLETED)
+        confirm_inventory(inventory.data.get('items'))
+        return jsonify({
+            "status": "success",
+            "message": f"Order {order_id} created and payment authorized",
+            "order_id": order_id,
+            "trace_id": trace_id_hex
+        }), 200
 
-        # Call 1: Inventory Service: create a new span for the inventory call
-        with tracer.start_as_current_span("inventory_service_call") as span:
-            span.set_attribute("inventory.sku", item_id)
-            span.set_attribute("inventory.requested_quantity", quantity)
-            app.logger.debug(f'order-service makes a post request to inventory-service trace_id={trace_id_hex}')
+@app.route('/order/batch', methods=['POST'])
+def create_orders_batch():
+    headers = {"Content-Type": "application/json"}
+    submitted = request.get_json().get('orders', [])
+    app.logger.debug('order-service received a batch of %s orders', len(submitted))
+    if hold_confirmer.full():
+        return confirmations_backed_up()
+    tracer = trace.get_tracer(__name__)
+
+    with tracer.start_as_current_span("create_order_batch") as batch_span:
+        batch_span.set_attribute("batch.size", len(submitted))
+        trace_id_hex = format(batch_span.get_span_context().trace_id, '032x')
+
+        results = [None] * len(submitted)
+        accepted = []
+
+        # Every order gets its own span linked to the order span of the caller
+        for index, order in enumerate(submitted):
+            links = tracing.item_links(order.get('trace_context'))
+            with tracer.start_as_current_span("create_order", links=links) as span:
+                span.set_attribute("batch.index", index)
+                items = order_items(order)
+                if items is None:
+                    results[index] = {"status": "failure", "message": "Items need an item_id and a positive quantity"}
+                    continue
+                if not items:
+                    results[index] = {"status": "failure", "message": "Order has no items"}
+                    continue
+                order_id = order_ids.next_id()
+                span.set_attribute("order.order_id", order_id)
+                span.set_attribute("order.user_id", order.get('user_id'))
+                accepted.append({
+                    "index": index,
+                    "order_id": order_id,
+                    "order": order,
+                    "record": new_order(order_id, order, items),
+                    "trace_context": tracing.item_context(),
+                })
+
+        if not accepted:
+            return batch_response(batch_span, results, trace_id_hex)
+
+        # Call 1: Inventory Service, a single round trip for the whole batch
+        with tracer.start_as_current_span("inventory_service_batch_call") as span:
+            span.set_attribute("batch.size", len(accepted))
+            app.logger.debug('order-service makes a batch request to inventory-service')
             try:
-                response = requests.post("http://inventory-service:5000/inventory/check", 
-                    json={'item_id': item_id, 'quantity': quantity}, headers=headers
+                response = inventory_service.post("/inventory/check/batch",
+                    json={"items": [{
+                        "items": each['record']['items'],
+                        "trace_context": each['trace_context'],
+                    } for each in accepted]},
+                    headers=headers
                 )
-
-                # Handle inventory service response
                 if response.status_code != 200:
-                    app.logger.error(f'Inventory check failed: {response.text}')
+                    app.logger.error('Inventory batch check failed: %s', response.text)
+                    update_orders(accepted, orders.OUT_OF_STOCK, "Inventory capacity failure")
                     return jsonify({
                         "status": "failure",
                         "message": "Inventory capacity failure",
                         "trace_id": trace_id_hex
                     }), 400
-
             except requests.exceptions.RequestException as e:
-                app.logger.error(f"Error while calling inventory service: {e}")
+                app.logger.error("Error while calling inventory service: %s", e)
+                update_orders(accepted, orders.FAILED, "Error contacting inventory service")
                 return jsonify({"status": "failure", "message": "Error contacting inventory service"}), 500
 
-        # Call 2: Payment Authorization
-        with tracer.start_as_current_span("order_to_payment_authorization") as span:
-            span.set_attribute("order.order_id", order_id)
-            span.set_attribute("order.user_id", user_id)
-            span.set_attribute("order.payment_method", payment_method)
-            span.set_attribute("order.amount", amount)
-            payment_url = 'http://payment-service:5000/payment/authorize'
-            span.set_attribute("order.payment_url", payment_url)
-
-            with tracer.start_as_current_span("http_post_payment_authorization") as http_span:
-                try:
-                    response = requests.post(
-                        payment_url,
-                        json={
-                            "order_id": order_id,
-                            "user_id": user_id,
-                            "payment_method": payment_method,
-                            "amount": amount
-                        }
-                    )
-
-                    http_span.set_attribute("http.method", "POST")
-                    http_span.set_attribute("http.url", payment_url)
-                    http_span.set_attribute("http.status_code", response.status_code)
-                    http_span.set_attribute("http.request_body", f"order_id={order_id}, user_id={user_id}, payment_method={payment_method}, amount={amount}")
-                    http_span.set_attribute("http.response_body", response.text)
-                    http_span.set_attribute("http.response_time", response.elapsed.total_seconds())
-
-                    with tracer.start_as_current_span("payment_response_handling") as resp_span:
-                        if response.status_code == 200:
-                            resp_span.set_attribute("response.status", "success")
-                            resp_span.set_attribute("response.message", "Payment authorized")
-                        else:
-                            resp_span.set_attribute("response.status", "failure")
-                            resp_span.set_attribute("response.message", response.text)
-
-                        # Handle the response from the Payment Service
-                        if response.status_code == 200:
-                            # Payment was authorized
-                            # Update the order status, send confirmation, etc.
-                            return jsonify({
-                                "status": "success", 
-                                "message": f"Order {order_id} created and payment authorized",
-                                "trace_id": trace_id_hex
-                            }), 200
-                        else:
-                            # Payment failed
-                            app.logger.error(f'payment authorization error: {response.text}')
-                            app.logger.error(f'error_reason: {response.json()}')
-                            return jsonify({
-                                "status": "failure",
-                                "message": "Payment authorization failed",
-                                "category": response.json().get('category'),
-                                "trace_id": trace_id_hex
-                            }), 400
-
-                except requests.exceptions.RequestException as e:
-                    http_span.set_attribute("http.error", str(e))
-                    app.logger.error(f"Error while calling payment service: {e}")
-                    return jsonify({"status": "failure", "message": "Error contacting payment service"}), 500
+            inventory_results = batch_results(response, len(accepted))
+            if inventory_results is None:
+                app.logger.error('Inventory batch check returned results for other orders: %s', response.text)
+                update_orders(accepted, orders.FAILED, "Invalid inventory response")
+                reserved = reserved_in(response)
+                if reserved:
+                    release_inventory(reserved)
+                return jsonify({
+                    "status": "failure",
+                    "message": "Invalid inventory response",
+                    "trace_id": trace_id_hex
+                }), 502
 
-if __name__ == '__main__':
+            in_stock = []
+            for each, result in zip(accepted, inventory_results):
+                if result['status'] == 'success':
+                    update_order(each['record'], orders.RESERVED)
+                    each['reserved_items'] = result.get('items') or []
+                    in_stock.append(each)
+                else:
+                    update_order(each['record'], orders.OUT_OF_STOCK, "Inventory capacity failure")
+                    results[each['index']] = {
+                        "status": "failure",
+                        "message": "Inventory capacity failure",
+                        "order_id": each['order_id']
+                    }
+
+        if not in_stock:
+            return batch_response(batch_span, results, trace_id_hex)
+
+        # Call 2: Payment Authorization, a single round trip for the whole batch
+        with tracer.start_as_current_span("order_to_payment_authorization_batch") as span:
+            span.set_attribute("batch.size", len(in_stock))
+            for each in in_stock:
+                each['idempotency_key'] = uuid.uuid4().hex
+            try:
+                response = payment_service.post(
+                    '/payment/authorize/batch',
+                    json={"payments": [{
+                        "order_id": each['order_id'],
+                        "user_id": each['order'].get('user_id'),
+                        "payment_method": each['record']['payment_method'],
+                        "amount": each['order'].get('amount'),
+                        "idempotency_key": each['idempotency_key'],
+                        "trace_context": each['trace_context'],
+                    } for each in in_stock]},
+                    headers=headers
+                )
+                if response.status_code != 200:
+                    app.logger.error('payment batch authorization error: %s', response.text)
+                    update_orders(in_stock, orders.PAYMENT_FAILED, "Payment authorization failed")
+                    release_inventory([item for each in in_stock for item in each['reserved_items']])
+                    return jsonify({
+                        "status": "failure",
+                        "message": "Payment authorization failed",
+                        "trace_id": trace_id_hex
+                    }), 400
+            except requests.exceptions.RequestException as e:
+                app.logger.error("Error while calling payment service: %s", e)
+                update_orders(in_stock, orders.FAILED, "Error contacting payment service")
+                release_inventory([item for each in in_stock for item in each['reserved_items']])
+                # The authorizations may still have gone through
+                for each in in_stock:
+                    void_payment(each['order_id'], each['idempotency_key'])
+                return jsonify({"status": "failure", "message": "Error contacting payment service"}), 500
+
+            payment_results = batch_results(response, len(in_stock))
+            if payment_results is None:
+                app.logger.error('payment batch authorization returned results for other orders: %s', response.text)
+                update_orders(in_stock, orders.FAILED, "Invalid payment response")
+                release_inventory([item for each in in_stock for item in each['reserved_items']])
+                # Which authorizations went through is unknown
+                for each in in_stock:
+                    void_payment(each['order_id'], each['idempotency_key'])
+                return jsonify({
+                    "status": "failure",
+                    "message": "Invalid payment response",
+                    "trace_id": trace_id_hex
+                }), 502
+
+            completed = []
+            declined = []
+            for each, result in zip(in_stock, payment_results):
+                order_id = each['order_id']
+                if result['status'] == 'success':
+                    update_order(each['record'], orders.COMPLETED)
+                    completed.extend(each['reserved_items'])
+                    results[each['index']] = {
+                        "status": "success",
+                        "message": f"Order {order_id} created and payment authorized",
+                        "order_id": order_id
+                    }
+                else:
+                    update_order(each['record'], orders.PAYMENT_FAILED, result.get('category'))
+                    declined.extend(each['reserved_items'])
+                    results[each['index']] = {
+                        "status": "failure",
+                        "message": "Payment authorization failed",
+                        "category": result.get('category'),
+                        "order_id": order_id
+                    }
+
+        # The stock of the declined orders goes back with one release
+        if declined:
+            release_inventory(declined)
+
+        # The reservations of every completed order are kept with one confirmation
+        confirm_inventory(completed)
+
+        return batch_response(batch_span, results, trace_id_hex)
+
+def batch_results(response, expected):
+    """The per-order results of a batch response, None unless there is one
+    result for each of the expected orders."""
+    try:
+        body = response.json()
+    except ValueError:
+        return None
+    results = body.get('results') if isinstance(body, dict) else None
+    if not isinstance(results, list) or len(results) != expected:
+        return None
+    if not all(isinstance(result, dict) for result in results):
+        return None
+    return results
+
+def reserved_in(response):
+    """The reserved items of the successful results of a batch response
+    that cannot be matched to its orders."""
+    try:
+        results = response.json().get('results')
+    except (ValueError, AttributeError):
+        return []
+    if not isinstance(results, list):
+        return []
+    return [
+        item for result in results
+        if isinstance(result, dict) and result.get('status') == 'success'
+        for item in result.get('items') or []
+    ]
+
+def update_orders(entries, status, failure_reason):
+    for each in entries:
+        update_order(each['record'], status, failure_reason)
+
+@app.route('/order/<int:order_id>', methods=['GET'])
+def get_order(order_id):
+    entry = read_order(order_id)
+    if entry is None:
+        return jsonify({"status": "failure", "message": f"Order {order_id} not found"}), 404
+    view, etag = entry
+    # Polling clients send the ETag they have and get an empty 304 while
+    # the order is unchanged
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(view)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/order/cache/stats', methods=['GET'])
+def order_cache_stats():
+    return jsonify(order_cache.stats()), 200
+
+@app.route('/order/writer/stats', methods=['GET'])
+def order_writer_stats():
+    return jsonify(order_writer.stats()), 200
+
+@app.route('/order/confirmer/stats', methods=['GET'])
+def hold_confirmer_stats():
+    return jsonify(hold_confirmer.stats()), 200
+
+def batch_response(batch_span, results, trace_id_hex):
+    succeeded = sum(1 for result in results if result['status'] == 'success')
+    batch_span.set_attribute("batch.succeeded", succeeded)
+    return jsonify({
+        "status": "success" if succeeded == len(results) else "partial",
+        "results": results,
+        "trace_id": trace_id_hex
+    }), 200
+
+def init_db():
+    """Create the schema and seed data, runs once before the server starts."""
     with app.app_context():
         db.create_all()
+
+if __name__ == '__main__':
+    init_db()
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,450 @@
+import os
+import json
+import time
+import atexit
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import OperationalError
+from common import telemetry
+
+# Order ids: 41 bits of milliseconds since ORDER_ID_EPOCH_MS, 10 bits of
+# worker id and a 12 bit sequence per millisecond
+ORDER_ID_EPOCH_MS = os.getenv('ORDER_ID_EPOCH_MS', 1704067200000)
+# Set a different node id (0-7) per order-service container
+ORDER_NODE_ID = os.getenv('ORDER_NODE_ID', 0)
+# Write-behind: orders are committed in batches by a background thread
+ORDER_FLUSH_INTERVAL_MS = os.getenv('ORDER_FLUSH_INTERVAL_MS', 100)
+ORDER_FLUSH_BATCH_SIZE = os.getenv('ORDER_FLUSH_BATCH_SIZE', 500)
+ORDER_MAX_PENDING = os.getenv('ORDER_MAX_PENDING', 10000)
+# Warehouse holds of completed orders are confirmed in batches behind the request
+ORDER_CONFIRM_INTERVAL_MS = os.getenv('ORDER_CONFIRM_INTERVAL_MS', 50)
+ORDER_CONFIRM_BATCH_SIZE = os.getenv('ORDER_CONFIRM_BATCH_SIZE', 200)
+# While this many orders wait for their confirmation new orders are turned
+# away, so the queue stays bounded when the warehouse is down
+ORDER_CONFIRM_MAX_PENDING = os.getenv('ORDER_CONFIRM_MAX_PENDING', 10000)
+# Orders read by id are cached per worker. An order that can still change
+# status in another worker is kept for ORDER_CACHE_PENDING_TTL_SECONDS only
+ORDER_CACHE_SIZE = os.getenv('ORDER_CACHE_SIZE', 10000)
+ORDER_CACHE_TTL_SECONDS = os.getenv('ORDER_CACHE_TTL_SECONDS', 300)
+ORDER_CACHE_PENDING_TTL_SECONDS = os.getenv('ORDER_CACHE_PENDING_TTL_SECONDS', 1)
+
+# Status lifecycle: created -> reserved -> completed, or one of the failures
+CREATED = 'created'
+RESERVED = 'reserved'
+COMPLETED = 'completed'
+OUT_OF_STOCK = 'out_of_stock'
+PAYMENT_FAILED = 'payment_failed'
+FAILED = 'failed'
+FINAL_STATUSES = (COMPLETED, OUT_OF_STOCK, PAYMENT_FAILED, FAILED)
+
+SEQUENCE_BITS = 12
+WORKER_BITS = 10
+PROCESS_BITS = 7
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+class SnowflakeGenerator:
+    """Time-ordered 63 bit ids, unique across the processes of all nodes.
+
+    The worker id is the node id and the slot of the gunicorn worker, which
+    the master hands out so no two live workers share one (WEB_WORKER_SLOT,
+    see common/gunicorn_conf.py). It is taken again after a fork. Outside
+    gunicorn only one process may issue ids, with slot 0.
+    """
+
+    def __init__(self, node_id=None, epoch_ms=None):
+        self.node_id = int(ORDER_NODE_ID if node_id is None else node_id)
+        if not 0 <= self.node_id < 1 << (WORKER_BITS - PROCESS_BITS):
+            raise ValueError(f"ORDER_NODE_ID must be within 0 and {(1 << (WORKER_BITS - PROCESS_BITS)) - 1}")
+        self.epoch_ms = int(ORDER_ID_EPOCH_MS if epoch_ms is None else epoch_ms)
+        self.lock = threading.Lock()
+        self.pid = None
+        self.unslotted_pid = None
+        self.worker_id = None
+        self.last_ms = -1
+        self.sequence = 0
+
+    def _now_ms(self):
+        return time.time_ns() // 1000000 - self.epoch_ms
+
+    def _slot(self):
+        slot = os.getenv('WEB_WORKER_SLOT')
+        if slot is None:
+            if self.unslotted_pid not in (None, self.pid):
+                raise RuntimeError("order ids are issued by a second process without a worker slot, "
+                                   "run the order-service with common/gunicorn_conf.py")
+            self.unslotted_pid = self.pid
+            return 0
+        if not 0 <= int(slot) < 1 << PROCESS_BITS:
+            raise RuntimeError(f"worker slot {slot} is out of range, at most {1 << PROCESS_BITS} workers issue order ids")
+        return int(slot)
+
+    def next_id(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.worker_id = self.node_id << PROCESS_BITS | self._slot()
+                self.last_ms = -1
+            now = self._now_ms()
+            # Never reuse a millisecond, also when the clock went backwards
+            if now < self.last_ms:
+                now = self.last_ms
+            if now == self.last_ms:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    while now <= self.last_ms:
+                        now = self._now_ms()
+            else:
+                self.sequence = 0
+            self.last_ms = now
+            return now << (WORKER_BITS + SEQUENCE_BITS) | self.worker_id << SEQUENCE_BITS | self.sequence
+
+class OrderWriter:
+    """Write-behind buffer for orders.
+
+    save() keeps the latest state of an order in memory, a background thread
+    upserts all pending orders in one transaction every flush interval, or
+    sooner when the batch size is reached. Status changes of an order that
+    was not flushed yet are written once. When max_pending orders wait, the
+    caller flushes itself. Pending orders are flushed at exit.
+
+    While the database is unavailable the orders stay queued. A batch it
+    rejects for another reason is written order by order, and the orders
+    that still fail are logged and dropped, so one bad row cannot block the
+    queue.
+
+    get() finds the orders of this worker until their commit succeeded, the
+    orders of a flush stay in in_flight meanwhile. Unflushed orders of other
+    workers are not visible.
+    """
+
+    def __init__(self, app, db, model, interval_ms=None, batch_size=None, max_pending=None):
+        self.app = app
+        self.db = db
+        self.model = model
+        self.interval = float(ORDER_FLUSH_INTERVAL_MS if interval_ms is None else interval_ms) / 1000.0
+        self.batch_size = int(ORDER_FLUSH_BATCH_SIZE if batch_size is None else batch_size)
+        self.max_pending = int(ORDER_MAX_PENDING if max_pending is None else max_pending)
+        self.pending = {}
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.thread_pid = None
+        self.flushes = 0
+        self.written = 0
+        self.failed_flushes = 0
+        self.dropped = 0
+        self.largest_batch = 0
+        self.flush_seconds_total = 0.0
+
+    def _ensure_thread(self):
+        # Started on first use, so every forked worker gets its own thread
+        if self.thread_pid == os.getpid():
+            return
+        self.thread_pid = os.getpid()
+        self.thread = threading.Thread(target=self._run, name='order-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+        telemetry.flush_before_shutdown(self.flush)
+
+    def save(self, order):
+        """Queue the current state of an order, a dict of Order columns."""
+        row = dict(order, updated_at=datetime.utcnow())
+        with self.lock:
+            self._ensure_thread()
+            self.pending[row['id']] = row
+            size = len(self.pending)
+        if size >= self.max_pending:
+            # The request goes on when the flush fails, its order stays queued
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('order write-behind flush failed')
+        elif size >= self.batch_size:
+            self.wakeup.set()
+
+    def get(self, order_id):
+        """State of an order that is not flushed yet, or None."""
+        with self.lock:
+            row = self.pending.get(order_id) or self.in_flight.get(order_id)
+            return dict(row) if row is not None else None
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('order write-behind flush failed')
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                self.in_flight, self.pending = self.pending, {}
+                rows = list(self.in_flight.values())
+            if not rows:
+                return 0
+            started = time.perf_counter()
+            try:
+                self._write(rows)
+                written = len(rows)
+            except OperationalError:
+                self._requeue(rows)
+                raise
+            except Exception:
+                self.app.logger.exception('order batch write failed, writing its %s orders one by one', len(rows))
+                written = self._write_each(rows)
+            with self.lock:
+                self.in_flight = {}
+                self.flushes += 1
+                self.written += written
+                self.largest_batch = max(self.largest_batch, len(rows))
+                self.flush_seconds_total += time.perf_counter() - started
+            return written
+
+    def _requeue(self, rows):
+        # Put the orders back unless a newer state was saved meanwhile
+        with self.lock:
+            for row in rows:
+                self.pending.setdefault(row['id'], row)
+            self.in_flight = {}
+            self.failed_flushes += 1
+
+    def _write_each(self, rows):
+        """Write a failed batch order by order, returns how many were written."""
+        written = 0
+        for position, row in enumerate(rows):
+            try:
+                self._write([row])
+                written += 1
+            except OperationalError:
+                self._requeue(rows[position:])
+                raise
+            except Exception:
+                self.app.logger.exception('dropping order %s, it cannot be written', row['id'])
+                with self.lock:
+                    self.dropped += 1
+        return written
+
+    def _write(self, rows):
+        statement = insert(self.model)
+        statement = statement.on_conflict_do_update(
+            index_elements=['id'],
+            set_={
+                'status': statement.excluded.status,
+                'failure_reason': statement.excluded.failure_reason,
+                'updated_at': statement.excluded.updated_at,
+            },
+        )
+        with self.app.app_context():
+            self.db.session.execute(statement, rows)
+            self.db.session.commit()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": len(self.pending),
+                "flushes": self.flushes,
+                "failed_flushes": self.failed_flushes,
+                "orders_written": self.written,
+                "orders_dropped": self.dropped,
+                "largest_batch": self.largest_batch,
+                "average_batch": round(self.written / self.flushes, 2) if self.flushes else 0.0,
+                "flush_seconds_total": round(self.flush_seconds_total, 6),
+            }
+
+class HoldConfirmer:
+    """Confirms the reservations of completed orders behind the request.
+
+    confirm() queues the reserved items of an order, a background thread
+    hands everything queued to send(entries), batch_size orders per call,
+    every flush interval, or sooner when the batch size is reached. Entries
+    of a send() that raised are queued again, an unconfirmed hold only
+    expires after the hold TTL of the warehouse. Queued entries are sent at exit. send() returns how many
+    orders lost holds that expired or were released before.
+
+    The queue holds max_pending orders, full() tells the order routes to
+    turn new orders away until it drains. Orders already past that check
+    are still queued, so it holds at most one more per request thread.
+    """
+
+    def __init__(self, app, send, interval_ms=None, batch_size=None, max_pending=None):
+        self.app = app
+        self.send = send
+        self.interval = float(ORDER_CONFIRM_INTERVAL_MS if interval_ms is None else interval_ms) / 1000.0
+        self.batch_size = int(ORDER_CONFIRM_BATCH_SIZE if batch_size is None else batch_size)
+        self.max_pending = int(ORDER_CONFIRM_MAX_PENDING if max_pending is None else max_pending)
+        self.pending = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread_pid = None
+        self.flushes = 0
+        self.confirmed = 0
+        self.lost = 0
+        self.failed_flushes = 0
+        self.rejected = 0
+
+    def _ensure_thread(self):
+        # Started on first use, so every forked worker gets its own thread
+        if self.thread_pid == os.getpid():
+            return
+        self.thread_pid = os.getpid()
+        threading.Thread(target=self._run, name='hold-confirmer', daemon=True).start()
+        atexit.register(self.flush)
+        telemetry.flush_before_shutdown(self.flush)
+
+    def confirm(self, items, span_context):
+        """Queue the reserved items of an order and the span context of the order."""
+        with self.lock:
+            self._ensure_thread()
+            self.pending.append((items, span_context))
+            size = len(self.pending)
+        if size >= self.batch_size:
+            self.wakeup.set()
+
+    def full(self):
+        """True while max_pending orders wait, counts the order turned away."""
+        with self.lock:
+            if len(self.pending) < self.max_pending:
+                return False
+            self.rejected += 1
+        self.wakeup.set()
+        return True
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('hold confirmation failed')
+
+    def flush(self):
+        """Send every queued entry, returns the number of orders sent."""
+        sent = 0
+        with self.flush_lock:
+            while True:
+                with self.lock:
+                    entries = self.pending[:self.batch_size]
+                    del self.pending[:self.batch_size]
+                if not entries:
+                    return sent
+                try:
+                    lost = self.send(entries) or 0
+                except Exception:
+                    with self.lock:
+                        self.pending[:0] = entries
+                        self.failed_flushes += 1
+                    raise
+                with self.lock:
+                    self.flushes += 1
+                    self.confirmed += len(entries) - lost
+                    self.lost += lost
+                sent += len(entries)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": len(self.pending),
+                "max_pending": self.max_pending,
+                "flushes": self.flushes,
+                "failed_flushes": self.failed_flushes,
+                "orders_confirmed": self.confirmed,
+                "orders_lost": self.lost,
+                "orders_rejected": self.rejected,
+                "average_batch": round((self.confirmed + self.lost) / self.flushes, 2) if self.flushes else 0.0,
+            }
+
+def order_view(order):
+    """The public fields of an order, a dict of Order columns."""
+    created_at = order.get('created_at')
+    return {
+        "order_id": order['id'],
+        "user_id": order.get('user_id'),
+        "items": order.get('items'),
+        "amount": order.get('amount'),
+        "payment_method": order.get('payment_method'),
+        "status": order.get('status'),
+        "failure_reason": order.get('failure_reason'),
+        "created_at": created_at.isoformat() if created_at is not None else None,
+    }
+
+def etag(view):
+    """Strong validator of an order view, the same in every worker."""
+    body = json.dumps(view, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(body.encode()).hexdigest()
+
+class OrderCache:
+    """LRU cache of the orders read by id, with their ETag.
+
+    Orders in a final status never change again and are kept for ttl
+    seconds, the others for pending_ttl, since another worker may change
+    their status. Status changes in this worker invalidate the entry, so
+    they are read through at once.
+    """
+
+    def __init__(self, max_entries=None, ttl=None, pending_ttl=None):
+        self.max_entries = int(ORDER_CACHE_SIZE if max_entries is None else max_entries)
+        self.ttl = float(ORDER_CACHE_TTL_SECONDS if ttl is None else ttl)
+        self.pending_ttl = float(ORDER_CACHE_PENDING_TTL_SECONDS if pending_ttl is None else pending_ttl)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get(self, order_id):
+        """The (view, etag) of a cached order, or None."""
+        with self.lock:
+            entry = self.entries.get(order_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[2] <= time.monotonic():
+                del self.entries[order_id]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(order_id)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, order):
+        """Cache the current state of an order, returns its (view, etag)."""
+        view = order_view(order)
+        tag = etag(view)
+        ttl = self.ttl if view['status'] in FINAL_STATUSES else self.pending_ttl
+        with self.lock:
+            self.entries[view['order_id']] = (view, tag, time.monotonic() + ttl)
+            self.entries.move_to_end(view['order_id'])
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return view, tag
+
+    def invalidate(self, order_id):
+        with self.lock:
+            if self.entries.pop(order_id, None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "expired": self.expired,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+            }
@@ -1,62 +1,184 @@
 import os
 import sys
+import json
 import random
 import requests
 from flask import Flask, request, jsonify
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
 from opentelemetry import trace
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.instrumentation.flask import FlaskInstrumentor
-from opentelemetry.instrumentation.requests import RequestsInstrumentor
-from opentelemetry.sdk.resources import SERVICE_NAME, Resource
-from opentelemetry.sdk.trace import TracerProvider
-
-TEMPO_HOSTNAME = os.getenv('TEMPO_HOSTNAME', 'tempo')
-TEMPO_PORT     = os.getenv('TEMPO_PORT', '4317')
+from common import database, faults, http_client, logs, metrics, profiling, telemetry, tracing
+import batcher
+import ledger
+
 FRAUD_SERVICE_URL = os.getenv('FRAUD_SERVICE_URL', 'http://fraud-service:5000')
+# Collect concurrent fraud checks into micro-batches, see batcher.py
+FRAUD_BATCH_ENABLED = os.getenv('FRAUD_BATCH_ENABLED', 'true')
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:////sqlite.db')
 
 app = Flask(__name__)
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = database.sqlite_engine_options()
+db = SQLAlchemy(app)
+database.enable_sqlite_wal(app, db)
+
+# Configure tracing and instrument Flask, see common/telemetry.py
+telemetry.init_tracing(os.environ['SERVICE_NAME'])
+telemetry.init_app(app)
+
+# JSON logs with the trace context of every record, see common/logs.py
+logs.init_logging(os.environ['SERVICE_NAME'], app)
+
+# RED metrics with trace exemplars at GET /metrics, see common/metrics.py
+metrics.init_app(app, db)
+
+# Sampling profiler at GET /debug/profile, see common/profiling.py
+profiling.init_app(app)
+
+# Latency and fault injection per route and downstream, see common/faults.py
+faults.init_app(app)
+
+# Pooled keep-alive client for the fraud service
+fraud_service = http_client.client('fraud-service', FRAUD_SERVICE_URL)
+http_client.init_app(app)
+
+# Payment model
+class Payment(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    idempotency_key = db.Column(db.String(64), unique=True, nullable=True)
+    order_id = db.Column(db.String(32), index=True)
+    user_id = db.Column(db.String(20))
+    payment_method = db.Column(db.String(20))
+    amount = db.Column(db.String(10))
+    status = db.Column(db.String(20))
+    response = db.Column(db.Text)
+    response_status = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime)
+
+# Persistent payment ledger with a bounded cache of recent results
+payment_ledger = ledger.PaymentLedger(db, Payment)
+
+def send_fraud_batch(checks):
+    """Score a micro-batch of fraud checks with a single call to fraud-service.
+
+    Runs in a batcher thread, so the batch span starts a trace of its own
+    and links to the span of every payment in it.
+    """
+    tracer = trace.get_tracer(__name__)
+    links = [link for check in checks for link in tracing.item_links(check['trace_context'])]
+    with tracer.start_as_current_span("fraud_detection_micro_batch", links=links) as span:
+        span.set_attribute("batch.size", len(checks))
+        response = fraud_service.post('/fraud/check/batch', json={"transactions": [
+            dict(check['transaction'], trace_context=check['trace_context']) for check in checks
+        ]})
+        span.set_attribute("http.status_code", response.status_code)
+        batch_context = span.get_span_context()
+        if response.status_code != 200:
+            app.logger.error("Fraud detection batch failed: %s", response.text)
+            return [(response.status_code, {"message": response.text}, batch_context)] * len(checks)
+        return [(200, result, batch_context) for result in response.json()['results']]
+
+# Concurrent single authorizations share fraud-service calls
+fraud_batcher = None
+if str(FRAUD_BATCH_ENABLED).lower() in ('1', 'true', 'yes', 'on'):
+    fraud_batcher = batcher.MicroBatcher(send_fraud_batch)
+
+def check_fraud(span, fraud_payload):
+    """Status code and decision of fraud-service for one payment."""
+    if fraud_batcher is None:
+        response = fraud_service.post('/fraud/check', json=fraud_payload)
+        span.set_attribute("http.method", "POST")
+        span.set_attribute("http.url", fraud_service.url('/fraud/check'))
+        span.set_attribute("http.status_code", response.status_code)
+        telemetry.record_body(span, "http.request_body", fraud_payload)
+        telemetry.record_body(span, "http.response_body", lambda: response.text)
+        return response.status_code, response.json() if response.status_code == 200 else {"message": response.text}
 
-# Configure tracer
-trace.set_tracer_provider(TracerProvider(
-    resource=Resource.create({SERVICE_NAME: "payment-service"})
-))
+    status_code, result, batch_context = fraud_batcher.submit({
+        "transaction": fraud_payload,
+        "trace_context": tracing.item_context(),
+    })
+    # Tie the payment to the batch it was scored in
+    span.add_link(batch_context)
+    span.set_attribute("fraud.micro_batched", True)
+    span.set_attribute("http.status_code", status_code)
+    telemetry.record_body(span, "http.request_body", fraud_payload)
+    telemetry.record_body(span, "http.response_body", result)
+    return status_code, result
 
-# Set up the OTLP exporter
-otlp_exporter = OTLPSpanExporter(
-    endpoint=f"{TEMPO_HOSTNAME}:{TEMPO_PORT}",
-    insecure=True
-)
+FRAUDULENT = 'fraudulent'
+LEGITIMATE = 'legitimate'
 
-# Configure OpenTelemetry trace provider to 
-# use BatchSpanProcessor with the OTLP exporter.
-trace.get_tracer_provider().add_span_processor(
-    BatchSpanProcessor(otlp_exporter)
-)
+def fraud_decision(status_code, result):
+    """FRAUDULENT or LEGITIMATE, or None when fraud-service gave no decision."""
+    if status_code != 200 or not isinstance(result, dict):
+        return None
+    decision = result.get("status")
+    return decision if decision in (FRAUDULENT, LEGITIMATE) else None
 
-# Instrument Flask
-FlaskInstrumentor().instrument_app(app)
-# Instrument Flask and Requests for context propagation
-FlaskInstrumentor().instrument_app(app)
-RequestsInstrumentor().instrument()
+def fraud_unavailable():
+    return jsonify({
+        "status": "failure",
+        "message": "Fraud detection is unavailable, try again later",
+        "category": "unavailable"
+    }), 503, {"Retry-After": "1"}
 
-# In-Memory database
-payments_db = {}
+def replay_response(replay):
+    body, status = replay
+    return app.response_class(body, status=status, mimetype='application/json')
+
+def record_payment(idempotency_key, payload, status, response, status_code):
+    body = payment_ledger.add(
+        idempotency_key,
+        payload.get("order_id"),
+        payload.get("user_id"),
+        payload.get("payment_method"),
+        payload.get("amount"),
+        status,
+        response,
+        status_code,
+    )
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another worker finished an authorization with the same key first
+        db.session.rollback()
+        replay = payment_ledger.lookup(idempotency_key)
+        if replay is not None:
+            return replay_response(replay)
+        raise
+    payment_ledger.remember(idempotency_key, body, status_code)
+    return jsonify(response), status_code
 
 @app.route('/payment/authorize', methods=['POST'])
 def authorize_payment():
     tracer = trace.get_tracer(__name__)
-    payload = request.get_json()
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if not idempotency_key:
+        return process_authorization(request.get_json(), None)
+
+    # A retried authorization returns the earlier result without calling downstream
+    with tracer.start_as_current_span("idempotency_lookup") as span:
+        span.set_attribute("payment.idempotency_key", idempotency_key)
+        replay = payment_ledger.lookup(idempotency_key)
+        span.set_attribute("payment.idempotent_replay", replay is not None)
+        if replay is not None:
+            return replay_response(replay)
+        if not payment_ledger.begin(idempotency_key):
+            return jsonify({"status": "failure", "message": "Authorization with this key is in progress"}), 409
+    try:
+        return process_authorization(request.get_json(), idempotency_key)
+    finally:
+        payment_ledger.end(idempotency_key)
+
+def process_authorization(payload, idempotency_key):
+    tracer = trace.get_tracer(__name__)
     order_id = payload.get("order_id")
     user_id = payload.get("user_id")
     payment_method = payload.get("payment_method")
     amount = payload.get("amount")
 
     with tracer.start_as_current_span("authorize_payment"):
-        current_span = trace.get_current_span()
-        trace_id = current_span.get_span_context().trace_id
-        trace_id_hex = format(trace_id, '032x')
-        app.logger.info(f"[payment-service] logged trace_id={trace_id_hex}")
 
         # Simulate payment authorization logic
         with tracer.start_as_current_span("validate_payment_details") as span:
@@ -68,7 +190,7 @@ def authorize_payment():
             # Dummy validation logic
             if not order_id or not user_id or not payment_method or not amount:
                 span.set_attribute("payment.status", "failure")
-                app.logger.error(f'invalid payment details error: order_id={order_id}, user_id={user_id}, payment_method={payment_method}, amount={amount}')
+                app.logger.error('invalid payment details error: order_id=%s, user_id=%s, payment_method=%s, amount=%s', order_id, user_id, payment_method, amount)
                 return jsonify({"status": "failure", "message": "Invalid payment details"}), 400
 
         # Fraud Detection Service Call
@@ -80,43 +202,205 @@ def authorize_payment():
                 "amount": amount
             }
             try:
-                response = requests.post(f'{FRAUD_SERVICE_URL}/fraud/check', json=fraud_payload)
-                span.set_attribute("http.method", "POST")
-                span.set_attribute("http.url", f'{FRAUD_SERVICE_URL}/fraud/check')
-                span.set_attribute("http.status_code", response.status_code)
-                span.set_attribute("http.request_body", str(fraud_payload))
-                span.set_attribute("http.response_body", response.text)
-
-                if response.status_code != 200 or response.json().get("status") == "fraudulent":
-                    span.set_attribute("fraud_check", "failed")
-                    app.logger.error(f"Fraud detection failed: {response.text}")
-                    return jsonify({
-                        "status": "failure",
-                        "message": "Fraudulent transaction detected",
-                        "category": "fraud"
-                    }), 403
-                else:
-                    span.set_attribute("fraud_check", "passed")
-
-            except requests.exceptions.RequestException as e:
+                status_code, fraud_result = check_fraud(span, fraud_payload)
+            except (requests.exceptions.RequestException, batcher.BatchResultError) as e:
                 span.set_attribute("http.error", str(e))
-                app.logger.error(f"Error while calling fraud detection service: {e}")
-                return jsonify({"status": "failure", "message": "Error contacting fraud detection service"}), 500
+                app.logger.error("Error while calling fraud detection service: %s", e)
+                return fraud_unavailable()
+
+            decision = fraud_decision(status_code, fraud_result)
+            if decision is None:
+                # No decision, nothing is recorded under the key so a retry scores it again
+                span.set_attribute("fraud_check", "unavailable")
+                app.logger.error("Fraud detection failed: %s %s", status_code, json.dumps(fraud_result))
+                return fraud_unavailable()
+            if decision == FRAUDULENT:
+                span.set_attribute("fraud_check", "failed")
+                app.logger.error("Fraud detected: %s", json.dumps(fraud_result))
+                return record_payment(idempotency_key, payload, "declined", {
+                    "status": "failure",
+                    "message": "Fraudulent transaction detected",
+                    "category": "fraud"
+                }, 403)
+            span.set_attribute("fraud_check", "passed")
 
         # Proceed with payment processing after passing fraud check
         with tracer.start_as_current_span("process_payment") as span:
             # Simulated payment processing
             payment_status = "authorized"
-            payments_db[order_id] = {
-                "user_id": user_id,
-                "payment_method": payment_method,
-                "amount": amount,
-                "status": payment_status
-            }
             span.set_attribute("payment.status", payment_status)
 
-        # Return the result of the payment authorization
-        return jsonify({"status": "success", "message": "Payment authorized", "order_id": order_id}), 200
+            # Record the payment and return the result of the payment authorization
+            return record_payment(idempotency_key, payload, payment_status, {
+                "status": "success",
+                "message": "Payment authorized",
+                "order_id": order_id
+            }, 200)
+
+@app.route('/payment/authorize/batch', methods=['POST'])
+def authorize_payments_batch():
+    tracer = trace.get_tracer(__name__)
+    payments = request.get_json().get('payments', [])
+
+    with tracer.start_as_current_span("authorize_payment_batch") as batch_span:
+        batch_span.set_attribute("batch.size", len(payments))
+
+        results = [None] * len(payments)
+        valid = []
+        claimed = []
+
+        try:
+            with tracer.start_as_current_span("validate_payment_details"):
+                for index, payment in enumerate(payments):
+                    links = tracing.item_links(payment.get('trace_context'))
+                    with tracer.start_as_current_span("authorize_payment", links=links) as span:
+                        span.set_attribute("batch.index", index)
+                        span.set_attribute("payment.order_id", payment.get("order_id"))
+                        span.set_attribute("payment.user_id", payment.get("user_id"))
+                        span.set_attribute("payment.payment_method", payment.get("payment_method"))
+                        span.set_attribute("payment.amount", payment.get("amount"))
+                        if not all(payment.get(key) for key in ("order_id", "user_id", "payment_method", "amount")):
+                            span.set_attribute("payment.status", "failure")
+                            results[index] = {"status": "failure", "message": "Invalid payment details"}
+                            continue
+
+                        idempotency_key = payment.get("idempotency_key")
+                        if idempotency_key:
+                            replay = payment_ledger.lookup(idempotency_key)
+                            span.set_attribute("payment.idempotent_replay", replay is not None)
+                            if replay is not None:
+                                results[index] = json.loads(replay[0])
+                                continue
+                            if not payment_ledger.begin(idempotency_key):
+                                results[index] = {"status": "failure", "message": "Authorization with this key is in progress"}
+                                continue
+                            claimed.append(idempotency_key)
+                        valid.append({"index": index, "payment": payment, "trace_context": tracing.item_context()})
+
+            # Fraud Detection Service Call, a single round trip for the whole batch
+            if valid:
+                with tracer.start_as_current_span("fraud_detection_service_batch_call") as span:
+                    span.set_attribute("batch.size", len(valid))
+                    try:
+                        response = fraud_service.post('/fraud/check/batch', json={"transactions": [{
+                            "order_id": each['payment'].get("order_id"),
+                            "user_id": each['payment'].get("user_id"),
+                            "payment_method": each['payment'].get("payment_method"),
+                            "amount": each['payment'].get("amount"),
+                            "trace_context": each['trace_context'],
+                        } for each in valid]})
+                        span.set_attribute("http.status_code", response.status_code)
+                        if response.status_code != 200:
+                            app.logger.error("Fraud detection batch failed: %s", response.text)
+                            return fraud_unavailable()
+                    except requests.exceptions.RequestException as e:
+                        span.set_attribute("http.error", str(e))
+                        app.logger.error("Error while calling fraud detection service: %s", e)
+                        return fraud_unavailable()
+
+                # Record every payment of the batch in one transaction
+                with tracer.start_as_current_span("process_payment"):
+                    recorded = []
+                    decisions = response.json().get('results') or []
+                    for index, each in enumerate(valid):
+                        payment = each['payment']
+                        decision = fraud_decision(200, decisions[index] if index < len(decisions) else None)
+                        if decision is None:
+                            # Not recorded under its key, a retry scores it again
+                            results[each['index']] = {
+                                "status": "failure",
+                                "message": "Fraud detection is unavailable, try again later",
+                                "category": "unavailable"
+                            }
+                            continue
+                        if decision == FRAUDULENT:
+                            status, code = "declined", 403
+                            result = {
+                                "status": "failure",
+                                "message": "Fraudulent transaction detected",
+                                "category": "fraud"
+                            }
+                        else:
+                            status, code = "authorized", 200
+                            result = {"status": "success", "message": "Payment authorized", "order_id": payment.get("order_id")}
+                        body = payment_ledger.add(
+                            payment.get("idempotency_key"),
+                            payment.get("order_id"),
+                            payment.get("user_id"),
+                            payment.get("payment_method"),
+                            payment.get("amount"),
+                            status,
+                            result,
+                            code,
+                        )
+                        recorded.append((payment.get("idempotency_key"), body, code))
+                        results[each['index']] = result
+
+                    try:
+                        db.session.commit()
+                    except IntegrityError:
+                        db.session.rollback()
+                        app.logger.error("payment batch conflicts with an authorization using the same idempotency key")
+                        return jsonify({"status": "failure", "message": "Authorization with this key already exists"}), 409
+                    for key, body, code in recorded:
+                        payment_ledger.remember(key, body, code)
+        finally:
+            for key in claimed:
+                payment_ledger.end(key)
+
+        return jsonify({"status": "success", "results": results}), 200
+
+# Replayed to authorizations whose key was voided
+VOIDED = {"status": "failure", "message": "Payment was voided", "category": "voided"}
+
+@app.route('/payment/void', methods=['POST'])
+def void_payment():
+    payload = request.get_json()
+    idempotency_key = payload.get('idempotency_key')
+    if not idempotency_key:
+        return jsonify({"status": "failure", "message": "idempotency_key is required"}), 400
+    tracer = trace.get_tracer(__name__)
+
+    with tracer.start_as_current_span("void_payment") as span:
+        span.set_attribute("payment.order_id", payload.get('order_id'))
+        span.set_attribute("payment.idempotency_key", idempotency_key)
+        payment = Payment.query.filter_by(idempotency_key=idempotency_key).first()
+        if payment is None:
+            # The authorization has not arrived (yet): record the void under its
+            # key, so an authorization that arrives late is answered with it
+            body = payment_ledger.add(idempotency_key, payload.get('order_id'), None, None, None, "voided", VOIDED, 409)
+            try:
+                db.session.commit()
+                payment_ledger.remember(idempotency_key, body, 409)
+                span.set_attribute("payment.previous_status", "none")
+                return jsonify({"status": "success", "message": "Payment voided"}), 200
+            except IntegrityError:
+                db.session.rollback()
+                payment = Payment.query.filter_by(idempotency_key=idempotency_key).first()
+
+        previous_status = payment.status
+        span.set_attribute("payment.previous_status", previous_status)
+        if previous_status == "authorized":
+            # A retry of the authorization replays the void from now on
+            body = payment_ledger.void(payment, VOIDED, 409)
+            db.session.commit()
+            payment_ledger.remember(idempotency_key, body, 409)
+            return jsonify({"status": "success", "message": "Payment voided"}), 200
+        return jsonify({"status": "success", "message": f"Payment was {previous_status}, nothing to void"}), 200
+
+@app.route('/payment/ledger/stats', methods=['GET'])
+def payment_ledger_stats():
+    return jsonify(payment_ledger.stats()), 200
+
+@app.route('/payment/fraud-batcher/stats', methods=['GET'])
+def fraud_batcher_stats():
+    return jsonify(fraud_batcher.stats() if fraud_batcher is not None else {"enabled": False}), 200
+
+def init_db():
+    """Create the schema and seed data, runs once before the server starts."""
+    with app.app_context():
+        db.create_all()
 
 if __name__ == '__main__':
+    init_db()
     app.run(debug=True, host='0.0.0.0', port=5000)
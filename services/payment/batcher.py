@@ -0,0 +1,125 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Concurrent fraud checks are collected for up to FRAUD_BATCH_WINDOW_MS after
+# the first one arrives, or until FRAUD_BATCH_MAX_SIZE are waiting
+FRAUD_BATCH_WINDOW_MS = os.getenv('FRAUD_BATCH_WINDOW_MS', 3)
+FRAUD_BATCH_MAX_SIZE = os.getenv('FRAUD_BATCH_MAX_SIZE', 32)
+# Batches sent at the same time, the next batch collects while they run
+FRAUD_BATCH_MAX_IN_FLIGHT = os.getenv('FRAUD_BATCH_MAX_IN_FLIGHT', 4)
+
+class BatchResultError(Exception):
+    """send() returned a different number of results than it was given items."""
+
+class Waiter:
+    """One item of a micro-batch and the request thread waiting for its result."""
+
+    __slots__ = ('item', 'done', 'result', 'error')
+
+    def __init__(self, item):
+        self.item = item
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class MicroBatcher:
+    """Turns concurrent single calls into batch calls.
+
+    submit() queues an item and blocks until its result is there. A
+    dispatcher thread takes the queued items once the window after the first
+    item has passed or max_size items wait, and hands them to send(items),
+    which returns one result per item in the same order. When send() raises,
+    or returns more or fewer results, every item of the batch gets the
+    exception.
+    """
+
+    def __init__(self, send, window_ms=None, max_size=None, max_in_flight=None):
+        self.send = send
+        self.window = float(FRAUD_BATCH_WINDOW_MS if window_ms is None else window_ms) / 1000.0
+        self.max_size = int(FRAUD_BATCH_MAX_SIZE if max_size is None else max_size)
+        self.max_in_flight = int(FRAUD_BATCH_MAX_IN_FLIGHT if max_in_flight is None else max_in_flight)
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.pending = []
+        self.first_at = None
+        self.slots = threading.BoundedSemaphore(self.max_in_flight)
+        self.pool = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='micro-batch')
+        self.thread_pid = None
+        self.batches = 0
+        self.items = 0
+        self.largest_batch = 0
+        self.failed_batches = 0
+
+    def _ensure_thread(self):
+        # Started on first use, so every forked worker gets its own thread
+        if self.thread_pid == os.getpid():
+            return
+        self.thread_pid = os.getpid()
+        threading.Thread(target=self._run, name='micro-batcher', daemon=True).start()
+
+    def submit(self, item):
+        waiter = Waiter(item)
+        with self.lock:
+            self._ensure_thread()
+            if not self.pending:
+                self.first_at = time.monotonic()
+            self.pending.append(waiter)
+            if len(self.pending) == 1 or len(self.pending) >= self.max_size:
+                self.ready.notify()
+        waiter.done.wait()
+        if waiter.error is not None:
+            raise waiter.error
+        return waiter.result
+
+    def _next_batch(self):
+        with self.lock:
+            while not self.pending:
+                self.ready.wait()
+            while len(self.pending) < self.max_size:
+                remaining = self.first_at + self.window - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.ready.wait(remaining)
+            batch, self.pending = self.pending[:self.max_size], self.pending[self.max_size:]
+            self.first_at = time.monotonic() if self.pending else None
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            self.slots.acquire()
+            self.pool.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch):
+        try:
+            results = list(self.send([waiter.item for waiter in batch]))
+            if len(results) != len(batch):
+                raise BatchResultError(f"batch of {len(batch)} items returned {len(results)} results")
+            for waiter, result in zip(batch, results):
+                waiter.result = result
+        except Exception as e:
+            for waiter in batch:
+                waiter.error = e
+            with self.lock:
+                self.failed_batches += 1
+        finally:
+            self.slots.release()
+            with self.lock:
+                self.batches += 1
+                self.items += len(batch)
+                self.largest_batch = max(self.largest_batch, len(batch))
+            for waiter in batch:
+                waiter.done.set()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": len(self.pending),
+                "batches": self.batches,
+                "failed_batches": self.failed_batches,
+                "items": self.items,
+                "largest_batch": self.largest_batch,
+                "average_batch": round(self.items / self.batches, 2) if self.batches else 0.0,
+            }
@@ -0,0 +1,167 @@
+import os
+import sys
+import json
+import time
+import threading
+from datetime import datetime
+from collections import OrderedDict
+
+PAYMENT_CACHE_MAX_ENTRIES = os.getenv('PAYMENT_CACHE_MAX_ENTRIES', 10000)
+PAYMENT_IDEMPOTENCY_TTL_SECONDS = os.getenv('PAYMENT_IDEMPOTENCY_TTL_SECONDS', 86400)
+
+# Rough per entry overhead of the OrderedDict slot and the tuple holding the entry
+ENTRY_OVERHEAD_BYTES = 200
+
+def _text(value):
+    return str(value) if value is not None else None
+
+class LedgerCache:
+    """In-memory LRU of authorization results, entries expire after ttl seconds."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _size(key, body):
+        return sys.getsizeof(key) + sys.getsizeof(body) + ENTRY_OVERHEAD_BYTES
+
+    def _remove(self, key):
+        _, body, _ = self.entries.pop(key)
+        self.bytes -= self._size(key, body)
+
+    def get(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, body, status = entry
+            if expires_at <= now:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return body, status
+
+    def put(self, key, body, status, now=None, ttl=None):
+        now = time.monotonic() if now is None else now
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (now + ttl, body, status)
+            self.bytes += self._size(key, body)
+            while len(self.entries) > self.max_entries:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "memory_bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+class PaymentLedger:
+    """Authorizations persisted in the database with a bounded in-memory cache
+    of recent results in front of it, keyed by idempotency key.
+
+    A void replaces the stored result of an authorization. Another worker may
+    still cache the authorized result, so a cached authorization is only
+    replayed after a look at the stored status.
+    """
+
+    def __init__(self, db, model, max_entries=None, ttl=None):
+        self.db = db
+        self.model = model
+        self.ttl = float(PAYMENT_IDEMPOTENCY_TTL_SECONDS if ttl is None else ttl)
+        self.cache = LedgerCache(int(PAYMENT_CACHE_MAX_ENTRIES if max_entries is None else max_entries), self.ttl)
+        self.in_flight = set()
+        self.in_flight_lock = threading.Lock()
+        self.store_hits = 0
+
+    def lookup(self, key):
+        """Return the (body, status) of an earlier authorization with this key."""
+        cached = self.cache.get(key)
+        if cached is not None and (cached[1] != 200 or self._status(key) != 'voided'):
+            return cached
+        # Read through to the store, e.g. after a restart or an eviction
+        payment = self.model.query.filter_by(idempotency_key=key).first()
+        if payment is None or payment.response is None:
+            return None
+        age = (datetime.utcnow() - payment.created_at).total_seconds()
+        if age >= self.ttl:
+            return None
+        self.store_hits += 1
+        self.cache.put(key, payment.response, payment.response_status, ttl=self.ttl - age)
+        return payment.response, payment.response_status
+
+    def _status(self, key):
+        return self.db.session.query(self.model.status).filter_by(idempotency_key=key).scalar()
+
+    def begin(self, key):
+        """Claim a key, False when a request with the same key is still running."""
+        with self.in_flight_lock:
+            if key in self.in_flight:
+                return False
+            self.in_flight.add(key)
+            return True
+
+    def end(self, key):
+        with self.in_flight_lock:
+            self.in_flight.discard(key)
+
+    def add(self, key, order_id, user_id, payment_method, amount, status, response=None, response_status=None):
+        """Add an authorization to the current transaction, the caller commits."""
+        body = json.dumps(response, separators=(',', ':'), sort_keys=True) if response is not None else None
+        self.db.session.add(self.model(
+            idempotency_key=key,
+            order_id=_text(order_id),
+            user_id=_text(user_id),
+            payment_method=payment_method,
+            amount=_text(amount),
+            status=status,
+            response=body,
+            response_status=response_status,
+            created_at=datetime.utcnow(),
+        ))
+        return body
+
+    def void(self, payment, response, response_status):
+        """Void a stored authorization in the current transaction, replays of
+        its key get response from then on. The caller commits and remembers it."""
+        payment.status = 'voided'
+        payment.response = json.dumps(response, separators=(',', ':'), sort_keys=True)
+        payment.response_status = response_status
+        return payment.response
+
+    def remember(self, key, body, status):
+        """Cache a committed result for replays of the same key."""
+        if key and body is not None:
+            self.cache.put(key, body, status)
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats["store_hits"] = self.store_hits
+        with self.in_flight_lock:
+            stats["in_flight"] = len(self.in_flight)
+        return stats
@@ -0,0 +1,105 @@
+import os
+
+# Strategy used when a reservation does not ask for one
+ALLOCATION_STRATEGY = os.getenv('ALLOCATION_STRATEGY', 'nearest')
+
+# Distance of every warehouse location, e.g. "Warehouse-A=10,Warehouse-B=25".
+# Locations that are not listed are treated as the furthest away.
+WAREHOUSE_DISTANCES = os.getenv('WAREHOUSE_DISTANCES', 'Warehouse-A=10,Warehouse-B=20')
+
+def parse_distances(value):
+    distances = {}
+    for entry in value.split(','):
+        if '=' in entry:
+            location, distance = entry.split('=', 1)
+            distances[location.strip()] = float(distance)
+    return distances
+
+DISTANCES = parse_distances(WAREHOUSE_DISTANCES)
+
+def distance(location):
+    return DISTANCES.get(location, float('inf'))
+
+class StockLevel:
+    """Available quantity of an item in one warehouse location."""
+
+    def __init__(self, row_id, location, available):
+        self.row_id = row_id
+        self.location = location
+        self.available = available
+
+class Allocation:
+    """Quantities to take from each location to fulfil a reservation."""
+
+    def __init__(self, strategy, picks):
+        self.strategy = strategy
+        self.picks = picks
+        # Set when the reservation is stored, one hold per pick
+        self.hold_ids = []
+        self.expires_at = None
+
+    @property
+    def splits(self):
+        return len(self.picks)
+
+    @property
+    def locations(self):
+        return [stock.location for stock, _ in self.picks]
+
+    @property
+    def quantities(self):
+        return [quantity for _, quantity in self.picks]
+
+    def apply(self):
+        # Keep the in-memory stock levels current for later items of a batch
+        for stock, quantity in self.picks:
+            stock.available -= quantity
+
+STRATEGIES = {}
+
+def strategy(name):
+    """Register an allocation strategy.
+
+    A strategy receives the stock levels that have stock left and returns
+    them in the order they should be drawn from.
+    """
+    def register(func):
+        STRATEGIES[name] = func
+        return func
+    return register
+
+@strategy('nearest')
+def nearest(stock_levels, quantity):
+    return sorted(stock_levels, key=lambda stock: (distance(stock.location), -stock.available))
+
+@strategy('most_stock')
+def most_stock(stock_levels, quantity):
+    return sorted(stock_levels, key=lambda stock: (-stock.available, distance(stock.location)))
+
+@strategy('fewest_splits')
+def fewest_splits(stock_levels, quantity):
+    # The nearest location that can ship everything on its own, otherwise
+    # draw from the biggest stock first which needs the fewest locations
+    single = [stock for stock in stock_levels if stock.available >= quantity]
+    if single:
+        return [min(single, key=lambda stock: distance(stock.location))]
+    return most_stock(stock_levels, quantity)
+
+def allocate(stock_levels, quantity, strategy_name=None):
+    """Split quantity over the stock levels, None when there is not enough stock."""
+    strategy_name = strategy_name or ALLOCATION_STRATEGY
+    if strategy_name not in STRATEGIES:
+        raise ValueError(f"unknown allocation strategy: {strategy_name}")
+    candidates = [stock for stock in stock_levels if stock.available > 0]
+    if quantity <= 0 or sum(stock.available for stock in candidates) < quantity:
+        return None
+
+    picks = []
+    remaining = quantity
+    for stock in STRATEGIES[strategy_name](candidates, quantity):
+        take = min(stock.available, remaining)
+        picks.append((stock, take))
+        remaining -= take
+        if remaining == 0:
+            return Allocation(strategy_name, picks)
+    return None
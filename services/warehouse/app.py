@@ -1,50 +1,47 @@
 import os
 import sys
 import time
+import uuid
 import random
 import requests
 from datetime import datetime
 from flask import Flask, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text
+from sqlalchemy import bindparam, select, text
 from opentelemetry import trace
-from opentelemetry.instrumentation.flask import FlaskInstrumentor
-from opentelemetry.instrumentation.sqlalchemy import SQLAlchemyInstrumentor
-from opentelemetry.instrumentation.requests import RequestsInstrumentor
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.resources import SERVICE_NAME, Resource
-from opentelemetry.sdk.trace import TracerProvider
-
-TEMPO_HOSTNAME = os.getenv('TEMPO_HOSTNAME', 'tempo')
-TEMPO_PORT     = os.getenv('TEMPO_PORT', '4317')
+from common import catalog, database, faults, http_client, logs, metrics, profiling, telemetry, tracing
+import allocation
+import holds
+
 INVENTORY_AVAILABILITY = os.getenv('INVENTORY_AVAILABILITY', 100)
+INVENTORY_SERVICE_URL = os.getenv('INVENTORY_SERVICE_URL', 'http://inventory-service:5000')
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:////sqlite.db')
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////sqlite.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = database.sqlite_engine_options()
 db = SQLAlchemy(app)
+# Reservations read stock levels and update them in the same transaction
+database.enable_sqlite_wal(app, db, begin_immediate=True)
 
-# Configure tracer
-trace.set_tracer_provider(TracerProvider(
-    resource=Resource.create({SERVICE_NAME: os.environ['SERVICE_NAME']})
-))
+# Configure tracing and instrument Flask, see common/telemetry.py
+telemetry.init_tracing(os.environ['SERVICE_NAME'])
+telemetry.init_app(app, sqlalchemy=True)
 
-# Set up the OTLP exporter
-otlp_exporter = OTLPSpanExporter(
-    endpoint=f"{TEMPO_HOSTNAME}:{TEMPO_PORT}",
-    insecure=True
-)
+# JSON logs with the trace context of every record, see common/logs.py
+logs.init_logging(os.environ['SERVICE_NAME'], app)
 
-# Configure OpenTelemetry trace provider to 
-# use BatchSpanProcessor with the OTLP exporter.
-trace.get_tracer_provider().add_span_processor(
-    BatchSpanProcessor(otlp_exporter)
-)
+# RED metrics with trace exemplars at GET /metrics, see common/metrics.py
+metrics.init_app(app, db)
+
+# Sampling profiler at GET /debug/profile, see common/profiling.py
+profiling.init_app(app)
 
-# Instrument Flask
-FlaskInstrumentor().instrument_app(app)
-SQLAlchemyInstrumentor().instrument()
-RequestsInstrumentor().instrument()
+# Latency and fault injection per route and downstream, see common/faults.py
+faults.init_app(app)
+
+# Pool counters of the inventory-service client, see restock_inventory()
+http_client.init_app(app)
 
 # Warehouse Reservations Model
 class Reservations(db.Model):
@@ -54,6 +51,9 @@ class Reservations(db.Model):
 
 # Warehouse Inventory Model
 class WarehouseInventory(db.Model):
+    __table_args__ = (
+        db.Index('ix_warehouse_inventory_item_location', 'item_id', 'warehouse_location'),
+    )
     id = db.Column(db.String, primary_key=True)
     item_id = db.Column(db.String, nullable=False)
     warehouse_location = db.Column(db.String, nullable=False)
@@ -62,93 +62,402 @@ class WarehouseInventory(db.Model):
     reservation_timestamp = db.Column(db.DateTime, nullable=True)
     reservation_status = db.Column(db.String, nullable=True)
 
+# Stock reserved at one location for one order, released when it is not
+# confirmed before it expires, see holds.py
+class WarehouseHold(db.Model):
+    __tablename__ = 'warehouse_holds'
+    __table_args__ = (
+        db.Index('ix_warehouse_holds_status_expires', 'status', 'expires_at'),
+        # Open holds of a location, subtracted by catalog imports that set the stock
+        db.Index('ix_warehouse_holds_row_status', 'row_id', 'status'),
+    )
+    id = db.Column(db.String, primary_key=True)
+    row_id = db.Column(db.String, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(10), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+def restock_inventory(items):
+    """Return the stock of expired holds to the inventory-service, raises when it did not take it."""
+    # Created on first use, the inventory-service calls this one and is
+    # started after it
+    inventory_service = http_client.client('inventory-service', INVENTORY_SERVICE_URL)
+    response = inventory_service.post('/inventory/restock', json={"items": items})
+    if response.status_code != 200:
+        raise requests.exceptions.HTTPError(f"inventory restock failed: {response.text}")
+
+hold_sweeper = holds.HoldSweeper(app, db, restock_inventory)
+
+@app.before_request
+def start_hold_sweeper():
+    hold_sweeper.ensure_thread()
+
+# Take the allocated quantity from one location, the row is only
+# changed when the stock is still there
+RESERVE_QUERY = text(
+    "UPDATE warehouse_inventory SET "
+    "available_quantity = available_quantity - :quantity, "
+    "reserved_quantity = reserved_quantity + :quantity, "
+    "reservation_timestamp = :timestamp, reservation_status = 'reserved' "
+    "WHERE id = :row_id AND available_quantity >= :quantity"
+).bindparams(bindparam('timestamp', type_=db.DateTime))
+
+# Give reserved stock back to the location it was taken from
+RELEASE_QUERY = text(
+    "UPDATE warehouse_inventory SET "
+    "available_quantity = available_quantity + :quantity, "
+    "reserved_quantity = reserved_quantity - :quantity, "
+    "reservation_status = CASE WHEN reserved_quantity > :quantity THEN reservation_status ELSE 'released' END "
+    "WHERE item_id = :item_id AND warehouse_location = :location AND reserved_quantity >= :quantity"
+)
+
+# Bulk catalog import, a row of the input sets or adds to the available stock
+# of a location. Rows that would not change are skipped, see common/catalog.py
+# A set counts the stock of the location including its open holds, which
+# give their stock back when they are released or expire, so they are
+# subtracted. Below the open holds the stock goes negative until they end.
+OPEN_HOLDS = (
+    "(SELECT COALESCE(SUM(quantity), 0) FROM warehouse_holds "
+    "WHERE row_id = warehouse_inventory.id AND status = 'held')"
+)
+IMPORT_QUERIES = {
+    'set': text(
+        "INSERT INTO warehouse_inventory (id, item_id, warehouse_location, available_quantity, reserved_quantity) "
+        "VALUES (:id, :item_id, :location, :quantity, 0) "
+        f"ON CONFLICT (id) DO UPDATE SET available_quantity = excluded.available_quantity - {OPEN_HOLDS} "
+        f"WHERE available_quantity IS NOT excluded.available_quantity - {OPEN_HOLDS}"
+    ),
+    'add': text(
+        "INSERT INTO warehouse_inventory (id, item_id, warehouse_location, available_quantity, reserved_quantity) "
+        "VALUES (:id, :item_id, :location, :quantity, 0) "
+        "ON CONFLICT (id) DO UPDATE SET available_quantity = available_quantity + excluded.available_quantity "
+        "WHERE excluded.available_quantity > 0"
+    ),
+}
+
+def import_row(row):
+    """Parameters of the import queries for a row with item_id,
+    warehouse_location, available_quantity and an optional id, which
+    defaults to <item_id>_<warehouse_location>."""
+    item_id = catalog.required(row, 'item_id')
+    location = catalog.required(row, 'warehouse_location')
+    return {
+        "id": row.get('id') or f"{item_id}_{location}",
+        "item_id": item_id,
+        "location": location,
+        "quantity": catalog.quantity(row, 'available_quantity'),
+    }
+
+catalog.init_app(app, db, 'warehouse', import_row, IMPORT_QUERIES)
+
+class ReservationConflict(Exception):
+    pass
+
+def stock_levels(item_ids):
+    """Stock of every location for the given items, with a single query."""
+    rows = db.session.execute(
+        select(
+            WarehouseInventory.id,
+            WarehouseInventory.item_id,
+            WarehouseInventory.warehouse_location,
+            WarehouseInventory.available_quantity,
+        ).where(WarehouseInventory.item_id.in_(item_ids))
+    ).all()
+    levels = {}
+    for row in rows:
+        levels.setdefault(row.item_id, []).append(
+            allocation.StockLevel(row.id, row.warehouse_location, row.available_quantity)
+        )
+    return levels
+
+def reserve_allocations(allocations):
+    """Apply every allocation with one multi-row UPDATE in the current transaction,
+    and hold the stock taken from each location until it expires.
+
+    Sets the hold ids of every allocation in picked.hold_ids.
+    """
+    timestamp = datetime.utcnow()
+    params = [
+        {"row_id": stock.row_id, "quantity": quantity, "timestamp": timestamp}
+        for picked in allocations
+        for stock, quantity in picked.picks
+    ]
+    result = db.session.execute(RESERVE_QUERY, params)
+    if result.rowcount != len(params):
+        raise ReservationConflict(f"{len(params) - result.rowcount} locations ran out of stock")
+    expires_at = timestamp + holds.ttl()
+    rows = []
+    for picked in allocations:
+        picked.hold_ids = [uuid.uuid4().hex for _ in picked.picks]
+        picked.expires_at = expires_at
+        rows.extend({
+            "id": hold_id,
+            "row_id": stock.row_id,
+            "quantity": quantity,
+            "status": holds.HELD,
+            "created_at": timestamp,
+            "expires_at": expires_at,
+        } for hold_id, (stock, quantity) in zip(picked.hold_ids, picked.picks))
+    db.session.execute(WarehouseHold.__table__.insert(), rows)
+
+def record_allocation(span, picked):
+    span.set_attribute("warehouse.allocation.strategy", picked.strategy)
+    span.set_attribute("warehouse.allocation.locations", picked.locations)
+    span.set_attribute("warehouse.allocation.quantities", picked.quantities)
+    span.set_attribute("warehouse.allocation.splits", picked.splits)
+
+def allocation_summary(picked):
+    # The hold id releases or confirms the reservation of that location
+    return [
+        {"warehouse_location": location, "quantity": quantity, "hold_id": hold_id}
+        for location, quantity, hold_id in zip(picked.locations, picked.quantities, picked.hold_ids)
+    ]
+
+def commit_holds(allocations):
+    db.session.commit()
+    if allocations:
+        hold_sweeper.track(allocations[0].expires_at)
+
 @app.route('/warehouse/reserve', methods=['POST'])
 def reserve_item():
     app.logger.debug('warehouse-service received a post request')
     payload = request.get_json()
     item_id = payload['item_id']
     quantity = payload['quantity']
-    warehouse_location = "Warehouse-A"
+    strategy_name = payload.get('allocation_strategy')
+    if strategy_name and strategy_name not in allocation.STRATEGIES:
+        return jsonify({"status": "failure", "message": f"Unknown allocation strategy {strategy_name}"}), 400
     tracer = trace.get_tracer(__name__)
 
     with tracer.start_as_current_span("reserve_item"):
-        # Access the current span
-        current_span = trace.get_current_span()
+        app.logger.info("warehouse-service about to make a database query")
+
+        with tracer.start_as_current_span("database_operation") as span:
+            span.set_attribute("warehouse.item_id", item_id)
+            span.set_attribute("warehouse.requested_quantity", quantity)
+            picked = allocation.allocate(stock_levels([item_id]).get(item_id, []), quantity, strategy_name)
+            if picked is None:
+                db.session.rollback()
+                return jsonify({"status": "failure", "message": "Insufficient inventory in warehouse"}), 400
+
+            record_allocation(span, picked)
+            span.set_attribute("db.query", RESERVE_QUERY.text)
+            try:
+                reserve_allocations([picked])
+                commit_holds([picked])
+            except ReservationConflict as e:
+                db.session.rollback()
+                app.logger.error("reservation conflict for item %s: %s", item_id, e)
+                return jsonify({"status": "failure", "message": "Reservation conflict, retry the request"}), 409
+
+            return jsonify({
+                "status": "success",
+                "message": f"Reserved {quantity} of item {item_id}",
+                "allocations": allocation_summary(picked)
+            }), 200
+
+@app.route('/warehouse/reserve/batch', methods=['POST'])
+def reserve_items_batch():
+    payload = request.get_json()
+    items = payload.get('items', [])
+    strategy_name = payload.get('allocation_strategy')
+    if strategy_name and strategy_name not in allocation.STRATEGIES:
+        return jsonify({"status": "failure", "message": f"Unknown allocation strategy {strategy_name}"}), 400
+    app.logger.debug('warehouse-service received a batch of %s items', len(items))
+    tracer = trace.get_tracer(__name__)
+
+    with tracer.start_as_current_span("reserve_item_batch") as batch_span:
+        batch_span.set_attribute("batch.size", len(items))
+        app.logger.info("warehouse-service about to make a database query")
+
+        results = [None] * len(items)
+        allocations = []
 
-        # Get the trace ID from the current span
-        trace_id = current_span.get_span_context().trace_id
+        # One query and one transaction for the whole batch
+        with tracer.start_as_current_span("database_operation") as span:
+            levels = stock_levels({item['item_id'] for item in items})
+            span.set_attribute("db.query", RESERVE_QUERY.text)
+
+            for index, item in enumerate(items):
+                item_id = item['item_id']
+                quantity = item['quantity']
+                links = tracing.item_links(item.get('trace_context'))
+                with tracer.start_as_current_span("reserve_item", links=links) as item_span:
+                    item_span.set_attribute("batch.index", index)
+                    item_span.set_attribute("warehouse.item_id", item_id)
+                    item_span.set_attribute("warehouse.requested_quantity", quantity)
+                    picked = allocation.allocate(levels.get(item_id, []), quantity, strategy_name)
+                    if picked is None:
+                        results[index] = {"status": "failure", "message": "Insufficient inventory in warehouse"}
+                        continue
+                    picked.apply()
+                    record_allocation(item_span, picked)
+                    allocations.append((index, picked))
 
-        # Format the trace ID into a hexadecimal string
-        trace_id_hex = format(trace_id, '032x')
+            try:
+                if allocations:
+                    reserve_allocations([picked for _, picked in allocations])
+                commit_holds([picked for _, picked in allocations])
+            except ReservationConflict as e:
+                db.session.rollback()
+                app.logger.error("reservation conflict in batch: %s", e)
+                return jsonify({"status": "failure", "message": "Reservation conflict, retry the request"}), 409
 
-        # Log the trace ID
-        app.logger.info(f"warehouse-service about to make a database query. trace_id={trace_id_hex}")
+        for index, picked in allocations:
+            item = items[index]
+            results[index] = {
+                "status": "success",
+                "message": f"Reserved {item['quantity']} of item {item['item_id']}",
+                "allocations": allocation_summary(picked)
+            }
+        return jsonify({"status": "success", "results": results}), 200
 
-        # Start a new span for the database operation
-        randomid = random.randint(0,4)
+@app.route('/warehouse/reserve/items', methods=['POST'])
+def reserve_items():
+    """Reserve every line item of one order, all or nothing."""
+    payload = request.get_json()
+    items = payload.get('items', [])
+    strategy_name = payload.get('allocation_strategy')
+    if strategy_name and strategy_name not in allocation.STRATEGIES:
+        return jsonify({"status": "failure", "message": f"Unknown allocation strategy {strategy_name}"}), 400
+    if not items:
+        return jsonify({"status": "failure", "message": "No items to reserve"}), 400
+    tracer = trace.get_tracer(__name__)
+
+    with tracer.start_as_current_span("reserve_items") as items_span:
+        items_span.set_attribute("warehouse.item_count", len(items))
+        app.logger.info("warehouse-service about to make a database query")
 
         with tracer.start_as_current_span("database_operation") as span:
-            warehouse_item = WarehouseInventory.query.filter_by(item_id=item_id, warehouse_location=warehouse_location).first()
-            if warehouse_item and warehouse_item.available_quantity >= quantity:
-                warehouse_item.available_quantity -= quantity
-                warehouse_item.reserved_quantity += quantity
-                warehouse_item.reservation_timestamp = datetime.utcnow()
-                warehouse_item.reservation_status = "reserved"
-                db.session.commit()
-                sql_query =  f"UPDATE warehouse_inventory SET available_quantity = {warehouse_item.available_quantity}, reserved_quantity = {warehouse_item.reserved_quantity} WHERE id = {warehouse_item.id}"
-                span.set_attribute("db.query", sql_query)
-                return jsonify({"status": "success", "message": f"Reserved {quantity} of item {item_id}"}), 200
-            else:
-                return jsonify({"status": "failure", "message": "Insufficient inventory in warehouse"}), 400
+            span.set_attribute("warehouse.item_ids", [item['item_id'] for item in items])
+            span.set_attribute("warehouse.requested_quantities", [item['quantity'] for item in items])
+            span.set_attribute("db.query", RESERVE_QUERY.text)
+            levels = stock_levels({item['item_id'] for item in items})
+
+            allocations = []
+            for item in items:
+                picked = allocation.allocate(levels.get(item['item_id'], []), item['quantity'], strategy_name)
+                if picked is None:
+                    db.session.rollback()
+                    return jsonify({
+                        "status": "failure",
+                        "message": "Insufficient inventory in warehouse",
+                        "item_id": item['item_id']
+                    }), 400
+                # Lines of the same item draw from what the earlier lines left
+                picked.apply()
+                allocations.append(picked)
+
+            try:
+                reserve_allocations(allocations)
+                commit_holds(allocations)
+            except ReservationConflict as e:
+                db.session.rollback()
+                app.logger.error("reservation conflict for items: %s", e)
+                return jsonify({"status": "failure", "message": "Reservation conflict, retry the request"}), 409
+
+            return jsonify({
+                "status": "success",
+                "message": f"Reserved {len(items)} items",
+                "items": [{
+                    "item_id": item['item_id'],
+                    "quantity": item['quantity'],
+                    "allocations": allocation_summary(picked)
+                } for item, picked in zip(items, allocations)]
+            }), 200
+
+@app.route('/warehouse/release', methods=['POST'])
+def release_items():
+    # items: [{"item_id": ..., "allocations": [{"warehouse_location": ..., "quantity": ...}]}]
+    items = request.get_json().get('items', [])
+    tracer = trace.get_tracer(__name__)
+
+    with tracer.start_as_current_span("release_reservation") as span:
+        allocations = [each for item in items for each in item.get('allocations') or []]
+        # Reservations with a hold are released through it, a hold that
+        # expired already gave its stock back
+        hold_ids = [each['hold_id'] for each in allocations if each.get('hold_id')]
+        params = [
+            {"item_id": item['item_id'], "location": each['warehouse_location'], "quantity": each['quantity']}
+            for item in items
+            for each in item.get('allocations') or []
+            if not each.get('hold_id')
+        ]
+        span.set_attribute("warehouse.item_ids", [item['item_id'] for item in items])
+        span.set_attribute("warehouse.allocation.locations", [each['warehouse_location'] for each in allocations])
+        span.set_attribute("warehouse.allocation.quantities", [each['quantity'] for each in allocations])
+        span.set_attribute("warehouse.hold_count", len(hold_ids))
+        if hold_ids and holds.release(db, hold_ids):
+            db.session.rollback()
+            return jsonify({"status": "failure", "message": "Reservation not found"}), 409
+        if params:
+            result = db.session.execute(RELEASE_QUERY, params)
+            if result.rowcount != len(params):
+                db.session.rollback()
+                return jsonify({"status": "failure", "message": "Reservation not found"}), 409
+        db.session.commit()
+        return jsonify({"status": "success", "message": f"Released {len(items)} items"}), 200
+
+@app.route('/warehouse/confirm', methods=['POST'])
+def confirm_holds():
+    """Keep the reservations of completed orders, their holds no longer expire.
+
+    The holds of a call may belong to many orders, every hold that is still
+    held is confirmed. Holds that expired or were released lost their stock,
+    their ids are returned as lost so one of them does not fail the others.
+    """
+    hold_ids = request.get_json().get('hold_ids', [])
+    tracer = trace.get_tracer(__name__)
+
+    with tracer.start_as_current_span("confirm_reservation") as span:
+        span.set_attribute("warehouse.hold_count", len(hold_ids))
+        lost = []
+        confirmed = holds.set_status(db, hold_ids, holds.CONFIRMED)
+        if confirmed != len(hold_ids):
+            # Holds confirmed before are fine
+            statuses = {row.id: row.status for row in db.session.execute(holds.HOLDS_QUERY, {"hold_ids": hold_ids})}
+            lost = [hold_id for hold_id in hold_ids if statuses.get(hold_id) != holds.CONFIRMED]
+        db.session.commit()
+        if lost:
+            span.set_attribute("warehouse.lost_holds", len(lost))
+            app.logger.warning('%s of %s holds expired or were released before their confirmation', len(lost), len(hold_ids))
+        return jsonify({
+            "status": "success",
+            "message": f"Confirmed {len(hold_ids) - len(lost)} holds",
+            "lost": lost,
+        }), 200
+
+@app.route('/warehouse/holds/stats', methods=['GET'])
+def hold_stats():
+    return jsonify(hold_sweeper.stats()), 200
+
+SEED_QUERY = text(
+    "INSERT OR IGNORE INTO warehouse_inventory (id, item_id, warehouse_location, available_quantity, reserved_quantity) "
+    "VALUES (:id, :item_id, :location, :quantity, 0)"
+)
 
 def seed_warehouse_inventory():
     with app.app_context():
         db.create_all()
+        # create_all() only indexes new tables, add the indexes to existing databases
+        for index in WarehouseInventory.__table__.indexes | WarehouseHold.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
 
-        # Data to seed the database
+        # Data to seed the database, rows that exist already are kept
         warehouse_items = [
-            WarehouseInventory(
-                id="sku001_warehouseA",
-                item_id="sku001",
-                warehouse_location="Warehouse-A",
-                available_quantity=int(INVENTORY_AVAILABILITY),
-                reserved_quantity=0,
-                reservation_timestamp=None,
-                reservation_status=None
-            ),
-            WarehouseInventory(
-                id="sku002_warehouseA",
-                item_id="sku002",
-                warehouse_location="Warehouse-A",
-                available_quantity=30,
-                reserved_quantity=0,
-                reservation_timestamp=None,
-                reservation_status=None
-            ),
-            WarehouseInventory(
-                id="sku001_warehouseB",
-                item_id="sku001",
-                warehouse_location="Warehouse-B",
-                available_quantity=40,
-                reserved_quantity=0,
-                reservation_timestamp=None,
-                reservation_status=None
-            ),
+            {"id": "sku001_warehouseA", "item_id": "sku001", "location": "Warehouse-A", "quantity": int(INVENTORY_AVAILABILITY)},
+            {"id": "sku002_warehouseA", "item_id": "sku002", "location": "Warehouse-A", "quantity": 30},
+            {"id": "sku001_warehouseB", "item_id": "sku001", "location": "Warehouse-B", "quantity": 40},
         ]
-
-        # Loop over warehouse items
-        for item in warehouse_items:
-            # Check if the item already exists in the database
-            existing_item = WarehouseInventory.query.filter_by(id=item.id).first()
-            if existing_item:
-                print(f"Item with id {item.id} already exists. Skipping.")
-            else:
-                db.session.add(item)
-        
-        # Commit to the db
+        db.session.execute(SEED_QUERY, warehouse_items)
         db.session.commit()
 
-if __name__ == '__main__':
+def init_db():
+    """Create the schema and seed data, runs once before the server starts."""
     with app.app_context():
         seed_warehouse_inventory()
+
+if __name__ == '__main__':
+    init_db()
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,261 @@
+import os
+import math
+import time
+import heapq
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import DateTime, bindparam, text
+
+# Reserved stock goes back to its location when the order does not confirm
+# the hold within WAREHOUSE_HOLD_TTL_SECONDS
+WAREHOUSE_HOLD_TTL_SECONDS = os.getenv('WAREHOUSE_HOLD_TTL_SECONDS', 300)
+# The sweeper wakes at the next known expiry, and at least every interval
+# for holds created by other workers
+WAREHOUSE_SWEEP_INTERVAL_MS = os.getenv('WAREHOUSE_SWEEP_INTERVAL_MS', 1000)
+WAREHOUSE_SWEEP_BATCH_SIZE = os.getenv('WAREHOUSE_SWEEP_BATCH_SIZE', 500)
+
+HELD = 'held'
+CONFIRMED = 'confirmed'
+RELEASED = 'released'
+EXPIRED = 'expired'
+# Expired, and the inventory-service got the stock back as well
+RESTOCKED = 'restocked'
+
+# Expired holds, oldest first, read through the (status, expires_at) index
+DUE_QUERY = text(
+    "SELECT id, row_id, quantity FROM warehouse_holds "
+    "WHERE status = 'held' AND expires_at <= :now ORDER BY expires_at LIMIT :limit"
+).bindparams(bindparam('now', type_=DateTime))
+HOLDS_QUERY = text(
+    "SELECT id, row_id, quantity, status FROM warehouse_holds WHERE id IN :hold_ids"
+).bindparams(bindparam('hold_ids', expanding=True))
+# Expired holds the inventory-service was not told about yet, with their item
+UNREPORTED_QUERY = text(
+    "SELECT h.id, i.item_id, h.quantity FROM warehouse_holds h "
+    "JOIN warehouse_inventory i ON i.id = h.row_id "
+    "WHERE h.status = 'expired' ORDER BY h.expires_at LIMIT :limit"
+)
+# Holds only change while they are held, a hold is released, confirmed or expired once
+SET_STATUS_QUERY = text(
+    "UPDATE warehouse_holds SET status = :status WHERE id IN :hold_ids AND status = :current"
+).bindparams(bindparam('hold_ids', expanding=True))
+RETURN_STOCK_QUERY = text(
+    "UPDATE warehouse_inventory SET "
+    "available_quantity = available_quantity + :quantity, "
+    "reserved_quantity = reserved_quantity - :quantity, "
+    "reservation_status = CASE WHEN reserved_quantity > :quantity THEN reservation_status ELSE 'released' END "
+    "WHERE id = :row_id"
+)
+
+def ttl():
+    return timedelta(seconds=float(WAREHOUSE_HOLD_TTL_SECONDS))
+
+def return_stock(db, holds):
+    """Give the stock of the holds back to their locations, one UPDATE per
+    location with a single executemany."""
+    quantities = {}
+    for hold in holds:
+        quantities[hold.row_id] = quantities.get(hold.row_id, 0) + hold.quantity
+    if quantities:
+        db.session.execute(RETURN_STOCK_QUERY, [
+            {"row_id": row_id, "quantity": quantity} for row_id, quantity in quantities.items()
+        ])
+
+def set_status(db, hold_ids, status, current=HELD):
+    """Move the holds of hold_ids still in current to status in the current
+    transaction, returns how many changed."""
+    if not hold_ids:
+        return 0
+    return db.session.execute(SET_STATUS_QUERY, {
+        "hold_ids": list(hold_ids), "status": status, "current": current,
+    }).rowcount
+
+def release(db, hold_ids):
+    """Release the held ones of hold_ids and return their stock, in the
+    current transaction. Holds that expired or were released already are
+    skipped, their stock is back. Returns the ids of unknown holds."""
+    holds = db.session.execute(HOLDS_QUERY, {"hold_ids": list(hold_ids)}).all()
+    held = [hold for hold in holds if hold.status == HELD]
+    set_status(db, [hold.id for hold in held], RELEASED)
+    return_stock(db, held)
+    known = {hold.id for hold in holds}
+    return [hold_id for hold_id in hold_ids if hold_id not in known]
+
+class HoldSweeper:
+    """Releases the holds whose TTL passed.
+
+    Expired holds are found through the (status, expires_at) index, never by
+    scanning the table, and released batch_size at a time: one UPDATE marks
+    them expired and one executemany gives the stock back per location, in
+    one transaction. A min-heap of the expiry times of the holds created in
+    this worker lets the sweeper wake when the next one is due, the interval
+    bounds the wait for holds of other workers. Expiries are rounded up to
+    BUCKET_SECONDS, so the heap holds one entry per bucket, not per hold.
+
+    The inventory-service took the same stock off when the order was
+    reserved. After a sweep, restock(items) hands it the quantity per item
+    of the expired holds, and they are marked restocked. The holds are
+    claimed before the call, so two workers never report one twice, and
+    put back when it fails, the next sweep reports them again.
+    """
+
+    BUCKET_SECONDS = 0.1
+
+    def __init__(self, app, db, restock=None, interval_ms=None, batch_size=None):
+        self.app = app
+        self.db = db
+        self.restock = restock
+        self.interval = float(WAREHOUSE_SWEEP_INTERVAL_MS if interval_ms is None else interval_ms) / 1000.0
+        self.batch_size = int(WAREHOUSE_SWEEP_BATCH_SIZE if batch_size is None else batch_size)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.expiries = []
+        self.buckets = set()
+        self.thread_pid = None
+        self.sweeps = 0
+        self.failed_sweeps = 0
+        self.released_holds = 0
+        self.released_quantity = 0
+        self.restocked_holds = 0
+        self.failed_restocks = 0
+        self.sweep_seconds_total = 0.0
+        self.sweep_seconds_max = 0.0
+        self.last_sweep_seconds = 0.0
+
+    def ensure_thread(self):
+        # Started on first use, so every forked worker gets its own thread
+        if self.thread_pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread_pid == os.getpid():
+                return
+            self.thread_pid = os.getpid()
+            self.expiries = []
+            self.buckets = set()
+            threading.Thread(target=self._run, name='hold-sweeper', daemon=True).start()
+
+    def track(self, expires_at):
+        """Wake the sweeper when a hold created in this worker expires."""
+        self.ensure_thread()
+        # datetime.utcnow() based expiry to the monotonic clock of the heap
+        due = time.monotonic() + (expires_at - datetime.utcnow()).total_seconds()
+        bucket = math.ceil(due / self.BUCKET_SECONDS) * self.BUCKET_SECONDS
+        with self.lock:
+            if bucket in self.buckets:
+                return
+            self.buckets.add(bucket)
+            heapq.heappush(self.expiries, bucket)
+            if self.expiries[0] == bucket:
+                self.wakeup.notify()
+
+    def _wait(self):
+        with self.lock:
+            timeout = self.interval
+            if self.expiries:
+                timeout = min(timeout, max(0.0, self.expiries[0] - time.monotonic()))
+            if timeout > 0:
+                self.wakeup.wait(timeout)
+            now = time.monotonic()
+            while self.expiries and self.expiries[0] <= now:
+                self.buckets.discard(heapq.heappop(self.expiries))
+
+    def _run(self):
+        while True:
+            self._wait()
+            try:
+                self.sweep()
+            except Exception:
+                with self.lock:
+                    self.failed_sweeps += 1
+                self.app.logger.exception('warehouse hold sweep failed')
+            try:
+                self.report()
+            except Exception:
+                with self.lock:
+                    self.failed_restocks += 1
+                self.app.logger.exception('restocking the inventory of expired holds failed')
+
+    def sweep(self, now=None):
+        """Release every hold that expired by now, returns how many were released."""
+        started = time.perf_counter()
+        released = 0
+        quantity = 0
+        with self.app.app_context():
+            while True:
+                due = self.db.session.execute(DUE_QUERY, {
+                    "now": now or datetime.utcnow(),
+                    "limit": self.batch_size,
+                }).all()
+                if not due:
+                    self.db.session.rollback()
+                    break
+                if set_status(self.db, [hold.id for hold in due], EXPIRED) != len(due):
+                    # Changed by another worker since the query, read them again
+                    self.db.session.rollback()
+                    continue
+                return_stock(self.db, due)
+                self.db.session.commit()
+                released += len(due)
+                quantity += sum(hold.quantity for hold in due)
+                if len(due) < self.batch_size:
+                    break
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.sweeps += 1
+            self.released_holds += released
+            self.released_quantity += quantity
+            self.sweep_seconds_total += elapsed
+            self.sweep_seconds_max = max(self.sweep_seconds_max, elapsed)
+            self.last_sweep_seconds = elapsed
+        if released:
+            self.app.logger.info('released %s expired holds (%s units) in %.1f ms', released, quantity, elapsed * 1000.0)
+        return released
+
+    def report(self):
+        """Give the stock of expired holds back to the inventory-service,
+        returns how many holds were reported."""
+        if self.restock is None:
+            return 0
+        reported = 0
+        with self.app.app_context():
+            while True:
+                due = self.db.session.execute(UNREPORTED_QUERY, {"limit": self.batch_size}).all()
+                if not due:
+                    self.db.session.rollback()
+                    break
+                hold_ids = [hold.id for hold in due]
+                if set_status(self.db, hold_ids, RESTOCKED, current=EXPIRED) != len(due):
+                    # Claimed by another worker since the query, read them again
+                    self.db.session.rollback()
+                    continue
+                self.db.session.commit()
+                quantities = {}
+                for hold in due:
+                    quantities[hold.item_id] = quantities.get(hold.item_id, 0) + hold.quantity
+                try:
+                    self.restock([{"item_id": item_id, "quantity": quantity} for item_id, quantity in quantities.items()])
+                except Exception:
+                    set_status(self.db, hold_ids, EXPIRED, current=RESTOCKED)
+                    self.db.session.commit()
+                    raise
+                reported += len(due)
+                if len(due) < self.batch_size:
+                    break
+        with self.lock:
+            self.restocked_holds += reported
+        return reported
+
+    def stats(self):
+        with self.lock:
+            return {
+                "tracked_expiries": len(self.expiries),
+                "sweeps": self.sweeps,
+                "failed_sweeps": self.failed_sweeps,
+                "released_holds": self.released_holds,
+                "released_quantity": self.released_quantity,
+                "restocked_holds": self.restocked_holds,
+                "failed_restocks": self.failed_restocks,
+                "last_sweep_seconds": round(self.last_sweep_seconds, 6),
+                "max_sweep_seconds": round(self.sweep_seconds_max, 6),
+                "average_sweep_seconds": round(self.sweep_seconds_total / self.sweeps, 6) if self.sweeps else 0.0,
+            }